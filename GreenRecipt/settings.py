@@ -245,3 +245,121 @@ GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY')
 GOOGLE_MAPS_GEOCODING_ENABLED = True
 # ジオコーディング実行制限 (1回あたり)
 GOOGLE_MAPS_GEOCODING_LIMIT_PER_RUN = 100
+
+#  - -  エコ商品照合設定  - -
+
+# OCR誤字を許容する類似度の閾値 (0〜1, 1で完全一致のみ)
+ECO_PRODUCT_MATCH_THRESHOLD = float(os.environ.get('ECO_PRODUCT_MATCH_THRESHOLD', '0.8'))
+# 候補絞り込みに使用する文字n-gramの長さ
+ECO_PRODUCT_NGRAM_SIZE = 2
+
+#  - -  バックグラウンドジョブ設定  - -
+
+# 実行中のまま更新がないジョブを停止したとみなすまでの分数 (--resumeの対象判定に使用)
+BACKGROUND_JOB_STALE_MINUTES = 30
+
+#  - -  再採点ジョブ設定  - -
+
+# 1チャンクあたりのレシート明細数
+RESCORE_CHUNK_SIZE = 1000
+# 採点を並列実行するワーカープロセス数
+RESCORE_WORKERS = int(os.environ.get('RESCORE_WORKERS', '1'))
+# チャンクごとの待機秒数 (Webワーカーへの負荷軽減)
+RESCORE_PAUSE_SECONDS = 0.05
+# 再解析ジョブの1チャンクあたりのレシート数
+REPARSE_CHUNK_SIZE = 500
+
+#  - -  重複レシート検出設定  - -
+
+# 撮り直したレシートを同一とみなす文字シングルの類似度 (Jaccard係数, 0〜1)
+RECEIPT_NEAR_DUPLICATE_SIMILARITY = 0.8
+# 同一画像とみなす画像ハッシュ (dHash, 64ビット) のハミング距離
+RECEIPT_IMAGE_HASH_MAX_DISTANCE = 5
+# 画像ハッシュを比較する直近のレシート数 (ユーザーごと)
+RECEIPT_IMAGE_HASH_LOOKBACK = 100
+
+#  - -  ランク・特典ルール設定  - -
+
+# ルールのキャッシュを読み直す最大間隔 (秒)。CACHES 未設定 (プロセスごとのLocMemCache) の場合、
+# 変更が即時に反映されるのは変更したプロセスのみで、他のワーカーへの反映はこの間隔が上限となる
+REWARD_RULES_MAX_AGE = 300
+
+#  - -  クーポン一括付与設定  - -
+
+# 1回の一括登録で付与するユーザー数
+COUPON_GRANT_CHUNK_SIZE = 1000
+# 管理画面からの全員付与で、これを超える人数はバックグラウンドジョブで実行する
+COUPON_GRANT_SYNC_LIMIT = 5000
+
+#  - -  クーポン統計設定  - -
+
+# スタッフホームのクーポン統計をキャッシュする秒数。付与・利用時はキャッシュのバージョンを更新して無効化するが、
+# CACHES 未設定 (プロセスごとのLocMemCache) の場合に即時に反映されるのは変更したプロセスのみで、
+# 他のワーカーへの反映はこの秒数が上限となる
+COUPON_STATS_CACHE_TIMEOUT = 300
+# ユーザーごとのクーポン取得可否をキャッシュする秒数。付与・利用時はそのユーザーの分を無効化するが、
+# 即時に反映されるのは変更したプロセスのみで、他のワーカーへの反映はこの秒数が上限となる（取得時の判定はDBで行う）
+COUPON_ELIGIBILITY_CACHE_TIMEOUT = 600
+
+#  - -  クーポン利用設定  - -
+
+# POS端末からの一括利用で1リクエストに含められる件数
+COUPON_REDEMPTION_BATCH_LIMIT = 100
+# 店舗端末がオフライン検証するクーポントークンの共有鍵 (未設定時はSECRET_KEYから導出)
+COUPON_TOKEN_KEY = os.environ.get('COUPON_TOKEN_KEY', '')
+# クーポン一覧で発行するトークンの有効期間 (秒)
+COUPON_TOKEN_TTL = 15 * 60
+# 有効期限後もトークンの利用報告を受け付ける猶予 (秒)。端末がオフラインの間に検証した利用の報告用
+COUPON_TOKEN_REPORT_GRACE = 24 * 60 * 60
+
+#  - -  クーポン利用統計設定  - -
+
+# クーポン利用詳細の履歴一覧の1ページの件数
+COUPON_HISTORY_PAGE_SIZE = 50
+
+#  - -  店舗マップ設定  - -
+
+# このズームレベル未満では近接する店舗をクラスターにまとめて返す
+STORE_MAP_CLUSTER_MAX_ZOOM = 15
+# 近い店舗の検索で返す最大件数と最大半径 (km)
+STORE_NEAREST_MAX_K = 50
+STORE_NEAREST_MAX_RADIUS_KM = 50
+# 店舗インデックスを作り直す最大間隔 (秒)。CACHES 未設定 (プロセスごとのLocMemCache) の場合、
+# 店舗の変更が即時に反映されるのは変更したプロセスのみで、他のワーカーへの反映はこの間隔が上限となる
+STORE_INDEX_MAX_AGE = 60
+
+#  - -  ジオコーディング設定  - -
+
+# 問い合わせるプロバイダーの順序 ('nominatim' / 'google' / 'stub')。googleはAPIキー設定時のみ使用
+GEOCODING_PROVIDERS = ['nominatim', 'google']
+NOMINATIM_USER_AGENT = 'GreenRecipt_Geocoder'
+# プロバイダーごとの問い合わせ上限 (回/秒)。Nominatimは利用規約により1回/秒まで。未指定のプロバイダーは制限なし
+GEOCODING_RATE_LIMITS = {'nominatim': 1.0, 'google': 25.0}
+# geocode_stores の1バッチの店舗数と並列に問い合わせるスレッド数
+GEOCODING_BATCH_SIZE = 50
+GEOCODING_WORKERS = 4
+# ジオコーディング結果のキャッシュ期間。見つからなかった住所は短めに保持して再試行する
+GEOCODE_CACHE_TTL_DAYS = 180
+GEOCODE_NEGATIVE_CACHE_TTL_HOURS = 24
+
+#  - -  店舗照合設定  - -
+
+# レシートのヘッダーを既存の店舗名・別名とあいまい照合する際の類似度の閾値 (0〜1)
+STORE_RESOLVE_THRESHOLD = 0.85
+# 照合用インデックスを作り直す最大間隔 (秒)。CACHES 未設定 (プロセスごとのLocMemCache) の場合、
+# 他のワーカーで追加・変更された店舗と別名の反映はこの間隔が上限となる
+STORE_RESOLVER_MAX_AGE = 60
+
+#  - -  AIレポート設定  - -
+
+# 生成モデル ('gemini' / 'stub') と Gemini のモデル名
+AI_REPORT_MODEL = 'gemini'
+AI_REPORT_MODEL_NAME = 'gemini-flash-latest'
+# 同時に問い合わせる数と1分あたりのリクエスト数の上限 (0は制限なし)
+AI_REPORT_CONCURRENCY = 4
+AI_REPORT_REQUESTS_PER_MINUTE = 60
+# 失敗時の再試行回数と待ち時間の起点 (秒、再試行ごとに倍増)
+AI_REPORT_MAX_RETRIES = 3
+AI_REPORT_RETRY_BACKOFF_SECONDS = 2.0
+# 1回のジョブでまとめて生成するユーザー数
+AI_REPORT_BATCH_SIZE = 20
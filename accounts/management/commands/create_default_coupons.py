@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
-from core.models import Coupon
+from core.models import Coupon, RewardRule
+from core.services import CouponGrantService
 
 class Command(BaseCommand):
     help = 'ランク別のデフォルトクーポンを作成します。'
@@ -8,24 +9,28 @@ class Command(BaseCommand):
         coupons_to_create = [
             {
                 'title': 'ブロンズランク特典',
+                'rule': {'kind': 'rank_reached', 'rank': 'sprout'},
                 'description': '全商品10%割引',
                 'type': 'percentage',
                 'discount_value': 10.00,
             },
             {
                 'title': 'シルバーランク特典',
+                'rule': {'kind': 'rank_reached', 'rank': 'tree'},
                 'description': '全商品20%割引',
                 'type': 'percentage',
                 'discount_value': 20.00,
             },
             {
                 'title': 'ゴールドランク特典',
+                'rule': {'kind': 'rank_reached', 'rank': 'apple_tree'},
                 'description': '500円割引',
                 'type': 'absolute',
                 'discount_value': 500.00,
             },
             {
                 'title': '1000ポイント達成記念',
+                'rule': {'kind': 'points_milestone', 'points': 1000},
                 'description': '次回のお買い物で使える300円割引クーポン',
                 'type': 'absolute',
                 'discount_value': 300.00,
@@ -33,6 +38,7 @@ class Command(BaseCommand):
         ]
 
         for coupon_data in coupons_to_create:
+            rule = coupon_data.pop('rule')
             coupon, created = Coupon.objects.get_or_create(
                 title=coupon_data['title'],
                 defaults=coupon_data
@@ -41,3 +47,12 @@ class Command(BaseCommand):
                 self.stdout.write(self.style.SUCCESS(f'クーポンを作成しました: "{coupon.title}"'))
             else:
                 self.stdout.write(self.style.WARNING(f'クーポンは既に存在します: "{coupon.title}"'))
+
+            # ランク到達・ポイント達成時に自動付与されるよう特典ルールを登録
+            _rule, rule_created = RewardRule.objects.get_or_create(coupon=coupon, **rule)
+            if rule_created:
+                self.stdout.write(self.style.SUCCESS(f'特典ルールを登録しました: "{coupon.title}"'))
+
+        # 既に条件を満たしているユーザーにも特典を一括付与
+        granted = CouponGrantService.grant_rule_rewards()
+        self.stdout.write(self.style.SUCCESS(f'条件を満たすユーザーに {sum(granted.values())} 件の特典を付与しました。'))
@@ -1,49 +1,38 @@
-from django.core.management.base import BaseCommand
-from accounts.models import CustomUser
-from core.models import Coupon
-from django.db.models import Q
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.models import Coupon, RewardRule
+from core.services import BackgroundJobService, CouponGrantService
+
 
 class Command(BaseCommand):
-    help = 'ランクに基づいてユーザーにクーポンを付与します。'
+    help = 'クーポンを未所持のユーザーに一括付与します（省略時は特典ルールに基づくランク・ポイント特典）。'
 
-    def handle(self, *args, **options):
-        # ランクとクーポンのタイトルのマッピング
-        rank_coupon_map = {
-            'bronze': 'ブロンズランク特典',
-            'silver': 'シルバーランク特典',
-            'gold': 'ゴールドランク特典',
-        }
+    def add_arguments(self, parser):
+        parser.add_argument('--coupon', type=int, help='必要ポイントを満たす全員に付与するクーポンのID')
+        parser.add_argument('--chunk-size', type=int, default=settings.COUPON_GRANT_CHUNK_SIZE, help='1回に登録する付与人数')
+        parser.add_argument('--enqueue', action='store_true', help='--coupon の付与をバックグラウンドジョブとして登録のみ行う')
 
-        # 対象となるクーポンを事前に一括で取得
-        try:
-            coupons = Coupon.objects.filter(title__in=rank_coupon_map.values())
-            coupon_map = {coupon.title: coupon for coupon in coupons}
-        except Coupon.DoesNotExist:
-            self.stdout.write(self.style.ERROR('デフォルトクーポンが見つかりません。"create_default_coupons" を先に実行してください。'))
+    def handle(self, *args, **options):
+        if options['coupon']:
+            try:
+                coupon = Coupon.objects.get(pk=options['coupon'])
+            except Coupon.DoesNotExist:
+                raise CommandError(f'クーポン #{options["coupon"]} が見つかりません。')
+            job = CouponGrantService.schedule(coupon, chunk_size=options['chunk_size'])
+            if options['enqueue']:
+                self.stdout.write(self.style.SUCCESS(f'付与ジョブ #{job.pk} を登録しました。run_jobs で実行されます。'))
+                return
+            job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk), stdout=self.stdout)
+            if job.status != 'completed':
+                raise CommandError(f'付与に失敗しました: {job.error}')
+            self.stdout.write(self.style.SUCCESS(f'{job.result["granted"]} 人に "{coupon.title}" を付与しました。'))
             return
 
-        # 全てのユーザーを取得
-        users = CustomUser.objects.filter(role='user')
-
-        granted_count = 0
-        for user in users:
-            # ユーザーのランクに対応するクーポンのタイトルを取得
-            target_coupon_title = rank_coupon_map.get(user.rank.lower())
-            
-            if not target_coupon_title:
-                continue
-
-            # 対応するクーポンオブジェクトを取得
-            target_coupon = coupon_map.get(target_coupon_title)
-            if not target_coupon:
-                self.stdout.write(self.style.WARNING(f'クーポン "{target_coupon_title}" がデータベースに見つかりません。'))
-                continue
-
-            # ユーザーが既にそのクーポンを持っているか確認
-            if not user.current_coupons.filter(pk=target_coupon.pk).exists():
-                # クーポンを付与
-                user.current_coupons.add(target_coupon)
-                granted_count += 1
-                self.stdout.write(f'ユーザー {user.username} に "{target_coupon.title}" を付与しました。')
+        if not RewardRule.objects.filter(is_active=True).exists():
+            self.stdout.write(self.style.ERROR('有効な特典ルールがありません。"create_default_coupons" を先に実行してください。'))
+            return
 
-        self.stdout.write(self.style.SUCCESS(f'{granted_count} 人のユーザーにクーポン付与が完了しました。'))
+        granted = CouponGrantService.grant_rule_rewards(chunk_size=options['chunk_size'])
+        for coupon, count in granted.items():
+            self.stdout.write(f'"{coupon.title}": {count} 人に付与しました。')
+        self.stdout.write(self.style.SUCCESS(f'{sum(granted.values())} 件のクーポン付与が完了しました。'))
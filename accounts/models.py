@@ -1,7 +1,9 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
-from core.models import Coupon
+from core.models import PointTransaction
+from core.rewards import get_reward_engine
 
 
 class CustomUser(AbstractUser):
@@ -58,81 +60,97 @@ class CustomUser(AbstractUser):
         blank=True, null=True, verbose_name='退会確認コード有効期限'
     )
 
-    # ランク階層を定義
-    RANK_HIERARCHY = {'seed': 0, 'sprout': 1, 'tree': 2, 'apple_tree': 3}
+    @classmethod
+    def rank_for_points(cls, points):
+        """ポイント数に対応するランクを返す（RankTierの設定に従う）"""
+        return get_reward_engine().rank_for_points(points)
+
+    @classmethod
+    def rank_expression(cls, points='current_points'):
+        """一括更新用: ポイント（列名または式）からランクを求めるSQL式を返す"""
+        return get_reward_engine().rank_expression(points)
 
     def _update_rank(self):
         """ポイントに基づいてランクを更新する"""
-        points = self.current_points
-        new_rank = self.rank
-
-        if points >= 800:
-            new_rank = 'apple_tree'
-        elif points >= 300:
-            new_rank = 'tree'
-        elif points >= 100:
-            new_rank = 'sprout'
-        else:
-            new_rank = 'seed'
-        
-        self.rank = new_rank
-
-    def add_points(self, points):
-        """ポイントを加算し、ランクを更新して保存する"""
-        self.current_points += points
-        self._update_rank()
-        self.save()
+        self.rank = self.rank_for_points(self.current_points)
+
+    def add_points(self, points, reason='adjustment', receipt=None, coupon=None):
+        """
+        ポイントの増減を台帳に記録し、残高とランクをF()式による1回のUPDATEで更新する。
+        同時に実行されても加算が失われないよう、読み出し→加算→保存は行わない。
+        更新後の値を読み直して特典を判定し、新しい残高を返す。
+        """
+        with transaction.atomic():
+            PointTransaction.objects.create(user=self, delta=points, reason=reason, receipt=receipt, coupon=coupon)
+            new_points = F('current_points') + points
+            CustomUser.objects.filter(pk=self.pk).update(current_points=new_points, rank=self.rank_expression(new_points))
+            self.current_points, self.rank = CustomUser.objects.filter(pk=self.pk).values_list(
+                'current_points', 'rank').get()
+            self._remember_loaded_values()
+
+        old_points = self.current_points - points
+        self.grant_point_rewards(self.rank_for_points(old_points), old_points)
+        return self.current_points
+
+    # 読み込み時の値を保持し、保存時に変更の有無を判定するフィールド
+    TRACKED_FIELDS = ('current_points', 'rank')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_loaded_values()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._remember_loaded_values()
+
+    def _remember_loaded_values(self):
+        """DBと一致している追跡フィールドの値を記録する（遅延読み込みのフィールドは除く）"""
+        loaded = getattr(self, '_loaded_values', {})
+        loaded.update({field: self.__dict__[field] for field in self.TRACKED_FIELDS if field in self.__dict__})
+        self._loaded_values = loaded
+
+    def _loaded_value(self, field):
+        """読み込み時の値を返す。未記録の場合のみDBから取得する"""
+        if self._state.adding:
+            return self._meta.get_field(field).get_default()
+        if field not in self._loaded_values:
+            self._loaded_values[field] = CustomUser.objects.filter(pk=self.pk).values_list(field, flat=True).first()
+        return self._loaded_values[field]
 
     def save(self, *args, **kwargs):
-        # 1. 更新前処理
-        is_new_user = self.pk is None
-        old_rank = 'seed'
-        old_points = 0
-        if not is_new_user:
-            try:
-                # 保存前の状態取得
-                old_self = CustomUser.objects.get(pk=self.pk)
-                old_rank = old_self.rank
-                old_points = old_self.current_points
-            except CustomUser.DoesNotExist:
-                # ユーザー不在エラー無視
-                pass
-
-        # 2. ランク自動更新
-        self._update_rank()
-        
+        update_fields = kwargs.get('update_fields')
+        if not hasattr(self, '_loaded_values'):
+            self._loaded_values = {}
+
+        # 1. 更新前の値（読み込み時の値と比較し、保存前のSELECTは行わない）
+        points_saved = update_fields is None or 'current_points' in update_fields
+        old_points = self._loaded_value('current_points') if points_saved else self.current_points
+        points_changed = points_saved and self.current_points != old_points
+
+        # 2. ランク自動更新（ポイントが変わった場合のみ）
+        if points_changed:
+            old_rank = self._loaded_value('rank')
+            self._update_rank()
+            if update_fields is not None:
+                kwargs['update_fields'] = update_fields = {*update_fields, 'rank'}
+
         # 3. 保存実行
-        if not self.is_superuser:
+        if not self.is_superuser and (update_fields is None or 'role' in update_fields):
             self.is_staff = self.role in ['admin', 'system', 'store']
+            if update_fields is not None:
+                kwargs['update_fields'] = update_fields = {*update_fields, 'is_staff'}
         super().save(*args, **kwargs)
+        self._remember_loaded_values()
+
+        # 4. クーポン付与（ポイントが変わった場合のみ）
+        if points_changed:
+            self.grant_point_rewards(old_rank, old_points)
 
-        # 4. クーポン付与
-        # ランクアップ特典
-        rank_coupon_map = {
-            'sprout': 'ブロンズランク特典', # クーポン名定義
-            'tree': 'シルバーランク特典',
-            'apple_tree': 'ゴールドランク特典',
-        }
-        if self.RANK_HIERARCHY.get(self.rank, -1) > self.RANK_HIERARCHY.get(old_rank, -1):
-            coupon_title = rank_coupon_map.get(self.rank)
-            if coupon_title:
-                try:
-                    coupon_to_grant = Coupon.objects.get(title=coupon_title)
-                    # 未所持のみ付与
-                    if not self.current_coupons.filter(pk=coupon_to_grant.pk).exists():
-                        self.current_coupons.add(coupon_to_grant)
-                except Coupon.DoesNotExist:
-                    # クーポン不在時無視
-                    pass
-
-        # ポイント達成特典
-        if old_points < 1000 <= self.current_points:
-            try:
-                coupon_to_grant = Coupon.objects.get(title='1000ポイント達成記念')
-                if not self.current_coupons.filter(pk=coupon_to_grant.pk).exists():
-                    self.current_coupons.add(coupon_to_grant)
-            except Coupon.DoesNotExist:
-                pass
+    def grant_point_rewards(self, old_rank, old_points):
+        """ランクアップ・ポイント達成に応じたクーポンを特典ルールに従って付与する"""
+        get_reward_engine().grant([(self.pk, old_points, self.current_points, old_rank)])
 
     class Meta:
         verbose_name = 'ユーザー'
@@ -1,3 +1,45 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
-# テストをここに作成
+from accounts.models import CustomUser
+from core.models import Coupon, RewardRule
+from core.rewards import invalidate_reward_rules
+
+
+class CustomUserSaveTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='saver', email='saver@example.com', password='pass')
+        self.user = CustomUser.objects.get(pk=self.user.pk)
+
+    def test_unrelated_save_is_a_single_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.user.email = 'changed@example.com'
+            self.user.save()
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('UPDATE'))
+
+    def test_update_fields_is_honoured(self):
+        self.user.first_name = 'unsaved'
+        with CaptureQueriesContext(connection) as queries:
+            self.user.save(update_fields=['last_login'])
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('first_name', queries[0]['sql'])
+
+    def test_login_saves_last_login_with_single_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.client.login(username='saver', password='pass'))
+        user_queries = [q['sql'] for q in queries if 'accounts_customuser' in q['sql']]
+        # 認証時のSELECTとlast_loginのUPDATEのみ
+        self.assertEqual(len(user_queries), 2)
+        self.assertTrue(user_queries[1].startswith('UPDATE'))
+
+    def test_point_change_updates_rank_and_grants_reward(self):
+        coupon = Coupon.objects.create(title='ブロンズランク特典', description='特典', type='absolute', discount_value=100)
+        RewardRule.objects.create(kind='rank_reached', rank='sprout', coupon=coupon)
+        self.addCleanup(invalidate_reward_rules)
+        self.user.current_points = 150
+        self.user.save(update_fields=['current_points'])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.rank, 'sprout')
+        self.assertTrue(self.user.current_coupons.filter(pk=coupon.pk).exists())
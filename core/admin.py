@@ -1,7 +1,8 @@
 from django.contrib import admin
 from .models import (
     Store, Receipt, Product, ReceiptItem, Inquiry, 
-    Coupon, CouponUsage, Report, Announcement, EcoProduct
+    Coupon, CouponUsage, Report, Announcement, EcoProduct,
+    PointTransaction, BackgroundJob, RankTier, RewardRule, StoreAlias, UnresolvedStoreHeader
 )
 
 class StoreAdmin(admin.ModelAdmin):
@@ -50,6 +51,57 @@ class EcoProductAdmin(admin.ModelAdmin):
     list_display = ('name', 'points', 'jan_code')
     search_fields = ('name', 'jan_code')
 
+class PointTransactionAdmin(admin.ModelAdmin):
+    list_display = ('user', 'delta', 'reason', 'receipt', 'coupon', 'created_at')
+    list_filter = ('reason', 'created_at')
+    search_fields = ('user__username',)
+
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'status', 'progress', 'total', 'created_at', 'finished_at')
+    list_filter = ('kind', 'status')
+
+class RankTierAdmin(admin.ModelAdmin):
+    list_display = ('code', 'name', 'min_points')
+
+class RewardRuleAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'rank', 'points', 'coupon', 'is_active')
+    list_filter = ('kind', 'is_active')
+
+class StoreAliasAdmin(admin.ModelAdmin):
+    list_display = ('name', 'store', 'source', 'created_at')
+    list_filter = ('source',)
+    search_fields = ('name', 'store__store_name')
+    autocomplete_fields = ('store',)
+
+class UnresolvedStoreHeaderAdmin(admin.ModelAdmin):
+    list_display = ('header', 'tel', 'occurrences', 'status', 'store', 'last_seen')
+    list_filter = ('status',)
+    search_fields = ('header', 'tel')
+    ordering = ('status', '-occurrences')
+    autocomplete_fields = ('store',)
+    readonly_fields = ('occurrences', 'receipts', 'first_seen', 'last_seen')
+    actions = ['create_stores', 'ignore_headers']
+
+    def save_model(self, request, obj, form, change):
+        # 対応する店舗を選んで保存すると、別名として登録し対象のレシートに店舗を設定する
+        super().save_model(request, obj, form, change)
+        if obj.store_id and obj.status == 'pending':
+            from core.services import StoreResolutionService
+            StoreResolutionService.resolve_header(obj, obj.store)
+
+    @admin.action(description='選択したヘッダーを新規店舗として登録')
+    def create_stores(self, request, queryset):
+        from core.services import StoreResolutionService
+        entries = queryset.filter(status='pending')
+        for entry in entries:
+            StoreResolutionService.create_store(entry)
+        self.message_user(request, f'{len(entries)} 件の店舗を登録しました。')
+
+    @admin.action(description='選択したヘッダーを対象外にする')
+    def ignore_headers(self, request, queryset):
+        updated = queryset.filter(status='pending').update(status='ignored')
+        self.message_user(request, f'{updated} 件を対象外にしました。')
+
 admin.site.register(Store, StoreAdmin)
 admin.site.register(Receipt, ReceiptAdmin)
 admin.site.register(Product, ProductAdmin)
@@ -60,3 +112,9 @@ admin.site.register(CouponUsage, CouponUsageAdmin)
 admin.site.register(Report, ReportAdmin)
 admin.site.register(Announcement, AnnouncementAdmin)
 admin.site.register(EcoProduct, EcoProductAdmin)
+admin.site.register(PointTransaction, PointTransactionAdmin)
+admin.site.register(BackgroundJob, BackgroundJobAdmin)
+admin.site.register(RankTier, RankTierAdmin)
+admin.site.register(RewardRule, RewardRuleAdmin)
+admin.site.register(StoreAlias, StoreAliasAdmin)
+admin.site.register(UnresolvedStoreHeader, UnresolvedStoreHeaderAdmin)
@@ -0,0 +1,156 @@
+"""
+AIレポートの生成（プロンプトの組み立てと生成モデルの呼び出し）。
+モデルに依存しないため、ジョブやコマンドから読み込める。
+生成モデルへの問い合わせは ReportClientPool で同時実行数と1分あたりのリクエスト数を制限し、
+一時的な失敗は指数バックオフで再試行する。
+"""
+import asyncio
+import hashlib
+import random
+import time
+
+from django.conf import settings
+
+
+class ReportGenerationError(Exception):
+    """生成モデルへの問い合わせが失敗した場合に送出する例外"""
+
+
+def build_prompt(score, total_quantity, eco_quantity, eco_points, products, eco_products):
+    """月間の購入状況からレポート生成用のプロンプトを組み立てる"""
+    return f"""
+    あなたは環境保護のエキスパートです。
+    ユーザーの今月のエコスコアは【{score}点】です。
+    （購入商品数: {total_quantity}点、うちエコ商品: {eco_quantity}点、獲得エコポイント: {eco_points}点）
+
+    以下の購入商品リストとエコ商品データベースを参考に、
+    ユーザーに向けて**100文字程度**で簡潔なアドバイス付きレポートを作成してください。
+    JSONではなく、テキストのみで出力してください。
+
+    ※購入商品リストはレシートOCRの結果であり、省略や誤字が含まれる可能性があります。
+    文脈から正式な商品名を推測し、どのような商品を購入したかを理解した上でアドバイスを行ってください。
+
+    # 購入商品リスト:
+    \"\"\"
+    {', '.join(products)}
+    \"\"\"
+
+    # エコ商品データベース:
+    \"\"\"
+    {', '.join(eco_products)}
+    \"\"\"
+    """
+
+
+class GeminiReportModel:
+    name = 'gemini'
+
+    def __init__(self):
+        import google.generativeai as genai
+        genai.configure(api_key=settings.GEMINI_API_KEY)
+        self.model = genai.GenerativeModel(settings.AI_REPORT_MODEL_NAME)
+
+    async def generate(self, prompt):
+        try:
+            response = await self.model.generate_content_async(prompt)
+            return response.text.strip()
+        except Exception as e:
+            raise ReportGenerationError(str(e)) from e
+
+
+class StubReportModel:
+    """外部サービスに接続しないテスト用のモデル。プロンプトのハッシュから決まった文章を返す"""
+    name = 'stub'
+
+    async def generate(self, prompt):
+        digest = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:8]
+        return f'エコな買い物を続けましょう。（スタブ {digest}）'
+
+
+MODELS = {
+    GeminiReportModel.name: GeminiReportModel,
+    StubReportModel.name: StubReportModel,
+}
+
+
+def get_report_model():
+    """AI_REPORT_MODEL で指定した生成モデルを返す"""
+    return MODELS[settings.AI_REPORT_MODEL]()
+
+
+class RequestRateLimiter:
+    """
+    1分あたりのリクエスト数を制限する（リクエストを等間隔に並べる）。0以下・Noneは制限しない。
+    次に送信できる時刻は複数回の generate_all をまたいで保持する。
+    """
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute and requests_per_minute > 0 else 0.0
+        self.next_at = 0.0
+
+    async def acquire(self, lock):
+        if not self.interval:
+            return
+        async with lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class ReportClientPool:
+    """
+    生成モデルへの問い合わせを、同時実行数 (concurrency) と1分あたりのリクエスト数の上限内で並列に行う。
+    ReportGenerationError は max_retries 回まで、backoff秒を起点とした指数バックオフで再試行する。
+    生成モデルの非同期クライアントは最初に使用したイベントループに結び付くため、
+    イベントループはプールごとに1つを使い続け、close（またはwithブロックの終了）で閉じる。
+    """
+
+    def __init__(self, model=None, concurrency=None, requests_per_minute=None, max_retries=None, backoff=None):
+        self.model = model or get_report_model()
+        self.concurrency = max(concurrency or settings.AI_REPORT_CONCURRENCY, 1)
+        self.limiter = RequestRateLimiter(
+            requests_per_minute if requests_per_minute is not None else settings.AI_REPORT_REQUESTS_PER_MINUTE)
+        self.max_retries = max_retries if max_retries is not None else settings.AI_REPORT_MAX_RETRIES
+        self.backoff = backoff if backoff is not None else settings.AI_REPORT_RETRY_BACKOFF_SECONDS
+        self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """プールのイベントループを閉じる"""
+        if self._loop is not None:
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+            self._loop = None
+
+    async def _generate(self, prompt, semaphore, lock):
+        for attempt in range(self.max_retries + 1):
+            async with semaphore:
+                await self.limiter.acquire(lock)
+                try:
+                    return await self.model.generate(prompt)
+                except ReportGenerationError:
+                    if attempt == self.max_retries:
+                        raise
+            # 再試行が同時に集中しないよう、待ち時間に揺らぎを加える
+            await asyncio.sleep(self.backoff * (2 ** attempt) * random.uniform(1.0, 1.5))
+
+    async def _generate_all(self, prompts):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        lock = asyncio.Lock()
+        return await asyncio.gather(
+            *(self._generate(prompt, semaphore, lock) for prompt in prompts), return_exceptions=True)
+
+    def generate_all(self, prompts):
+        """プロンプトのリストを並列に生成し、同じ順で 文章 または 例外 のリストを返す"""
+        if not prompts:
+            return []
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self._generate_all(list(prompts)))
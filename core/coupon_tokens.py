@@ -0,0 +1,82 @@
+"""
+店舗端末でオフライン検証できる署名付きクーポントークン。
+
+トークンは `<ペイロード>.<署名>` の形式で、どちらもパディングなしのbase64url。
+ペイロードは ASCII の `v1:<ユーザーID>:<クーポンID>:<有効期限(UNIX秒)>:<ノンス>`、
+署名はペイロードに対する共有鍵の HMAC-SHA256 の先頭16バイト。
+店舗端末は共有鍵だけで署名と有効期限を検証でき、サーバーへの問い合わせは不要。
+ノンスは利用報告時の冪等キーとなり、同じトークンの再利用はサーバー側で拒否される。
+"""
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+from typing import NamedTuple
+
+TOKEN_VERSION = 'v1'
+SIGNATURE_BYTES = 16
+NONCE_BYTES = 12
+
+
+class CouponTokenError(Exception):
+    """トークンが不正・期限切れの場合に送出する例外。codeに理由を持つ"""
+
+    def __init__(self, code):
+        self.code = code
+        super().__init__(code)
+
+
+class CouponToken(NamedTuple):
+    user_id: int
+    coupon_id: int
+    expires_at: int
+    nonce: str
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(payload, key):
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hmac.new(key, payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def issue_token(user_id, coupon_id, key, ttl, now=None, nonce=None):
+    """ユーザー・クーポン・有効期限・ノンスに署名したトークンを返す"""
+    expires_at = int(now if now is not None else time.time()) + int(ttl)
+    nonce = nonce or _b64encode(secrets.token_bytes(NONCE_BYTES))
+    payload = f'{TOKEN_VERSION}:{int(user_id)}:{int(coupon_id)}:{expires_at}:{nonce}'.encode('ascii')
+    return f'{_b64encode(payload)}.{_b64encode(_sign(payload, key))}'
+
+
+def verify_token(token, key, now=None, leeway=0):
+    """
+    トークンの署名と有効期限を検証し、CouponToken を返す。
+    leeway秒までは期限切れも受け付ける（店舗で検証済みのトークンを後から報告する場合など）。
+    """
+    try:
+        payload_text, signature_text = token.split('.')
+        payload = _b64decode(payload_text)
+        signature = _b64decode(signature_text)
+    except (AttributeError, ValueError):
+        raise CouponTokenError('malformed')
+    if not hmac.compare_digest(signature, _sign(payload, key)):
+        raise CouponTokenError('bad_signature')
+
+    try:
+        version, user_id, coupon_id, expires_at, nonce = payload.decode('ascii').split(':')
+        claims = CouponToken(int(user_id), int(coupon_id), int(expires_at), nonce)
+    except ValueError:
+        raise CouponTokenError('malformed')
+    if version != TOKEN_VERSION or not nonce:
+        raise CouponTokenError('malformed')
+    if claims.expires_at + leeway < (now if now is not None else time.time()):
+        raise CouponTokenError('expired')
+    return claims
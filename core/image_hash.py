@@ -0,0 +1,51 @@
+"""
+レシート画像の知覚ハッシュ (dHash)。
+モデルに依存しないため、バックフィルのワーカープロセスからも読み込める。
+"""
+import cv2
+import numpy as np
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+
+def compute_dhash(image):
+    """
+    画像（OpenCVのBGRまたはグレースケール配列）の64ビットdHashを返す。
+    9x8に縮小したグレースケール画像で隣接ピクセルの明暗を比較するため、
+    撮り直しによる明るさ・縮尺の違いではほとんど変化しない。
+    BigIntegerFieldに収まるよう符号付き整数で返す。
+    """
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    resized = cv2.resize(image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (resized[:, 1:] > resized[:, :-1]).flatten()
+    value = int(np.packbits(bits).view('>u8')[0])
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def compute_image_hash(image_bytes):
+    """画像ファイルのバイト列からdHashを計算する。デコードできない場合はNoneを返す"""
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    return compute_dhash(image)
+
+
+def hamming_distance(a, b):
+    """2つのハッシュの異なるビット数を返す"""
+    return bin((a ^ b) & _HASH_MASK).count('1')
+
+
+def hash_image_files(rows):
+    """(レシートID, ファイルパス) のリストを受け取り、[(レシートID, ハッシュ)] を返す（プロセスプール用）"""
+    results = []
+    for receipt_id, path in rows:
+        try:
+            with open(path, 'rb') as f:
+                image_hash = compute_image_hash(f.read())
+        except OSError:
+            image_hash = None
+        results.append((receipt_id, image_hash))
+    return results
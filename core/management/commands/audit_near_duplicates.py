@@ -0,0 +1,72 @@
+import csv
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.models import Receipt
+from core.services import ReceiptService
+
+
+class Command(BaseCommand):
+    help = '撮り直しなどで重複登録されたレシートのクラスタを全レシートから検出します（データは変更しません）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--similarity', type=float, default=settings.RECEIPT_NEAR_DUPLICATE_SIMILARITY,
+                            help='同一とみなす文字シングルの類似度 (0〜1)')
+        parser.add_argument('--same-user', action='store_true', help='同じユーザーのレシート同士のみを対象とする')
+        parser.add_argument('--max-bucket', type=int, default=200, help='1つのバンド値で比較するレシート数の上限')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='1回に読み込むレシート数')
+        parser.add_argument('--limit', type=int, default=20, help='表示するクラスタ数')
+        parser.add_argument('--output', help='全クラスタをCSVに書き出すパス')
+
+    def handle(self, *args, **options):
+        clusters, stats = ReceiptService.find_near_duplicate_clusters(
+            min_similarity=options['similarity'],
+            same_user=options['same_user'],
+            max_bucket=options['max_bucket'],
+            chunk_size=options['chunk_size'],
+        )
+        self.stdout.write(
+            f'{stats["scanned"]} 件を走査 / 候補ペア {stats["candidate_pairs"]} 件 / '
+            f'類似度確認済み {stats["confirmed_pairs"]} 件'
+        )
+        if stats['truncated_buckets']:
+            self.stdout.write(self.style.WARNING(
+                f'{stats["truncated_buckets"]} 個のバンド値で比較件数が上限 ({options["max_bucket"]}) に達しました。'))
+        if not clusters:
+            self.stdout.write(self.style.SUCCESS('重複の疑いがあるレシートは見つかりませんでした。'))
+            return
+
+        receipts = {}
+        all_ids = [receipt_id for cluster in clusters for receipt_id in cluster]
+        for start in range(0, len(all_ids), options['chunk_size']):
+            chunk = all_ids[start:start + options['chunk_size']]
+            for row in Receipt.objects.filter(pk__in=chunk).values(
+                    'pk', 'user__username', 'store__store_name', 'transaction_time', 'scanned_at', 'points_earned'):
+                receipts[row['pk']] = row
+
+        # 各クラスタの最初の1件を正規の登録とみなし、それ以外を重複として集計する
+        duplicate_count = sum(len(cluster) - 1 for cluster in clusters)
+        duplicate_points = sum(receipts[receipt_id]['points_earned'] for cluster in clusters for receipt_id in cluster[1:])
+
+        for number, cluster in enumerate(clusters[:options['limit']], start=1):
+            self.stdout.write(f'--- クラスタ {number} ({len(cluster)} 件) ---')
+            for receipt_id in cluster:
+                row = receipts[receipt_id]
+                self.stdout.write(
+                    f'  #{receipt_id} {row["user__username"]} / {row["store__store_name"] or "店舗不明"} / '
+                    f'取引 {row["transaction_time"] or "-"} / スキャン {row["scanned_at"]} / {row["points_earned"]}pt'
+                )
+
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['cluster', 'receipt_id', 'username', 'store', 'transaction_time', 'scanned_at', 'points_earned'])
+                for number, cluster in enumerate(clusters, start=1):
+                    for receipt_id in cluster:
+                        row = receipts[receipt_id]
+                        writer.writerow([number, receipt_id, row['user__username'], row['store__store_name'] or '',
+                                         row['transaction_time'] or '', row['scanned_at'], row['points_earned']])
+            self.stdout.write(f'{options["output"]} に書き出しました。')
+
+        self.stdout.write(self.style.WARNING(
+            f'{len(clusters)} クラスタ / 重複の疑い {duplicate_count} 件 / 重複による獲得ポイント {duplicate_points}pt'))
@@ -0,0 +1,76 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from core.image_hash import hash_image_files
+from core.models import Receipt
+
+
+class Command(BaseCommand):
+    help = 'MEDIA_ROOT/receipts に保存済みのレシート画像から画像ハッシュを並列に計算して保存します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='ハッシュ計算を並列実行するプロセス数')
+        parser.add_argument('--chunk-size', type=int, default=200, help='1チャンクあたりのレシート数')
+
+    def _image_path(self, image_url):
+        """image_urlをMEDIA_ROOT/receipts配下のファイルパスに変換する（対象外の場合はNone）"""
+        if not image_url or not image_url.startswith(settings.MEDIA_URL):
+            return None
+        relative = image_url[len(settings.MEDIA_URL):]
+        if not relative.startswith('receipts/'):
+            return None
+        return os.path.join(settings.MEDIA_ROOT, relative)
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        chunk_size = options['chunk_size']
+        started = time.perf_counter()
+        hashed = missing = 0
+        last_id = 0
+
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while True:
+                # ワーカー数分のチャンクをまとめて読み出し、並列に計算する
+                chunks = []
+                for _ in range(workers):
+                    rows = list(
+                        Receipt.objects.filter(image_hash__isnull=True, pk__gt=last_id)
+                        .order_by('pk').values_list('pk', 'image_url')[:chunk_size]
+                    )
+                    if not rows:
+                        break
+                    last_id = rows[-1][0]
+                    chunk = []
+                    for receipt_id, image_url in rows:
+                        path = self._image_path(image_url)
+                        if path and os.path.exists(path):
+                            chunk.append((receipt_id, path))
+                        else:
+                            missing += 1
+                    chunks.append(chunk)
+                if not chunks:
+                    break
+
+                results = executor.map(hash_image_files, chunks) if executor else map(hash_image_files, chunks)
+                updates = []
+                for chunk_result in results:
+                    for receipt_id, image_hash in chunk_result:
+                        if image_hash is None:
+                            missing += 1
+                            continue
+                        updates.append(Receipt(pk=receipt_id, image_hash=image_hash))
+                Receipt.objects.bulk_update(updates, ['image_hash'], batch_size=chunk_size)
+                hashed += len(updates)
+                self.stdout.write(f'{hashed} 件のハッシュを保存しました (レシートID {last_id} まで)')
+        finally:
+            if executor:
+                executor.shutdown()
+
+        elapsed = time.perf_counter() - started
+        if missing:
+            self.stdout.write(self.style.WARNING(f'画像が見つからない、または読み込めないレシート: {missing} 件'))
+        self.stdout.write(self.style.SUCCESS(f'完了: {hashed} 件 / {elapsed:.1f}秒 ({workers} プロセス)'))
@@ -0,0 +1,114 @@
+import csv
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from core.models import EcoProduct
+from core.matching import EcoProductMatcher, normalize_product_name
+
+
+class Command(BaseCommand):
+    help = 'エコ商品照合の処理時間と再現率を計測します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sample', help='ラベル付きサンプルCSV (1列目: レシート上の商品名, 2列目: 正解のエコ商品名。非エコ商品は空欄)')
+        parser.add_argument('--size', type=int, default=1000, help='サンプル未指定時に生成する件数')
+        parser.add_argument('--seed', type=int, default=0, help='サンプル生成の乱数シード')
+        parser.add_argument('--threshold', type=float, default=None, help='類似度の閾値 (省略時は設定値)')
+
+    def handle(self, *args, **options):
+        eco_products = list(EcoProduct.objects.filter(status='approved').order_by('pk'))
+        if not eco_products:
+            raise CommandError('承認済みのエコ商品がありません。')
+
+        if options['sample']:
+            sample = self._load_sample(options['sample'], eco_products)
+        else:
+            sample = self._generate_sample(eco_products, options['size'], random.Random(options['seed']))
+
+        build_started = time.perf_counter()
+        matcher = EcoProductMatcher(eco_products, threshold=options['threshold'])
+        build_ms = (time.perf_counter() - build_started) * 1000
+        self.stdout.write(f'カタログ {len(matcher)} 件 / サンプル {len(sample)} 件 / インデックス構築 {build_ms:.1f}ms')
+
+        self._report('部分一致のみ (従来)', sample, lambda name, store_id: self._substring_match(eco_products, name, store_id))
+        self._report('n-gram + 類似度', sample, matcher.match)
+
+    def _substring_match(self, eco_products, name, store_id):
+        """従来のscanビューと同じ全件走査"""
+        normalized = normalize_product_name(name)
+        for eco_product in eco_products:
+            if normalize_product_name(eco_product.name) in normalized:
+                # 店舗不明のレシートには共通商品のみ付与する
+                if eco_product.is_common or (store_id is not None and eco_product.store_id == store_id):
+                    return eco_product, 1.0
+        return None, 0.0
+
+    def _report(self, label, sample, match):
+        latencies = []
+        hits = misses = false_positives = negatives = 0
+        for name, expected in sample:
+            store_id = expected.store_id if expected else None
+            started = time.perf_counter()
+            found, _score = match(name, store_id)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if expected is None:
+                negatives += 1
+                if found is not None:
+                    false_positives += 1
+            elif found is not None and found.pk == expected.pk:
+                hits += 1
+            else:
+                misses += 1
+
+        positives = hits + misses
+        recall = hits / positives * 100 if positives else 0
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(self.style.SUCCESS(
+            f'[{label}] 再現率 {recall:.1f}% ({hits}/{positives}) / 誤検出 {false_positives}/{negatives} / '
+            f'平均 {statistics.mean(latencies):.3f}ms / p95 {p95:.3f}ms'
+        ))
+
+    def _load_sample(self, path, eco_products):
+        by_name = {eco_product.name: eco_product for eco_product in eco_products}
+        sample = []
+        try:
+            with open(path, encoding='utf-8-sig') as f:
+                for row in csv.reader(f):
+                    if not row or not row[0].strip():
+                        continue
+                    expected_name = row[1].strip() if len(row) > 1 else ''
+                    if expected_name and expected_name not in by_name:
+                        self.stdout.write(self.style.WARNING(f'カタログにないエコ商品名をスキップ: {expected_name}'))
+                        continue
+                    sample.append((row[0].strip(), by_name.get(expected_name)))
+        except FileNotFoundError:
+            raise CommandError(f'{path} が見つかりません。')
+        return sample
+
+    def _generate_sample(self, eco_products, size, rng):
+        """カタログ名にOCR風の誤り（脱落・置換・入れ替え）を加えたサンプルを生成する"""
+        alphabet = ''.join({ch for eco_product in eco_products for ch in eco_product.name}) or 'ア'
+        sample = []
+        for i in range(size):
+            if i % 5 == 4:
+                # 非エコ商品（誤検出の確認用）
+                noise = ''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 10)))
+                sample.append((f'{noise}{rng.randint(1, 999)}', None))
+                continue
+            eco_product = rng.choice(eco_products)
+            chars = list(eco_product.name)
+            if len(chars) >= 5:
+                position = rng.randrange(len(chars))
+                operation = rng.choice(['drop', 'replace', 'swap', 'none'])
+                if operation == 'drop':
+                    del chars[position]
+                elif operation == 'replace':
+                    chars[position] = rng.choice(alphabet)
+                elif operation == 'swap' and position + 1 < len(chars):
+                    chars[position], chars[position + 1] = chars[position + 1], chars[position]
+            sample.append((f'{rng.choice(["", "特選", "新"])}{"".join(chars)} {rng.randint(1, 9)}個', eco_product))
+        return sample
@@ -0,0 +1,93 @@
+import random
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.db.models import Count
+from accounts.models import CustomUser
+from core.models import Coupon, CouponUsage
+from core.services import CouponRedemptionError, CouponRedemptionService
+
+
+class Command(BaseCommand):
+    help = '合成ユーザーのクーポンを複数スレッドから同時に利用し、二重利用が起きないことと処理件数を計測します（データは最後に削除されます）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500, help='クーポンを所持する合成ユーザー数')
+        parser.add_argument('--threads', type=int, default=8, help='同時に利用を送信するスレッド（POS端末）数')
+        parser.add_argument('--taps', type=int, default=3, help='1件の利用を送信する回数（二重タップ・再送）')
+        parser.add_argument('--seed', type=int, default=0, help='送信順の乱数シード')
+
+    def handle(self, *args, **options):
+        prefix = f'bench_redeem_{uuid.uuid4().hex[:8]}_'
+        coupon = Coupon.objects.create(
+            title='負荷試験用', description='負荷試験用', type='absolute', discount_value=1, status='approved')
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f'{prefix}{i}', email=f'{prefix}{i}@example.invalid', password='!')
+            for i in range(options['users'])
+        ])
+        users = list(CustomUser.objects.filter(username__startswith=prefix).values_list('pk', flat=True))
+        Through = CustomUser.current_coupons.through
+        Through.objects.bulk_create([Through(customuser_id=user_id, coupon_id=coupon.pk) for user_id in users])
+
+        # 半数は冪等キー付きの再送、残りはキーなしの二重タップとして送信する
+        requests = []
+        for i, user_id in enumerate(users):
+            key = f'{prefix}{user_id}' if i % 2 == 0 else None
+            requests.extend([(user_id, key)] * options['taps'])
+        random.Random(options['seed']).shuffle(requests)
+
+        counts = {'redeemed': 0, 'replayed': 0, 'rejected': 0, 'retried': 0}
+        lock = threading.Lock()
+        queue = iter(requests)
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        request = next(queue, None)
+                    if request is None:
+                        return
+                    user_id, key = request
+                    for attempt in range(20):
+                        try:
+                            _usage, replayed = CouponRedemptionService.redeem(user_id, coupon.pk, idempotency_key=key)
+                            outcome = 'replayed' if replayed else 'redeemed'
+                        except CouponRedemptionError:
+                            outcome = 'rejected'
+                        except OperationalError:
+                            # sqlite の書き込みロック競合は端末側の再送として扱う
+                            with lock:
+                                counts['retried'] += 1
+                            time.sleep(0.01 * (attempt + 1))
+                            continue
+                        break
+                    with lock:
+                        counts[outcome] += 1
+            finally:
+                connections.close_all()
+
+        try:
+            started = time.perf_counter()
+            threads = [threading.Thread(target=worker) for _ in range(options['threads'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+
+            doubles = CouponUsage.objects.filter(coupon=coupon).values('user').annotate(
+                count=Count('pk')).filter(count__gt=1).count()
+            self.stdout.write(
+                f'{len(requests)} 件の送信を {options["threads"]} スレッドで {elapsed:.2f}秒 '
+                f'({len(requests) / elapsed:.0f} 件/秒): 利用 {counts["redeemed"]} / 再送応答 {counts["replayed"]} / '
+                f'拒否 {counts["rejected"]} / ロック再試行 {counts["retried"]}')
+            if doubles or counts['redeemed'] != len(users):
+                self.stdout.write(self.style.ERROR(f'二重利用 {doubles} 人 / 利用 {counts["redeemed"]} 件 (期待値 {len(users)})'))
+            else:
+                self.stdout.write(self.style.SUCCESS('二重利用はありませんでした。'))
+        finally:
+            CustomUser.objects.filter(username__startswith=prefix).delete()
+            coupon.delete()
@@ -0,0 +1,69 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from accounts.models import CustomUser
+from core.services import MonthlyRolloverService
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '合成ユーザーを作成して月次リセットの処理時間を計測します（データはロールバックされます）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000, help='作成する合成ユーザー数')
+        parser.add_argument('--sample', type=int, default=1000, help='従来方式 (1人ずつsave) で計測するユーザー数')
+        parser.add_argument('--seed', type=int, default=0, help='ポイント生成の乱数シード')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        month_start = MonthlyRolloverService.month_start()
+        last_month = (month_start - timedelta(days=1)).replace(day=1)
+
+        try:
+            with transaction.atomic():
+                started = time.perf_counter()
+                batch = []
+                for i in range(options['users']):
+                    batch.append(CustomUser(
+                        username=f'bench_rollover_{i}', email=f'bench_rollover_{i}@example.invalid',
+                        password='!', current_points=rng.choice([0, 0, rng.randint(1, 1200)]),
+                        last_reset_month=last_month,
+                    ))
+                    if len(batch) >= 5000:
+                        CustomUser.objects.bulk_create(batch)
+                        batch = []
+                CustomUser.objects.bulk_create(batch)
+                self.stdout.write(f'合成ユーザー {options["users"]} 人を作成 ({time.perf_counter() - started:.1f}秒)')
+
+                # 従来方式: 1人ずつ残高を0にしてsave
+                sample = list(CustomUser.objects.filter(username__startswith='bench_rollover_')[:options['sample']])
+                started = time.perf_counter()
+                for user in sample:
+                    user.current_points = 0
+                    user.last_reset_month = month_start
+                    user.save()
+                legacy = time.perf_counter() - started
+                CustomUser.objects.filter(pk__in=[user.pk for user in sample]).update(last_reset_month=last_month)
+                estimated = legacy / max(len(sample), 1) * options['users']
+                self.stdout.write(
+                    f'[従来方式] {len(sample)} 人で {legacy:.2f}秒 → {options["users"]} 人換算 {estimated:.0f}秒')
+
+                started = time.perf_counter()
+                counts = MonthlyRolloverService.rollover(month_start)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(self.style.SUCCESS(
+                    f'[一括方式] {counts["reset"]} 人をリセット: {elapsed:.2f}秒'))
+
+                started = time.perf_counter()
+                counts = MonthlyRolloverService.rollover(month_start)
+                self.stdout.write(self.style.SUCCESS(
+                    f'[再実行] {counts["reset"]} 人をリセット: {time.perf_counter() - started:.2f}秒'))
+                raise _Rollback
+        except _Rollback:
+            self.stdout.write('合成データをロールバックしました。')
@@ -0,0 +1,89 @@
+import math
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
+from core.models import Store
+from core.store_index import EARTH_RADIUS_KM, STORE_FIELDS, StoreIndex
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = '合成店舗で近い店舗の検索（NumPyインデックスとORM）の処理時間を比較します（データはロールバックされます）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stores', type=int, default=20000, help='作成する合成店舗数')
+        parser.add_argument('--queries', type=int, default=200, help='検索回数')
+        parser.add_argument('--k', type=int, default=10, help='取得件数')
+        parser.add_argument('--radius', type=float, default=5.0, help='検索半径 (km)')
+        parser.add_argument('--seed', type=int, default=0, help='店舗位置・検索地点の乱数シード')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        # 首都圏・関西圏に偏らせた合成店舗
+        centers = [(35.68, 139.76, 0.6), (34.69, 135.50, 0.4), (35.17, 136.90, 0.3), (43.06, 141.35, 0.2)]
+
+        def random_point():
+            lat, lng, spread = rng.choice(centers)
+            return lat + rng.gauss(0, spread / 3), lng + rng.gauss(0, spread / 3)
+
+        points = [random_point() for _ in range(options['queries'])]
+        k, radius_km = options['k'], options['radius']
+
+        try:
+            with transaction.atomic():
+                Store.objects.bulk_create([
+                    Store(store_name=f'bench_store_{i}', category='retail', address='-', lat=lat, lng=lng)
+                    for i, (lat, lng) in enumerate(random_point() for _ in range(options['stores']))
+                ], batch_size=2000)
+
+                started = time.perf_counter()
+                index = StoreIndex(Store.objects.order_by('pk').values_list(*STORE_FIELDS))
+                self.stdout.write(f'店舗 {len(index)} 件 / インデックス構築 {(time.perf_counter() - started) * 1000:.0f}ms')
+
+                index_results = self._measure('NumPyインデックス', points, lambda lat, lng: [
+                    store['id'] for store, _distance in index.nearest(lat, lng, k=k, radius_km=radius_km)])
+                orm_results = self._measure('ORM', points, lambda lat, lng: self._orm_nearest(lat, lng, k, radius_km))
+
+                agree = sum(1 for a, b in zip(index_results, orm_results) if a == b)
+                self.stdout.write(f'検索結果の一致: {agree}/{len(points)}')
+                raise _Rollback
+        except _Rollback:
+            self.stdout.write('合成データをロールバックしました。')
+
+    def _orm_nearest(self, lat, lng, k, radius_km):
+        """緯度経度の範囲で絞り込み、ハバーサイン距離をSQLで計算して並べ替える"""
+        lat_delta = radius_km / 111.32
+        lng_delta = radius_km / (111.32 * math.cos(math.radians(lat)))
+        lat_rad, lng_rad = math.radians(lat), math.radians(lng)
+        haversine = (
+            Power(Sin((Radians(F('lat')) - lat_rad) / 2), 2)
+            + math.cos(lat_rad) * Cos(Radians(F('lat'))) * Power(Sin((Radians(F('lng')) - lng_rad) / 2), 2)
+        )
+        distance = 2 * EARTH_RADIUS_KM * ASin(Sqrt(haversine))
+        return list(
+            Store.objects.filter(
+                lat__range=(lat - lat_delta, lat + lat_delta), lng__range=(lng - lng_delta, lng + lng_delta),
+            ).annotate(distance=distance).filter(distance__lte=radius_km)
+            .order_by('distance', 'pk').values_list('pk', flat=True)[:k]
+        )
+
+    def _measure(self, label, points, search):
+        results, latencies = [], []
+        for lat, lng in points:
+            started = time.perf_counter()
+            results.append(search(lat, lng))
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(self.style.SUCCESS(
+            f'[{label}] 平均 {statistics.mean(latencies):.3f}ms / p95 {p95:.3f}ms / '
+            f'平均件数 {statistics.mean(len(result) for result in results):.1f}'))
+        return results
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from core.services import AIReportService, BackgroundJobService
+
+
+class Command(BaseCommand):
+    help = '対象月にレシートを読み取った利用者のAIレポートを一括で生成します（月末の定期実行用）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, help='対象年（省略時は今月）')
+        parser.add_argument('--month', type=int, help='対象月（省略時は今月）')
+        parser.add_argument('--requests-per-minute', type=int, default=settings.AI_REPORT_REQUESTS_PER_MINUTE,
+                            help='生成モデルへの1分あたりのリクエスト数の上限 (0は制限なし)')
+        parser.add_argument('--batch-size', type=int, default=settings.AI_REPORT_BATCH_SIZE, help='1バッチのユーザー数')
+        parser.add_argument('--enqueue', action='store_true', help='実行せずバックグラウンドジョブとして登録のみ行う')
+        parser.add_argument('--resume', action='store_true', help='中断した直近の一括生成ジョブを続きから実行する')
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        year = options['year'] or today.year
+        month = options['month'] or today.month
+        if not 1 <= month <= 12:
+            raise CommandError('--month は1〜12で指定してください。')
+        params = {
+            'year': year,
+            'month': month,
+            'requests_per_minute': options['requests_per_minute'],
+            'batch_size': options['batch_size'],
+        }
+
+        if options['resume']:
+            job = BackgroundJobService.resumable(AIReportService.MONTHLY_JOB_KIND)
+            if job is None:
+                raise CommandError('再開できる一括生成ジョブがありません。')
+            job.params.update(requests_per_minute=params['requests_per_minute'], batch_size=params['batch_size'])
+            job.save(update_fields=['params', 'updated_at'])
+            BackgroundJobService.requeue(job)
+            self.stdout.write(f'ジョブ #{job.pk} をユーザーID {job.checkpoint.get("last_user_id", 0)} の次から再開します。')
+        else:
+            job = BackgroundJobService.enqueue(AIReportService.MONTHLY_JOB_KIND, params=params, coalesce=True)
+
+        if options['enqueue']:
+            self.stdout.write(self.style.SUCCESS(f'一括生成ジョブ #{job.pk} を登録しました。run_jobs で実行されます。'))
+            return
+
+        job = BackgroundJobService.claim(job_id=job.pk)
+        if job is None:
+            raise CommandError('ジョブは既に他のワーカーで実行中です。')
+        job = BackgroundJobService.execute(job, stdout=self.stdout)
+        if job.status != 'completed':
+            raise CommandError(f'一括生成に失敗しました。--resume で続きから再開できます: {job.error}')
+        result = job.result
+        self.stdout.write(self.style.SUCCESS(
+            f'{job.params["year"]}年{job.params["month"]}月のレポート: 生成 {result["generated"]} 件 / '
+            f'購入履歴なし {result["empty"]} 件 / 失敗 {result["failed"]} 件'))
+        if result['failed']:
+            self.stdout.write(self.style.WARNING('失敗したユーザーは再実行すると生成し直します。'))
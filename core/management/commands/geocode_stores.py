@@ -1,91 +1,54 @@
-
-from django.core.management.base import BaseCommand
-from core.models import Store
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
 import time
+
 from django.conf import settings
-import googlemaps
+from django.core.management.base import BaseCommand, CommandError
+from core.services import BackgroundJobService, GeocodingService
 
 
 class Command(BaseCommand):
-    help = '緯度経度がない店舗住所をジオコーディングします。'
-
-    def handle(self, *args, **options):
-        geolocator = Nominatim(user_agent="GreenRecipt_Geocoder")
-        stores = Store.objects.filter(lat=0.0, lng=0.0).exclude(address__isnull=True).exclude(address__exact='')
-
-        self.stdout.write(self.style.SUCCESS(f'{stores.count()} 件の店舗を対象とします。'))
+    help = '緯度経度がない店舗住所をジオコーディングします（ジオコーディングのキャッシュを優先して使用します）。'
 
-        google_maps_calls_made = 0
-        google_maps_limit = settings.GOOGLE_MAPS_GEOCODING_LIMIT_PER_RUN
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.GEOCODING_BATCH_SIZE, help='1バッチあたりの店舗数')
+        parser.add_argument('--workers', type=int, default=settings.GEOCODING_WORKERS, help='並列に問い合わせるスレッド数')
+        parser.add_argument('--enqueue', action='store_true', help='実行せずバックグラウンドジョブとして登録のみ行う')
+        parser.add_argument('--resume', action='store_true', help='中断した直近のジオコーディングジョブを続きから実行する')
 
-        for store in stores:
-            if store.address:
-                geolocated = False
-                # Nominatimを最初に試行
-                try:
-                    encoded_address = store.address.encode('utf-8').decode('utf-8')
-                    location = geolocator.geocode(encoded_address, timeout=10, language='ja')
-                    if location:
-                        store.lat = location.latitude
-                        store.lng = location.longitude
-                        geolocated = True
-                        try:
-                            self.stdout.write(self.style.SUCCESS(f'Nominatim成功 {store.store_name}: {store.address} -> ({store.lat}, {store.lng})'))
-                        except UnicodeEncodeError:
-                            self.stdout.write(self.style.SUCCESS(f'Nominatim成功 (文字コード問題): ({store.lat}, {store.lng})'))
-                    else:
-                        try:
-                            self.stdout.write(self.style.WARNING(f'Nominatim失敗 {store.store_name}: {store.address}'))
-                        except UnicodeEncodeError:
-                            self.stdout.write(self.style.WARNING(f'Nominatim失敗 (文字コード問題)'))
-                except (GeocoderTimedOut, GeocoderServiceError, Exception) as e:
-                    try:
-                        self.stdout.write(self.style.ERROR(f'Nominatimエラー {store.store_name}: {store.address} - {e}'))
-                    except UnicodeEncodeError:
-                        self.stdout.write(self.style.ERROR(f'Nominatimエラー (文字コード問題) - {e}'))
-                time.sleep(1) # 負荷軽減
-
-                # If Nominatim failed, and Google Maps geocoding is enabled and within limit, try Google Maps
-                if not geolocated and settings.GOOGLE_MAPS_GEOCODING_ENABLED and settings.GOOGLE_MAPS_API_KEY and settings.GOOGLE_MAPS_API_KEY != 'YOUR_GOOGLE_MAPS_API_KEY':
-                    if google_maps_calls_made < google_maps_limit:
-                        try:
-                            gmaps = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY)
-                            geocode_result = gmaps.geocode(store.address, language='ja')
-                            google_maps_calls_made += 1
-                            if geocode_result:
-                                store.lat = geocode_result[0]['geometry']['location']['lat']
-                                store.lng = geocode_result[0]['geometry']['location']['lng']
-                                geolocated = True
-                                try:
-                                    self.stdout.write(self.style.SUCCESS(f'Google Maps geocoded store {store.store_name}: {store.address} -> ({store.lat}, {store.lng})'))
-                                except UnicodeEncodeError:
-                                    self.stdout.write(self.style.SUCCESS(f'Google Maps geocoded store (encoding issue in name/address): ({store.lat}, {store.lng})'))
-                            else:
-                                try:
-                                    self.stdout.write(self.style.WARNING(f'Google Maps could not geocode address for store {store.store_name}: {store.address}'))
-                                except UnicodeEncodeError:
-                                    self.stdout.write(self.style.WARNING(f'Google Maps could not geocode address for store (encoding issue in name/address)'))
-                        except Exception as e:
-                            try:
-                                self.stdout.write(self.style.ERROR(f'Google Maps geocoding failed for store {store.store_name}: {store.address} - {e}'))
-                            except UnicodeEncodeError:
-                                self.stdout.write(self.style.ERROR(f'Google Maps geocoding failed for store (encoding issue in name/address) - {e}'))
-                    else:
-                        self.stdout.write(self.style.WARNING(f'Skipping Google Maps geocoding for store {store.store_name} due to limit ({google_maps_limit} calls). '))
-                elif not geolocated and settings.GOOGLE_MAPS_GEOCODING_ENABLED and (not settings.GOOGLE_MAPS_API_KEY or settings.GOOGLE_MAPS_API_KEY == 'YOUR_GOOGLE_MAPS_API_KEY'):
-                    self.stdout.write(self.style.WARNING(f'Skipping Google Maps geocoding for store {store.store_name}: API key not configured or is default.'))
-                elif not geolocated and not settings.GOOGLE_MAPS_GEOCODING_ENABLED:
-                    self.stdout.write(self.style.WARNING(f'Skipping Google Maps geocoding for store {store.store_name}: Google Maps geocoding is disabled in settings.'))
-
-
-                if geolocated:
-                    store.save() # どちらかで成功した場合のみ保存
-            else:
-                try:
-                    self.stdout.write(self.style.WARNING(f'店舗 {store.store_name} には住所がありません。'))
-                except UnicodeEncodeError:
-                    self.stdout.write(self.style.WARNING(f'店舗 (文字コード問題) には住所がありません。'))
-
-        self.stdout.write(self.style.SUCCESS('ジオコーディング処理完了。'))
+    def handle(self, *args, **options):
+        params = {'batch_size': options['batch_size'], 'workers': options['workers']}
+
+        if options['resume']:
+            job = BackgroundJobService.resumable(GeocodingService.JOB_KIND)
+            if job is None:
+                raise CommandError('再開できるジオコーディングジョブがありません。')
+            job.params.update(params)
+            job.save(update_fields=['params', 'updated_at'])
+            BackgroundJobService.requeue(job)
+            self.stdout.write(f'ジョブ #{job.pk} を店舗ID {job.checkpoint.get("last_store_id", 0)} の次から再開します。')
+        else:
+            job = BackgroundJobService.enqueue(GeocodingService.JOB_KIND, params=params)
+
+        if options['enqueue']:
+            self.stdout.write(self.style.SUCCESS(f'ジオコーディングジョブ #{job.pk} を登録しました。run_jobs で実行されます。'))
+            return
+
+        job = BackgroundJobService.claim(job_id=job.pk)
+        if job is None:
+            raise CommandError('ジョブは既に他のワーカーで実行中です。')
+        started_progress = job.progress
+        started = time.perf_counter()
+        job = BackgroundJobService.execute(job, stdout=self.stdout)
+        elapsed = time.perf_counter() - started
+        if job.status != 'completed':
+            raise CommandError(f'ジオコーディングに失敗しました。--resume で続きから再開できます: {job.error}')
+
+        result = job.result
+        throughput = (result['processed'] - started_progress) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'ジオコーディング処理完了: {result["processed"]} 件中 {result["found"]} 件の位置を取得 '
+            f'(未取得 {result["missed"]} 件 / うち一時的なエラー {result["errors"]} 件)'
+        ))
+        self.stdout.write(
+            f'キャッシュ ヒット {result["cache_hits"]} 件 / ミス {result["processed"] - result["cache_hits"]} 件, '
+            f'{elapsed:.1f}秒 ({throughput:.1f} 件/秒)'
+        )
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from core.models import Store
+from core.services import StoreMergeService
+
+
+class Command(BaseCommand):
+    help = '店舗名（正規化後）や電話番号が重複する店舗を1つに統合します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--into', type=int, help='統合先の店舗ID (--from と併用)')
+        parser.add_argument('--from', dest='sources', type=int, nargs='+', help='統合する店舗ID')
+        parser.add_argument('--fuzzy', action='store_true', help='店舗名が類似する店舗も重複とみなす')
+        parser.add_argument('--dry-run', action='store_true', help='統合せず重複のグループを表示のみ行う')
+
+    def handle(self, *args, **options):
+        if options['into'] or options['sources']:
+            if not (options['into'] and options['sources']):
+                raise CommandError('--into と --from は同時に指定してください。')
+            groups = [[options['into'], *options['sources']]]
+            explicit = True
+        else:
+            groups = StoreMergeService.find_duplicates(fuzzy=options['fuzzy'])
+            explicit = False
+
+        if not groups:
+            self.stdout.write(self.style.SUCCESS('重複する店舗はありません。'))
+            return
+
+        store_ids = {store_id for group in groups for store_id in group}
+        stores = Store.objects.annotate(receipt_count=Count('receipt')).in_bulk(store_ids)
+        missing = store_ids - set(stores)
+        if missing:
+            raise CommandError(f'店舗が見つかりません: {sorted(missing)}')
+
+        merged = 0
+        for group in groups:
+            members = [stores[store_id] for store_id in group]
+            # 指定がなければ、レシートの多い店舗（同数なら位置が設定済み・IDの小さい店舗）を統合先にする
+            target = members[0] if explicit else min(
+                members, key=lambda store: (-store.receipt_count, (store.lat, store.lng) == (0.0, 0.0), store.pk))
+            sources = [store for store in members if store.pk != target.pk]
+            names = ', '.join(f'#{store.pk} {store.store_name}' for store in sources)
+            self.stdout.write(f'#{target.pk} {target.store_name} <- {names}')
+            if options['dry_run']:
+                continue
+            counts = StoreMergeService.merge(target, sources)
+            merged += counts.get('stores', 0)
+            self.stdout.write(
+                f'  レシート {counts.get("receipts", 0)} 件 / クーポン利用 {counts.get("coupon_usages", 0)} 件 / '
+                f'ユーザー {counts.get("users", 0)} 件を付け替えました'
+            )
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(f'{len(groups)} グループ（ドライラン）'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{len(groups)} グループ、{merged} 店舗を統合しました。'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from core.services import CouponUsageRollupService
+
+
+class Command(BaseCommand):
+    help = 'クーポン利用履歴から時間・日別の利用集計を作り直します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--coupon', type=int, action='append', help='対象のクーポンID（複数指定可。省略時は全クーポン）')
+
+    def handle(self, *args, **options):
+        created = CouponUsageRollupService.rebuild(options['coupon'])
+        self.stdout.write(self.style.SUCCESS(f'{created} 件の集計行を作成しました。'))
@@ -0,0 +1,30 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from core.services import UserMonthlySummaryService
+
+
+class Command(BaseCommand):
+    help = 'レシートと明細からユーザーの月別集計を作り直します（導入時の作成や不整合の修復用）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', help='対象のユーザーID（複数指定可。省略時は全ユーザー）')
+        parser.add_argument('--month', help='対象月 (YYYY-MM。--user と併用。省略時は全期間)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='1回に集計するユーザー数')
+
+    def handle(self, *args, **options):
+        months = None
+        if options['month']:
+            if not options['user']:
+                raise CommandError('--month は --user と併用してください。')
+            try:
+                year, month = map(int, options['month'].split('-'))
+                months = [date(year, month, 1)]
+            except ValueError:
+                raise CommandError('--month は YYYY-MM の形式で指定してください。')
+
+        if options['user']:
+            created = UserMonthlySummaryService.refresh(options['user'], months)
+        else:
+            created = UserMonthlySummaryService.rebuild(options['chunk_size'], stdout=self.stdout)
+        self.stdout.write(self.style.SUCCESS(f'{created} 件の月別集計を作成しました。'))
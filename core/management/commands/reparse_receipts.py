@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.receipt_parser import PARSER_VERSION
+from core.services import BackgroundJobService, ReceiptReparseService
+
+
+class Command(BaseCommand):
+    help = '保存済みのOCRテキストを現在の解析ロジックで再解析します（再OCRは行いません）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='書き込みを行わず、変化するレシート数のみ表示する')
+        parser.add_argument('--chunk-size', type=int, default=settings.REPARSE_CHUNK_SIZE, help='1チャンクあたりのレシート数')
+        parser.add_argument('--workers', type=int, default=settings.RESCORE_WORKERS, help='解析を並列実行するプロセス数')
+        parser.add_argument('--pause', type=float, default=settings.RESCORE_PAUSE_SECONDS, help='チャンクごとの待機秒数')
+        parser.add_argument('--enqueue', action='store_true', help='実行せずバックグラウンドジョブとして登録のみ行う')
+        parser.add_argument('--resume', action='store_true', help='中断した直近の再解析ジョブを続きから実行する')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'解析バージョン {PARSER_VERSION} 未満のレシートを対象とします。')
+
+        if options['dry_run']:
+            counts = ReceiptReparseService.dry_run(chunk_size=options['chunk_size'], workers=options['workers'])
+            self.stdout.write(self.style.SUCCESS(
+                f'{counts["examined"]} 件中 {counts["changed"]} 件が変化します '
+                f'(商品数: {counts["item_count"]} 件 / 合計: {counts["totals"]} 件 / 日時: {counts["date"]} 件)'
+            ))
+            return
+
+        params = {
+            'chunk_size': options['chunk_size'],
+            'workers': options['workers'],
+            'pause': options['pause'],
+        }
+        if options['resume']:
+            job = BackgroundJobService.resumable(ReceiptReparseService.JOB_KIND)
+            if job is None:
+                raise CommandError('再開できる再解析ジョブがありません。')
+            job.params.update(params)
+            job.save(update_fields=['params', 'updated_at'])
+            BackgroundJobService.requeue(job)
+        else:
+            job = BackgroundJobService.enqueue(ReceiptReparseService.JOB_KIND, params=params)
+
+        if options['enqueue']:
+            self.stdout.write(self.style.SUCCESS(f'再解析ジョブ #{job.pk} を登録しました。run_jobs で実行されます。'))
+            return
+
+        job = BackgroundJobService.claim(job_id=job.pk)
+        if job is None:
+            raise CommandError('ジョブは既に他のワーカーで実行中です。')
+        job = BackgroundJobService.execute(job, stdout=self.stdout)
+        if job.status != 'completed':
+            raise CommandError(f'再解析に失敗しました。--resume で続きから再開できます: {job.error}')
+        result = job.result
+        self.stdout.write(self.style.SUCCESS(
+            f'再解析完了: {result["examined"]} 件中 {result["changed"]} 件を更新 '
+            f'(商品数: {result["item_count"]} 件 / 合計: {result["totals"]} 件 / 日時: {result["date"]} 件)'
+        ))
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from core.services import BackgroundJobService, ReceiptRescoreService
+
+
+class Command(BaseCommand):
+    help = '現在のエコ商品カタログで過去のレシート明細を再採点します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.RESCORE_CHUNK_SIZE, help='1チャンクあたりの明細数')
+        parser.add_argument('--workers', type=int, default=settings.RESCORE_WORKERS, help='採点を並列実行するプロセス数')
+        parser.add_argument('--pause', type=float, default=settings.RESCORE_PAUSE_SECONDS, help='チャンクごとの待機秒数')
+        parser.add_argument('--enqueue', action='store_true', help='実行せずバックグラウンドジョブとして登録のみ行う')
+        parser.add_argument('--resume', action='store_true', help='中断した直近の再採点ジョブを続きから実行する')
+
+    def handle(self, *args, **options):
+        params = {
+            'chunk_size': options['chunk_size'],
+            'workers': options['workers'],
+            'pause': options['pause'],
+        }
+
+        if options['resume']:
+            job = BackgroundJobService.resumable(ReceiptRescoreService.JOB_KIND)
+            if job is None:
+                raise CommandError('再開できる再採点ジョブがありません。')
+            job.params.update(params)
+            job.save(update_fields=['params', 'updated_at'])
+            BackgroundJobService.requeue(job)
+            self.stdout.write(f'ジョブ #{job.pk} を明細ID {job.checkpoint.get("last_item_id", 0)} の次から再開します。')
+        else:
+            job = BackgroundJobService.enqueue(ReceiptRescoreService.JOB_KIND, params=params)
+
+        if options['enqueue']:
+            self.stdout.write(self.style.SUCCESS(f'再採点ジョブ #{job.pk} を登録しました。run_jobs で実行されます。'))
+            return
+
+        job = BackgroundJobService.claim(job_id=job.pk)
+        if job is None:
+            raise CommandError('ジョブは既に他のワーカーで実行中です。')
+        job = BackgroundJobService.execute(job, stdout=self.stdout)
+        if job.status != 'completed':
+            raise CommandError(f'再採点に失敗しました。--resume で続きから再開できます: {job.error}')
+        result = job.result
+        self.stdout.write(self.style.SUCCESS(
+            f'再採点完了: {result["processed"]} 件中 {result["changed_items"]} 件を更新 (ポイント差分 {result["point_delta"]:+d})'))
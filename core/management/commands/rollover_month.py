@@ -0,0 +1,33 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from core.services import MonthlyRolloverService
+
+
+class Command(BaseCommand):
+    help = '月替わりのポイントリセットを全ユーザー分まとめて実行します（同じ月に何度実行しても安全です）。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month', help='リセット対象の月 (YYYY-MM, 省略時は今月)')
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                month_start = datetime.strptime(options['month'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('--month は YYYY-MM 形式で指定してください。')
+        else:
+            month_start = MonthlyRolloverService.month_start()
+
+        started = time.perf_counter()
+        counts = MonthlyRolloverService.rollover(month_start)
+        elapsed = time.perf_counter() - started
+
+        if not counts['reset'] and not counts['initialized']:
+            self.stdout.write(self.style.SUCCESS(f'{month_start:%Y年%m月} のリセットは実行済みです。'))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f'{month_start:%Y年%m月} のリセット完了: {counts["reset"]} 人をリセット / '
+            f'{counts["initialized"]} 人を初期化 ({elapsed:.2f}秒)'
+        ))
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.models import BackgroundJob
+from core.services import BackgroundJobService
+
+
+class Command(BaseCommand):
+    help = '待機中のバックグラウンドジョブを実行します。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', help='実行するジョブ種別 (複数指定可)')
+        parser.add_argument('--loop', action='store_true', help='ジョブがなくなっても終了せず待機し続ける')
+        parser.add_argument('--interval', type=float, default=5.0, help='--loop時のポーリング間隔 (秒)')
+        parser.add_argument('--retry', type=int, help='指定IDの失敗ジョブを待機中に戻して実行する')
+        parser.add_argument('--requeue-stale', type=int, metavar='MINUTES',
+                            help='指定分数以上更新のない実行中ジョブを待機中に戻す')
+
+    def handle(self, *args, **options):
+        if options['requeue_stale']:
+            count = BackgroundJobService.requeue_stale(options['requeue_stale'])
+            self.stdout.write(self.style.WARNING(f'{count} 件の停止したジョブを待機中に戻しました。'))
+
+        if options['retry']:
+            job = BackgroundJob.objects.filter(pk=options['retry'], status='failed').first()
+            if job:
+                BackgroundJobService.requeue(job)
+
+        processed = 0
+        while True:
+            job = BackgroundJobService.claim(kinds=options['kind'])
+            if job is None:
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            self.stdout.write(f'ジョブ開始: {job}')
+            job = BackgroundJobService.execute(job)
+            processed += 1
+            if job.status == 'completed':
+                self.stdout.write(self.style.SUCCESS(f'ジョブ完了: {job} {job.result}'))
+            else:
+                self.stdout.write(self.style.ERROR(f'ジョブ失敗: {job} {job.error}'))
+
+        self.stdout.write(self.style.SUCCESS(f'{processed} 件のジョブを処理しました。'))
@@ -1,6 +1,6 @@
 import json
 from django.core.management.base import BaseCommand
-from core.views import parse_receipt_data
+from core.receipt_parser import parse_receipt_data
 
 class Command(BaseCommand):
     help = 'RECIPT.TXTを使用してレシート解析ロジックをテストします。'
@@ -0,0 +1,194 @@
+"""
+エコ商品照合のためのアルゴリズム群。
+モデルに依存しないため、ワーカープロセスからも読み込める。
+"""
+import re
+import unicodedata
+
+from django.conf import settings
+
+
+def normalize_product_name(name):
+    """商品名をNFKC正規化し、空白を除去して小文字化する"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', name or '')).lower()
+
+
+def bounded_substring_distance(pattern, text, max_distance):
+    """
+    patternとtext内の任意の部分文字列との最小編集距離を返す。
+    max_distanceを超える場合はNoneを返す。
+    """
+    m = len(pattern)
+    if m == 0:
+        return 0
+    if max_distance < 0 or len(text) < m - max_distance:
+        return None
+
+    # 行: pattern, 列: text。部分文字列照合のため0行目は常に0
+    column = list(range(m + 1))
+    best = column[m]
+    for ch in text:
+        diagonal = 0
+        for i in range(1, m + 1):
+            above = column[i]
+            cost = 0 if pattern[i - 1] == ch else 1
+            column[i] = min(above + 1, column[i - 1] + 1, diagonal + cost)
+            diagonal = above
+        if column[m] < best:
+            best = column[m]
+            if best == 0:
+                break
+    return best if best <= max_distance else None
+
+
+class NGramIndex:
+    """
+    正規化済み文字列の文字n-gram転置インデックス。
+    OCRの誤字を含む文字列に対し、照合候補を少数に絞り込むために使用する。
+    """
+
+    def __init__(self, n=2):
+        self.n = n
+        self.keys = []
+        self.gram_counts = []
+        self.postings = {}
+
+    def grams(self, text):
+        if len(text) < self.n:
+            return {text} if text else set()
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    def add(self, key):
+        """キーを追加し、エントリ番号を返す"""
+        entry_id = len(self.keys)
+        grams = self.grams(key)
+        self.keys.append(key)
+        self.gram_counts.append(len(grams))
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(entry_id)
+        return entry_id
+
+    def candidates(self, text, max_edits=None):
+        """
+        textの部分文字列とmax_edits(key)回以内の編集で一致し得るエントリ番号を返す。
+        1回の編集で失われるn-gramは高々n個であることを利用して絞り込む。
+        """
+        # n文字未満のキーはキー自体をgramとして登録しているため、短い部分文字列も引く
+        short = {text[i:i + size] for size in range(1, self.n) for i in range(len(text) - size + 1)}
+        shared = {}
+        for gram in self.grams(text) | short:
+            for entry_id in self.postings.get(gram, ()):
+                shared[entry_id] = shared.get(entry_id, 0) + 1
+
+        result = []
+        for entry_id, count in shared.items():
+            edits = max_edits(self.keys[entry_id]) if max_edits else 0
+            if count >= max(self.gram_counts[entry_id] - edits * self.n, 1):
+                result.append(entry_id)
+        result.sort()
+        return result
+
+
+class EcoProductMatcher:
+    """
+    レシートの商品名をエコ商品カタログに照合するクラス。
+    まず従来通りキーワードの部分一致を探し、見つからない場合のみ
+    n-gramインデックスで絞り込んだ候補に対して編集距離による類似度判定を行う。
+    """
+
+    def __init__(self, eco_products, threshold=None, ngram_size=None):
+        if threshold is None:
+            threshold = getattr(settings, 'ECO_PRODUCT_MATCH_THRESHOLD', 0.8)
+        if ngram_size is None:
+            ngram_size = getattr(settings, 'ECO_PRODUCT_NGRAM_SIZE', 2)
+        self.threshold = threshold
+        self.index = NGramIndex(ngram_size)
+        self.eco_products = []
+        for eco_product in eco_products:
+            normalized = normalize_product_name(eco_product.name)
+            if not normalized:
+                continue
+            self.index.add(normalized)
+            self.eco_products.append(eco_product)
+
+    def __len__(self):
+        return len(self.eco_products)
+
+    def max_edits(self, keyword):
+        """キーワード長と閾値から許容する編集回数を求める"""
+        return int(len(keyword) * (1 - self.threshold) + 1e-9)
+
+    @staticmethod
+    def _is_eligible(eco_product, store_id):
+        # 共通商品 または レシートの店舗とエコ商品の店舗が一致する場合のみ付与（店舗不明のレシートは共通商品のみ）
+        return eco_product.is_common or (store_id is not None and eco_product.store_id == store_id)
+
+    def match(self, product_name, store_id=None):
+        """最も適合するエコ商品と類似度(0〜1)のタプルを返す。該当なしは(None, 0.0)"""
+        normalized = normalize_product_name(product_name)
+        if not normalized:
+            return None, 0.0
+
+        # 1. 部分一致（カタログ順で最初の1つ）
+        for entry_id in self.index.candidates(normalized):
+            eco_product = self.eco_products[entry_id]
+            if self.index.keys[entry_id] in normalized and self._is_eligible(eco_product, store_id):
+                return eco_product, 1.0
+
+        # 2. 候補に対してのみ編集距離で類似度判定
+        best, best_score = None, 0.0
+        for entry_id in self.index.candidates(normalized, self.max_edits):
+            eco_product = self.eco_products[entry_id]
+            if not self._is_eligible(eco_product, store_id):
+                continue
+            keyword = self.index.keys[entry_id]
+            limit = self.max_edits(keyword)
+            if limit == 0:
+                continue
+            distance = bounded_substring_distance(keyword, normalized, limit)
+            if distance is None:
+                continue
+            score = 1 - distance / len(keyword)
+            if score >= self.threshold and score > best_score:
+                best, best_score = eco_product, score
+        return best, best_score
+
+
+# --- ワーカープロセス用 ---
+
+from collections import namedtuple
+
+# ワーカープロセスへ渡すエコ商品の最小限の情報
+CatalogEntry = namedtuple('CatalogEntry', ['pk', 'name', 'points', 'is_common', 'store_id'])
+
+_worker_matcher = None
+
+
+def catalog_entries(eco_products):
+    """エコ商品をプロセス間で受け渡し可能なタプルに変換する"""
+    return [
+        CatalogEntry(eco_product.pk, eco_product.name, eco_product.points, eco_product.is_common, eco_product.store_id)
+        for eco_product in eco_products
+    ]
+
+
+def init_scoring_worker(entries, threshold, ngram_size):
+    """ワーカープロセスの初期化時にマッチャーを構築する"""
+    global _worker_matcher
+    _worker_matcher = EcoProductMatcher(entries, threshold=threshold, ngram_size=ngram_size)
+
+
+def score_item_rows(rows, matcher=None):
+    """
+    明細行 (item_id, 商品名, 数量, 店舗ID, 現在のポイント) を再採点し、
+    ポイントが変わる行の (item_id, 新しいポイント) のリストを返す。
+    """
+    # 空のカタログのマッチャーも偽になるため、Noneかどうかで判定する
+    matcher = _worker_matcher if matcher is None else matcher
+    changes = []
+    for item_id, product_name, quantity, store_id, points in rows:
+        eco_product, _score = matcher.match(product_name, store_id)
+        new_points = eco_product.points * quantity if eco_product else 0
+        if new_points != points:
+            changes.append((item_id, new_points))
+    return changes
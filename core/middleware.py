@@ -23,27 +23,23 @@ class AdminAccessMiddleware:
 
 
 class MonthlyPointResetMiddleware:
+    """
+    月替わりのポイントリセットは rollover_month コマンドで一括実行する。
+    ここではリクエスト済みのユーザー情報だけを見て判定するため、通常はクエリを発行しない。
+    コマンドの実行前にアクセスしたユーザーのみ、同じ処理をそのユーザー分だけ行う。
+    """
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        if request.user.is_authenticated and request.user.role == 'user':
-            today = timezone.now().date()
-            # 月初めを取得 (1日)
-            first_day_of_month = today.replace(day=1)
-            
-            if not request.user.last_reset_month:
-                # 初回導入時：リセットせず、今月を「リセット済み」としてマーク
-                user = request.user
-                user.last_reset_month = first_day_of_month
-                user.save()
-            elif request.user.last_reset_month < first_day_of_month:
-                # 実際に月が替わった場合：リセット実行
-                user = request.user
-                user.current_points = 0
-                user.last_reset_month = first_day_of_month
-                user.save()
-        
+        user = request.user
+        if user.is_authenticated and user.role == 'user':
+            month_start = timezone.localdate().replace(day=1)
+            if not user.last_reset_month or user.last_reset_month < month_start:
+                from core.services import MonthlyRolloverService
+                MonthlyRolloverService.rollover(month_start, user_ids=[user.pk])
+                user.refresh_from_db(fields=['current_points', 'lastmonth_point', 'rank', 'last_reset_month'])
+
         response = self.get_response(request)
         return response
 
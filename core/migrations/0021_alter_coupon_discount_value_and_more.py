@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:40
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # 既存モデルのバリデーター定義にマイグレーションを追従させる（スキーマの変更はない）
+
+    dependencies = [
+        ('core', '0020_report_held_points'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='coupon',
+            name='discount_value',
+            field=models.DecimalField(decimal_places=2, max_digits=12, validators=[django.core.validators.MinValueValidator(1)], verbose_name='割引量'),
+        ),
+        migrations.AlterField(
+            model_name='coupon',
+            name='required_points',
+            field=models.IntegerField(default=0, validators=[django.core.validators.MinValueValidator(0)], verbose_name='必要ポイント数'),
+        ),
+        migrations.AlterField(
+            model_name='ecoproduct',
+            name='jan_code',
+            field=models.CharField(blank=True, max_length=13, null=True, unique=True, validators=[django.core.validators.RegexValidator('^\\d+$', 'JANコードは数字のみ入力してください。')], verbose_name='JANコード'),
+        ),
+        migrations.AlterField(
+            model_name='ecoproduct',
+            name='points',
+            field=models.IntegerField(default=10, validators=[django.core.validators.MinValueValidator(1)], verbose_name='付与ポイント'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_backgroundjob_pointtransaction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='parser_version',
+            field=models.PositiveSmallIntegerField(db_index=True, default=0, verbose_name='解析バージョン'),
+        ),
+        migrations.AlterField(
+            model_name='pointtransaction',
+            name='reason',
+            field=models.CharField(choices=[('scan', 'レシート読み取り'), ('rescore', '再採点'), ('reparse', '再解析'), ('adjustment', '調整')], max_length=20, verbose_name='理由'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+from core.receipt_parser import compute_ocr_fingerprint
+
+
+def backfill_ocr_fingerprints(apps, schema_editor):
+    # 既存の重複レシートは最初の1件のみに指紋を設定し、一意制約に違反しないようにする
+    Receipt = apps.get_model('core', 'Receipt')
+    seen = set()
+    batch = []
+    for receipt in Receipt.objects.order_by('pk').only('pk', 'user_id', 'ocr_text').iterator(chunk_size=1000):
+        fingerprint = compute_ocr_fingerprint(receipt.ocr_text)
+        if fingerprint is None or (receipt.user_id, fingerprint) in seen:
+            continue
+        seen.add((receipt.user_id, fingerprint))
+        receipt.ocr_fingerprint = fingerprint
+        batch.append(receipt)
+        if len(batch) >= 1000:
+            Receipt.objects.bulk_update(batch, ['ocr_fingerprint'])
+            batch = []
+    if batch:
+        Receipt.objects.bulk_update(batch, ['ocr_fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_receipt_parser_version_alter_pointtransaction_reason'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='ocr_fingerprint',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, verbose_name='OCR指紋'),
+        ),
+        migrations.RunPython(backfill_ocr_fingerprints, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='receipt',
+            constraint=models.UniqueConstraint(fields=('user', 'ocr_fingerprint'), name='unique_receipt_ocr_fingerprint'),
+        ),
+    ]
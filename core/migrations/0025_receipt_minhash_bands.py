@@ -0,0 +1,74 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:46
+
+from django.db import migrations, models
+
+from core.receipt_parser import MINHASH_BANDS, compute_minhash_bands
+
+
+def backfill_minhash_bands(apps, schema_editor):
+    Receipt = apps.get_model('core', 'Receipt')
+    fields = [f'minhash_band{band}' for band in range(MINHASH_BANDS)]
+    batch = []
+    for receipt in Receipt.objects.order_by('pk').only('pk', 'ocr_text').iterator(chunk_size=1000):
+        bands = compute_minhash_bands(receipt.ocr_text)
+        if bands is None:
+            continue
+        for field, value in zip(fields, bands):
+            setattr(receipt, field, value)
+        batch.append(receipt)
+        if len(batch) >= 1000:
+            Receipt.objects.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        Receipt.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_receipt_ocr_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band0',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド0'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band1',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド1'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band2',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド2'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band3',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド3'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band4',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド4'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band5',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド5'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band6',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド6'),
+        ),
+        migrations.AddField(
+            model_name='receipt',
+            name='minhash_band7',
+            field=models.IntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='MinHashバンド7'),
+        ),
+        migrations.RunPython(backfill_minhash_bands, migrations.RunPython.noop),
+    ]
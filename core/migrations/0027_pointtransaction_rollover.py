@@ -0,0 +1,58 @@
+# Generated by Django 5.2.7 on 2026-10-19 16:51
+
+from datetime import datetime, time
+
+from django.db import migrations, models
+from django.db.models import Sum
+from django.utils import timezone
+
+
+def backfill_scan_transactions(apps, schema_editor):
+    # 台帳導入前のレシートについて、読み取り時の獲得ポイントを台帳に記録する
+    # (points_earnedは再採点・再解析後の値のため、それらの台帳分を差し引く)
+    Receipt = apps.get_model('core', 'Receipt')
+    PointTransaction = apps.get_model('core', 'PointTransaction')
+    adjusted = dict(
+        PointTransaction.objects.filter(receipt__isnull=False).values('receipt_id')
+        .annotate(total=Sum('delta')).values_list('receipt_id', 'total')
+    )
+    scanned = set(PointTransaction.objects.filter(reason='scan').values_list('receipt_id', flat=True))
+    tz = timezone.get_current_timezone()
+
+    batch = []
+    rows = Receipt.objects.order_by('pk').values_list('pk', 'user_id', 'points_earned', 'scanned_at')
+    for receipt_id, user_id, points_earned, scanned_at in rows.iterator(chunk_size=1000):
+        delta = points_earned - adjusted.get(receipt_id, 0)
+        if receipt_id in scanned or not delta:
+            continue
+        batch.append((PointTransaction(user_id=user_id, delta=delta, reason='scan', receipt_id=receipt_id),
+                      datetime.combine(scanned_at, time.min, tzinfo=tz)))
+        if len(batch) >= 1000:
+            _save_with_created_at(PointTransaction, batch)
+            batch = []
+    if batch:
+        _save_with_created_at(PointTransaction, batch)
+
+
+def _save_with_created_at(PointTransaction, batch):
+    # created_atはauto_now_addのため、登録後にレシートの読み取り日で上書きする
+    transactions = PointTransaction.objects.bulk_create([point_transaction for point_transaction, _ in batch])
+    for point_transaction, (_, created_at) in zip(transactions, batch):
+        point_transaction.created_at = created_at
+    PointTransaction.objects.bulk_update(transactions, ['created_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_receipt_image_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pointtransaction',
+            name='reason',
+            field=models.CharField(choices=[('scan', 'レシート読み取り'), ('rescore', '再採点'), ('reparse', '再解析'), ('adjustment', '調整'), ('rollover', '月次リセット')], max_length=20, verbose_name='理由'),
+        ),
+        migrations.RunPython(backfill_scan_transactions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:11
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# これまでコード内で固定していたランクと特典を初期データとして登録する
+DEFAULT_TIERS = [
+    ('seed', '種', 0),
+    ('sprout', '芽', 100),
+    ('tree', '木', 300),
+    ('apple_tree', 'リンゴの木', 800),
+]
+DEFAULT_RULES = [
+    ('rank_reached', 'sprout', None, 'ブロンズランク特典'),
+    ('rank_reached', 'tree', None, 'シルバーランク特典'),
+    ('rank_reached', 'apple_tree', None, 'ゴールドランク特典'),
+    ('points_milestone', '', 1000, '1000ポイント達成記念'),
+]
+
+
+def seed_rank_rules(apps, schema_editor):
+    RankTier = apps.get_model('core', 'RankTier')
+    RewardRule = apps.get_model('core', 'RewardRule')
+    Coupon = apps.get_model('core', 'Coupon')
+    RankTier.objects.bulk_create([RankTier(code=code, name=name, min_points=points) for code, name, points in DEFAULT_TIERS])
+    coupons = {}
+    for coupon in Coupon.objects.filter(title__in=[title for *_rule, title in DEFAULT_RULES]).order_by('pk'):
+        coupons.setdefault(coupon.title, coupon)
+    RewardRule.objects.bulk_create([
+        RewardRule(kind=kind, rank=rank, points=points, coupon=coupons[title])
+        for kind, rank, points, title in DEFAULT_RULES if title in coupons
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_pointtransaction_rollover'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankTier',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=20, unique=True, verbose_name='ランクコード')),
+                ('name', models.CharField(max_length=32, verbose_name='ランク名')),
+                ('min_points', models.IntegerField(unique=True, validators=[django.core.validators.MinValueValidator(0)], verbose_name='必要ポイント')),
+            ],
+            options={
+                'verbose_name': 'ランク',
+                'verbose_name_plural': 'ランク',
+                'ordering': ['min_points'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RewardRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('rank_reached', 'ランク到達'), ('points_milestone', 'ポイント達成')], max_length=20, verbose_name='種別')),
+                ('rank', models.CharField(blank=True, max_length=20, verbose_name='対象ランクコード')),
+                ('points', models.IntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)], verbose_name='達成ポイント')),
+                ('is_active', models.BooleanField(default=True, verbose_name='有効')),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reward_rules', to='core.coupon', verbose_name='付与クーポン')),
+            ],
+            options={
+                'verbose_name': '特典ルール',
+                'verbose_name_plural': '特典ルール',
+            },
+        ),
+        migrations.RunPython(seed_rank_rules, migrations.RunPython.noop),
+    ]
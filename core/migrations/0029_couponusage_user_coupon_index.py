@@ -0,0 +1,19 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:21
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_rank_tiers_reward_rules'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='couponusage',
+            index=models.Index(fields=['user', 'coupon'], name='core_couponusage_user_coupon'),
+        ),
+    ]
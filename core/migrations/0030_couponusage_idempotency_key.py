@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_couponusage_user_coupon_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='couponusage',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True, verbose_name='冪等キー'),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import TruncDay, TruncHour
+
+
+def backfill_rollups(apps, schema_editor):
+    # 既存の利用履歴から時間・日別の集計を作成する（ランクは現在のランク）
+    CouponUsage = apps.get_model('core', 'CouponUsage')
+    CouponUsageRollup = apps.get_model('core', 'CouponUsageRollup')
+    for granularity, truncate in (('hour', TruncHour), ('day', TruncDay)):
+        rows = CouponUsage.objects.values('coupon_id', 'store_id', 'user__rank', bucket=truncate('used_at')) \
+            .annotate(count=Count('pk')).order_by()
+        CouponUsageRollup.objects.bulk_create([
+            CouponUsageRollup(
+                coupon_id=row['coupon_id'], store_id=row['store_id'], rank=row['user__rank'] or '',
+                granularity=granularity, bucket=row['bucket'], count=row['count'],
+            ) for row in rows
+        ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_couponusage_idempotency_key'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.CharField(blank=True, max_length=20, verbose_name='利用時のランク')),
+                ('granularity', models.CharField(choices=[('hour', '時間'), ('day', '日')], max_length=4, verbose_name='集計単位')),
+                ('bucket', models.DateTimeField(verbose_name='集計期間の開始')),
+                ('count', models.IntegerField(default=0, verbose_name='利用数')),
+            ],
+            options={
+                'verbose_name': 'クーポン利用集計',
+                'verbose_name_plural': 'クーポン利用集計',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='couponusage',
+            index=models.Index(fields=['coupon', '-used_at', '-id'], name='core_couponusage_history'),
+        ),
+        migrations.AddField(
+            model_name='couponusagerollup',
+            name='coupon',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='usage_rollups', to='core.coupon', verbose_name='クーポン'),
+        ),
+        migrations.AddField(
+            model_name='couponusagerollup',
+            name='store',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.store', verbose_name='利用店舗'),
+        ),
+        migrations.AddConstraint(
+            model_name='couponusagerollup',
+            constraint=models.UniqueConstraint(fields=('coupon', 'granularity', 'bucket', 'store', 'rank'), name='unique_coupon_usage_rollup'),
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_coupon_usage_rollups'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='store',
+            index=models.Index(fields=['lat', 'lng'], name='core_store_lat_lng'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_store_lat_lng_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_key', models.CharField(max_length=255, unique=True, verbose_name='正規化した住所')),
+                ('lat', models.FloatField(blank=True, null=True, verbose_name='緯度')),
+                ('lng', models.FloatField(blank=True, null=True, verbose_name='経度')),
+                ('provider', models.CharField(blank=True, max_length=20, verbose_name='取得元')),
+                ('expires_at', models.DateTimeField(verbose_name='有効期限')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': 'ジオコーディングキャッシュ',
+                'verbose_name_plural': 'ジオコーディングキャッシュ',
+            },
+        ),
+    ]
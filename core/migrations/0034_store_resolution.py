@@ -0,0 +1,48 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_geocode_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreAlias',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, verbose_name='別名')),
+                ('name_key', models.CharField(editable=False, max_length=255, unique=True, verbose_name='正規化した別名')),
+                ('source', models.CharField(choices=[('manual', '手動登録'), ('review', '未登録ヘッダーの確認'), ('merge', '店舗の統合')], default='manual', max_length=20, verbose_name='登録元')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='登録日時')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='aliases', to='core.store', verbose_name='店舗')),
+            ],
+            options={
+                'verbose_name': '店舗の別名',
+                'verbose_name_plural': '店舗の別名',
+            },
+        ),
+        migrations.CreateModel(
+            name='UnresolvedStoreHeader',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('header', models.CharField(max_length=255, verbose_name='ヘッダー')),
+                ('name_key', models.CharField(editable=False, max_length=255, unique=True, verbose_name='正規化したヘッダー')),
+                ('tel', models.CharField(blank=True, max_length=32, verbose_name='電話番号')),
+                ('occurrences', models.PositiveIntegerField(default=0, verbose_name='出現回数')),
+                ('status', models.CharField(choices=[('pending', '未確認'), ('resolved', '登録済み'), ('ignored', '対象外')], db_index=True, default='pending', max_length=20, verbose_name='ステータス')),
+                ('first_seen', models.DateTimeField(auto_now_add=True, verbose_name='初回検出日時')),
+                ('last_seen', models.DateTimeField(auto_now=True, verbose_name='最終検出日時')),
+                ('receipts', models.ManyToManyField(blank=True, related_name='unresolved_store_headers', to='core.receipt', verbose_name='対象のレシート')),
+                ('store', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='core.store', verbose_name='対応する店舗')),
+            ],
+            options={
+                'verbose_name': '未登録の店舗ヘッダー',
+                'verbose_name_plural': '未登録の店舗ヘッダー',
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.7 on 2026-10-19 17:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_store_resolution'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserMonthlySummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(verbose_name='対象月（月初日）')),
+                ('receipt_count', models.IntegerField(default=0, verbose_name='レシート数')),
+                ('eco_points', models.IntegerField(default=0, verbose_name='獲得エコポイント')),
+                ('total_quantity', models.IntegerField(default=0, verbose_name='購入商品数')),
+                ('eco_quantity', models.IntegerField(default=0, verbose_name='エコ商品数')),
+                ('products', models.JSONField(blank=True, default=list, verbose_name='購入商品')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='monthly_summaries', to=settings.AUTH_USER_MODEL, verbose_name='ユーザー')),
+            ],
+            options={
+                'verbose_name': '月別集計',
+                'verbose_name_plural': '月別集計',
+                'constraints': [models.UniqueConstraint(fields=('user', 'month'), name='unique_user_monthly_summary')],
+            },
+        ),
+    ]
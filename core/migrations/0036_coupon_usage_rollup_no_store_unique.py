@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-19 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_user_monthly_summary'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='couponusagerollup',
+            constraint=models.UniqueConstraint(condition=models.Q(('store__isnull', True)), fields=('coupon', 'granularity', 'bucket', 'rank'), name='unique_coupon_usage_rollup_no_store'),
+        ),
+    ]
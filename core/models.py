@@ -2,10 +2,9 @@
 from django.db import models
 from django.core.validators import MinValueValidator, RegexValidator
 from django.conf import settings
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
-import time
-import googlemaps
+
+from core.receipt_parser import MINHASH_BANDS
+from core.store_resolver import normalize_store_name
 
 
 class Store(models.Model):
@@ -29,44 +28,69 @@ class Store(models.Model):
         return self.store_name
 
     def save(self, *args, **kwargs):
-        if self.address and self.lat == 0.0 and self.lng == 0.0:
-            geolocated = False
-            # Nominatimでジオコーディングを試行
-            geolocator = Nominatim(user_agent="GreenRecipt_Geocoder")
-            try:
-                encoded_address = self.address.encode('utf-8').decode('utf-8')
-                location = geolocator.geocode(encoded_address, timeout=10, language='ja')
-                if location:
-                    self.lat = location.latitude
-                    self.lng = location.longitude
-                    geolocated = True
-                    print(f"Nominatim geocoded store {self.store_name}: {self.address} -> ({self.lat}, {self.lng})")
-                else:
-                    print(f"Nominatim could not geocode address for store {self.store_name}: {self.address}")
-            except (GeocoderTimedOut, GeocoderServiceError, Exception) as e:
-                print(f"Nominatim geocoding failed for store {self.store_name}: {self.address} - {e}")
-            time.sleep(1) # Nominatimサービスへの負荷軽減
-
-            # Nominatim失敗時はGoogle Mapsを使用
-            if not geolocated and settings.GOOGLE_MAPS_GEOCODING_ENABLED and settings.GOOGLE_MAPS_API_KEY and settings.GOOGLE_MAPS_API_KEY != 'YOUR_GOOGLE_MAPS_API_KEY':
-                try:
-                    gmaps = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY)
-                    geocode_result = gmaps.geocode(self.address, language='ja')
-                    if geocode_result:
-                        self.lat = geocode_result[0]['geometry']['location']['lat']
-                        self.lng = geocode_result[0]['geometry']['location']['lng']
-                        geolocated = True
-                        print(f"Google Maps geocoded store {self.store_name}: {self.address} -> ({self.lat}, {self.lng})")
-                    else:
-                        print(f"Google Maps could not geocode address for store {self.store_name}: {self.address}")
-                except Exception as e:
-                    print(f"Google Maps geocoding failed for store {self.store_name}: {self.address} - {e}")
-
+        # 位置未設定の店舗はジオコーディングのキャッシュから補い、キャッシュにない住所はバックグラウンドで取得する
+        needs_geocoding = bool(self.address) and self.lat == 0.0 and self.lng == 0.0
+        if needs_geocoding:
+            from core.services import GeocodingService
+            needs_geocoding = not GeocodingService.apply_cached(self)
         super().save(*args, **kwargs)
+        if needs_geocoding:
+            GeocodingService.schedule()
 
     class Meta:
         verbose_name = '加盟店'
         verbose_name_plural = '加盟店'
+        indexes = [
+            # 緯度経度の範囲検索用
+            models.Index(fields=['lat', 'lng'], name='core_store_lat_lng'),
+        ]
+
+
+class GeocodeCache(models.Model):
+    """住所ごとのジオコーディング結果。見つからなかった住所も lat/lng を空にして一定期間キャッシュする"""
+    address_key = models.CharField(max_length=255, unique=True, verbose_name='正規化した住所')
+    lat = models.FloatField(null=True, blank=True, verbose_name='緯度')
+    lng = models.FloatField(null=True, blank=True, verbose_name='経度')
+    provider = models.CharField(max_length=20, blank=True, verbose_name='取得元')
+    expires_at = models.DateTimeField(verbose_name='有効期限')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    @property
+    def found(self):
+        return self.lat is not None and self.lng is not None
+
+    def __str__(self):
+        return f"{self.address_key}: {self.lat}, {self.lng}"
+
+    class Meta:
+        verbose_name = 'ジオコーディングキャッシュ'
+        verbose_name_plural = 'ジオコーディングキャッシュ'
+
+
+class StoreAlias(models.Model):
+    """レシートのヘッダーなど、店舗を指す別名。店舗名の照合では店舗名と同様に扱う"""
+    SOURCE_CHOICES = [
+        ('manual', '手動登録'),
+        ('review', '未登録ヘッダーの確認'),
+        ('merge', '店舗の統合'),
+    ]
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name='aliases', verbose_name='店舗')
+    name = models.CharField(max_length=255, verbose_name='別名')
+    # 正規化した別名。同じ表記が複数の店舗を指さないよう一意にする
+    name_key = models.CharField(max_length=255, unique=True, editable=False, verbose_name='正規化した別名')
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, default='manual', verbose_name='登録元')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='登録日時')
+
+    def save(self, *args, **kwargs):
+        self.name_key = normalize_store_name(self.name)[:255]
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.name} -> {self.store}"
+
+    class Meta:
+        verbose_name = '店舗の別名'
+        verbose_name_plural = '店舗の別名'
 
 
 class Receipt(models.Model):
@@ -80,6 +104,24 @@ class Receipt(models.Model):
     image_url = models.URLField(max_length=191, verbose_name='画像URL')
     parsed_data = models.JSONField(null=True, blank=True, verbose_name='解析済みデータ')
     points_earned = models.IntegerField(default=0, verbose_name='獲得ポイント')
+    # parsed_dataを生成した解析ロジックのバージョン (0は導入前のデータ)
+    parser_version = models.PositiveSmallIntegerField(default=0, db_index=True, verbose_name='解析バージョン')
+    # 正規化したOCRテキストのハッシュ。ユーザーごとに一意とし、重複登録をDBで防ぐ
+    ocr_fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False, verbose_name='OCR指紋')
+    # OCRテキストのMinHashバンド値。撮り直した同じレシートをインデックス経由で検索するために使用する
+    minhash_band0 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド0')
+    minhash_band1 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド1')
+    minhash_band2 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド2')
+    minhash_band3 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド3')
+    minhash_band4 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド4')
+    minhash_band5 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド5')
+    minhash_band6 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド6')
+    minhash_band7 = models.IntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='MinHashバンド7')
+
+    # 画像の知覚ハッシュ (dHash)。撮り直した画像の再アップロードをOCR前に検出するために使用する
+    image_hash = models.BigIntegerField(null=True, blank=True, editable=False, db_index=True, verbose_name='画像ハッシュ')
+
+    MINHASH_BAND_FIELDS = [f'minhash_band{band}' for band in range(MINHASH_BANDS)]
 
     def __str__(self):
         return f"Receipt {self.id} - {self.scanned_at}"
@@ -120,6 +162,9 @@ class Receipt(models.Model):
     class Meta:
         verbose_name = 'レシート'
         verbose_name_plural = 'レシート'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'ocr_fingerprint'], name='unique_receipt_ocr_fingerprint'),
+        ]
 
 
 class Product(models.Model):
@@ -151,6 +196,37 @@ class ReceiptItem(models.Model):
         verbose_name_plural = 'レシート項目'
 
 
+class UnresolvedStoreHeader(models.Model):
+    """
+    既存の店舗に照合できなかったレシートのヘッダー（正規化した表記ごとに1行）。
+    管理者が既存店舗の別名とするか新規店舗として登録すると、対象のレシートに店舗が設定される。
+    """
+    STATUS_CHOICES = [
+        ('pending', '未確認'),
+        ('resolved', '登録済み'),
+        ('ignored', '対象外'),
+    ]
+    header = models.CharField(max_length=255, verbose_name='ヘッダー')
+    name_key = models.CharField(max_length=255, unique=True, editable=False, verbose_name='正規化したヘッダー')
+    tel = models.CharField(max_length=32, blank=True, verbose_name='電話番号')
+    occurrences = models.PositiveIntegerField(default=0, verbose_name='出現回数')
+    receipts = models.ManyToManyField(
+        Receipt, blank=True, related_name='unresolved_store_headers', verbose_name='対象のレシート')
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default='pending', db_index=True, verbose_name='ステータス')
+    store = models.ForeignKey(
+        Store, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='対応する店舗')
+    first_seen = models.DateTimeField(auto_now_add=True, verbose_name='初回検出日時')
+    last_seen = models.DateTimeField(auto_now=True, verbose_name='最終検出日時')
+
+    def __str__(self):
+        return f"{self.header} ({self.occurrences})"
+
+    class Meta:
+        verbose_name = '未登録の店舗ヘッダー'
+        verbose_name_plural = '未登録の店舗ヘッダー'
+
+
 class Inquiry(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL,
                              null=True, blank=True, verbose_name='問い合わせユーザー')
@@ -254,6 +330,9 @@ class CouponUsage(models.Model):
     coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, verbose_name='クーポン')
     store = models.ForeignKey(Store, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='利用店舗')
     used_at = models.DateTimeField(auto_now_add=True, verbose_name='利用日時')
+    # POS端末の再送・二重タップで同じ利用を二重に記録しないためのキー
+    idempotency_key = models.CharField(
+        max_length=64, unique=True, null=True, blank=True, verbose_name='冪等キー')
 
     def __str__(self):
         return f"{self.user} used {self.coupon} at {self.store}"
@@ -261,6 +340,41 @@ class CouponUsage(models.Model):
     class Meta:
         verbose_name = 'クーポン利用履歴'
         verbose_name_plural = 'クーポン利用履歴'
+        indexes = [
+            # ユーザーごとの利用済み判定 (CouponEligibilityService) 用
+            models.Index(fields=['user', 'coupon'], name='core_couponusage_user_coupon'),
+            # 利用履歴のキーセットページング (used_at, id) 用
+            models.Index(fields=['coupon', '-used_at', '-id'], name='core_couponusage_history'),
+        ]
+
+
+class CouponUsageRollup(models.Model):
+    """クーポン利用数の時間帯別集計（クーポン × 店舗 × ランク × 時間/日）。利用の記録時に加算される"""
+    GRANULARITY_CHOICES = [
+        ('hour', '時間'),
+        ('day', '日'),
+    ]
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='usage_rollups', verbose_name='クーポン')
+    store = models.ForeignKey(Store, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='利用店舗')
+    rank = models.CharField(max_length=20, blank=True, verbose_name='利用時のランク')
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES, verbose_name='集計単位')
+    bucket = models.DateTimeField(verbose_name='集計期間の開始')
+    count = models.IntegerField(default=0, verbose_name='利用数')
+
+    def __str__(self):
+        return f"{self.coupon} {self.granularity} {self.bucket}: {self.count}"
+
+    class Meta:
+        verbose_name = 'クーポン利用集計'
+        verbose_name_plural = 'クーポン利用集計'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['coupon', 'granularity', 'bucket', 'store', 'rank'], name='unique_coupon_usage_rollup'),
+            # NULLは一意制約で区別されるため、店舗なしの集計行は別の部分一意制約で重複を防ぐ
+            models.UniqueConstraint(
+                fields=['coupon', 'granularity', 'bucket', 'rank'], condition=models.Q(store__isnull=True),
+                name='unique_coupon_usage_rollup_no_store'),
+        ]
 
 
 class Report(models.Model):
@@ -364,3 +478,152 @@ class EcoProduct(models.Model):
     class Meta:
         verbose_name = 'エコ商品'
         verbose_name_plural = 'エコ商品'
+
+
+class PointTransaction(models.Model):
+    """ポイント増減の履歴（追記のみ）"""
+    REASON_CHOICES = [
+        ('scan', 'レシート読み取り'),
+        ('rescore', '再採点'),
+        ('reparse', '再解析'),
+        ('adjustment', '調整'),
+        ('rollover', '月次リセット'),
+    ]
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='point_transactions', verbose_name='ユーザー')
+    delta = models.IntegerField(verbose_name='増減ポイント')
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, verbose_name='理由')
+    receipt = models.ForeignKey(Receipt, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='対象レシート')
+    coupon = models.ForeignKey(Coupon, on_delete=models.SET_NULL, null=True, blank=True, verbose_name='対象クーポン')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+
+    def __str__(self):
+        return f"{self.user} {self.delta:+d} ({self.get_reason_display()})"
+
+    class Meta:
+        verbose_name = 'ポイント履歴'
+        verbose_name_plural = 'ポイント履歴'
+        indexes = [
+            models.Index(fields=['user', 'created_at']),
+        ]
+
+
+class UserMonthlySummary(models.Model):
+    """
+    ユーザーの月別のレシート集計（月はスキャン日の月）。
+    レシートの保存・再採点・再解析と同じトランザクションで更新し、画面表示ではこの1行を読む。
+    """
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                             related_name='monthly_summaries', verbose_name='ユーザー')
+    month = models.DateField(verbose_name='対象月（月初日）')
+    receipt_count = models.IntegerField(default=0, verbose_name='レシート数')
+    eco_points = models.IntegerField(default=0, verbose_name='獲得エコポイント')
+    total_quantity = models.IntegerField(default=0, verbose_name='購入商品数')
+    eco_quantity = models.IntegerField(default=0, verbose_name='エコ商品数')
+    # [商品名, 数量] のリスト（初めて購入した順）
+    products = models.JSONField(default=list, blank=True, verbose_name='購入商品')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    def top_products(self, limit=5):
+        """数量の多い順に (商品名, 数量) を返す"""
+        return sorted((tuple(product) for product in self.products), key=lambda product: -product[1])[:limit]
+
+    def products_display(self):
+        return [f"{name} ({quantity}点)" for name, quantity in self.products]
+
+    def __str__(self):
+        return f"{self.user} {self.month:%Y-%m}"
+
+    class Meta:
+        verbose_name = '月別集計'
+        verbose_name_plural = '月別集計'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'month'], name='unique_user_monthly_summary'),
+        ]
+
+
+class BackgroundJob(models.Model):
+    """run_jobsコマンドで処理されるバックグラウンドジョブ"""
+    STATUS_CHOICES = [
+        ('pending', '待機中'),
+        ('running', '実行中'),
+        ('completed', '完了'),
+        ('failed', '失敗'),
+    ]
+    kind = models.CharField(max_length=50, verbose_name='種別')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name='ステータス')
+    params = models.JSONField(default=dict, blank=True, verbose_name='パラメータ')
+    # 中断後に再開するための進捗情報
+    checkpoint = models.JSONField(default=dict, blank=True, verbose_name='チェックポイント')
+    progress = models.IntegerField(default=0, verbose_name='処理済み件数')
+    total = models.IntegerField(default=0, verbose_name='対象件数')
+    result = models.JSONField(null=True, blank=True, verbose_name='結果')
+    error = models.TextField(blank=True, verbose_name='エラー内容')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True,
+                             verbose_name='依頼ユーザー')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='作成日時')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='開始日時')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='終了日時')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新日時')
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.get_status_display()})"
+
+    @property
+    def progress_percentage(self):
+        if self.total > 0:
+            return min(int(self.progress / self.total * 100), 100)
+        return 100 if self.status == 'completed' else 0
+
+    def update_progress(self, progress=None, total=None, checkpoint=None):
+        """進捗とチェックポイントを保存する"""
+        if progress is not None:
+            self.progress = progress
+        if total is not None:
+            self.total = total
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        self.save(update_fields=['progress', 'total', 'checkpoint', 'updated_at'])
+
+    class Meta:
+        verbose_name = 'バックグラウンドジョブ'
+        verbose_name_plural = 'バックグラウンドジョブ'
+        indexes = [
+            models.Index(fields=['status', 'kind']),
+        ]
+
+
+class RankTier(models.Model):
+    """ランクの段階と必要ポイント"""
+    code = models.CharField(max_length=20, unique=True, verbose_name='ランクコード')
+    name = models.CharField(max_length=32, verbose_name='ランク名')
+    min_points = models.IntegerField(unique=True, validators=[MinValueValidator(0)], verbose_name='必要ポイント')
+
+    def __str__(self):
+        return f"{self.name} ({self.min_points}pt〜)"
+
+    class Meta:
+        verbose_name = 'ランク'
+        verbose_name_plural = 'ランク'
+        ordering = ['min_points']
+
+
+class RewardRule(models.Model):
+    """ランク到達・ポイント達成時に付与するクーポンの規則"""
+    KIND_CHOICES = [
+        ('rank_reached', 'ランク到達'),
+        ('points_milestone', 'ポイント達成'),
+    ]
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, verbose_name='種別')
+    rank = models.CharField(max_length=20, blank=True, verbose_name='対象ランクコード')
+    points = models.IntegerField(null=True, blank=True, validators=[MinValueValidator(1)], verbose_name='達成ポイント')
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='reward_rules', verbose_name='付与クーポン')
+    is_active = models.BooleanField(default=True, verbose_name='有効')
+
+    def __str__(self):
+        target = self.rank if self.kind == 'rank_reached' else f"{self.points}pt"
+        return f"{self.get_kind_display()} {target} → {self.coupon.title}"
+
+    class Meta:
+        verbose_name = '特典ルール'
+        verbose_name_plural = '特典ルール'
@@ -0,0 +1,227 @@
+"""
+レシートOCRテキストの解析ロジック。
+モデルに依存しないため、再解析ジョブのワーカープロセスからも読み込める。
+"""
+import hashlib
+import logging
+import re
+import unicodedata
+from datetime import datetime
+
+logger = logging.getLogger('core')
+
+# 解析ロジックを変更した場合はインクリメントし、reparse_receipts で過去のレシートを再解析する
+PARSER_VERSION = 1
+
+
+def parse_receipt_data(text):
+    """
+    OCRテキストから店舗名、取引日時、商品リスト、合計などを抽出する。（改善版）
+    - 様々な日付フォーマットに対応。
+    - 複数行にわたる商品情報や、1行にまとまった商品情報に対応。
+    - 合計金額、合計点数の抽出精度を向上。
+    """
+    lines = text.split('\n')
+    lines = [line.strip() for line in lines if line.strip()]
+
+    store_name = "不明"
+    title_line = ""
+    branch_line = ""
+
+    if lines:
+        title_line = lines[0]
+
+    for line in lines[1:5]:
+        if line.endswith('店'):
+            branch_line = line
+            break
+    
+    if title_line and branch_line and "HP" not in title_line:
+        store_name = f"{title_line} {branch_line}"
+    elif branch_line:
+        store_name = branch_line
+    elif title_line:
+        store_name = title_line
+    else:
+        store_name = "不明"
+
+    transaction_time = None
+    date_line_index = -1
+    date_pattern = re.compile(
+        r'(\d{4})[年/]\s*(\d{1,2})[月/]\s*(\d{1,2})日.*?\s*(\d{1,2}):(\d{2})'
+    )
+    for i, line in enumerate(lines):
+        logger.debug(f"Date parsing - Processing line: '{line}'")
+        match = date_pattern.search(line)
+        if match:
+            logger.debug(f"Date parsing - Match found for line: '{line}'")
+            logger.debug(f"Date parsing - Matched groups: {match.groups()}")
+            try:
+                year_str, month_str, day_str, hour_str, minute_str = match.groups()
+                year, month, day, hour, minute = map(
+                    int, [year_str, month_str, day_str, hour_str, minute_str])
+                if year < 100:
+                    year += 2000
+                transaction_time = datetime(year, month, day, hour, minute)
+                date_line_index = i
+                logger.debug(f"Date parsing - Successfully extracted: {transaction_time}")
+                break
+            except (ValueError, IndexError) as e: # エラー出力も追加
+                logger.debug(f"Date parsing - Error converting date parts: {e} for groups: {match.groups()}")
+                continue
+
+    total_quantity_from_receipt = 0
+    total_amount_from_receipt = 0
+    quantity_total_pattern = re.compile(r'(?:合計点数|買上点数|点数)\s*(\d+)')
+    amount_total_pattern = re.compile(r'(?:(?:御)?合計|小計)\s*¥?([\d,]+)')
+
+    for line in lines:
+        qty_match = quantity_total_pattern.search(line)
+        if qty_match:
+            total_quantity_from_receipt = int(qty_match.group(1))
+        amt_match = amount_total_pattern.search(line)
+        if amt_match:
+            total_amount_from_receipt = int(amt_match.group(1).replace(',', ''))
+
+    items = []
+    start_index = date_line_index + 1 if date_line_index != -1 else 0
+    end_index = len(lines)
+
+    for i, line in enumerate(lines[start_index:]):
+        if any(keyword in line for keyword in ['小計', '合計', 'クレジット', 'お預り']):
+            end_index = start_index + i
+            break
+
+    item_lines = lines[start_index:end_index]
+
+    # 商品行の正規表現
+    single_line_pattern = re.compile(r'^\d{4}\s+(.+?)\s+¥([\d,]+)※?$')
+    name_pattern = re.compile(r'^\d{4}\s+(.+)$')
+    price_pattern = re.compile(r'^¥([\d,]+)※?$')
+    quantity_pattern = re.compile(r'\(?\s*(\d+)\s*[個xX]')
+
+    i = 0
+    while i < len(item_lines):
+        line = item_lines[i]
+        
+        # 1行パターン
+        single_match = single_line_pattern.search(line)
+        if single_match:
+            name = single_match.group(1).strip()
+            price = int(single_match.group(2).replace(',', ''))
+            items.append({"name": name, "quantity": 1, "price": price})
+            i += 1
+        # 2行パターン
+        else:
+            name_match = name_pattern.search(line)
+            if name_match and i + 1 < len(item_lines):
+                next_line = item_lines[i+1]
+                price_match = price_pattern.search(next_line)
+                if price_match:
+                    name = name_match.group(1).strip()
+                    price = int(price_match.group(1).replace(',', ''))
+                    items.append({"name": name, "quantity": 1, "price": price})
+                    i += 2
+                else:
+                    i += 1 # nameはあったがpriceがなかった
+            else:
+                i += 1 # 何にもマッチせず
+            
+        # 数量行のチェック (itemsに追加された後)
+        if items and i < len(item_lines):
+            qty_line = item_lines[i]
+            qty_match = quantity_pattern.search(qty_line)
+            if qty_match:
+                quantity = int(qty_match.group(1))
+                items[-1]['quantity'] = quantity
+                i += 1 # 数量行を消費
+
+    final_total_quantity = total_quantity_from_receipt if total_quantity_from_receipt > 0 else sum(
+        item.get('quantity', 1) for item in items)
+
+    return {
+        "store_name": store_name,
+        "transaction_time": transaction_time,
+        "items": items,
+        "total_quantity": final_total_quantity,
+        "total_amount": total_amount_from_receipt
+    }
+
+
+def parse_receipt_rows(rows):
+    """
+    (レシートID, OCRテキスト) のリストを解析し、(レシートID, 解析結果) のリストを返す。
+    再解析ジョブのワーカープロセスで使用する。
+    """
+    return [(receipt_id, parse_receipt_data(ocr_text or '')) for receipt_id, ocr_text in rows]
+
+
+def normalize_ocr_text(text):
+    """OCRテキストをNFKC正規化し、空白を除去して小文字化する"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', text or '')).lower()
+
+
+def compute_ocr_fingerprint(text):
+    """
+    OCRテキストを正規化（NFKC・空白除去・小文字化）したSHA-256ハッシュを返す。
+    空のテキストの場合はNoneを返す。
+    """
+    normalized = normalize_ocr_text(text)
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+# --- 類似レシート検出 (MinHash) ---
+
+# 文字シングルの長さ
+SHINGLE_SIZE = 3
+# MinHashのバンド数と1バンドあたりのハッシュ数。
+# Jaccard係数0.8のペアは約98%、0.9のペアはほぼ確実にいずれかのバンドが一致する
+MINHASH_BANDS = 8
+MINHASH_ROWS = 4
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_PERMUTATIONS = [
+    (int.from_bytes(hashlib.blake2b(f'a{i}'.encode(), digest_size=8).digest(), 'big') % (_MERSENNE_PRIME - 1) + 1,
+     int.from_bytes(hashlib.blake2b(f'b{i}'.encode(), digest_size=8).digest(), 'big') % _MERSENNE_PRIME)
+    for i in range(MINHASH_BANDS * MINHASH_ROWS)
+]
+
+
+def ocr_shingles(text, size=SHINGLE_SIZE):
+    """正規化したOCRテキストの文字シングル（連続size文字）の集合を返す"""
+    normalized = normalize_ocr_text(text)
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+
+def shingle_similarity(a_text, b_text):
+    """2つのOCRテキストの文字シングルのJaccard係数を返す"""
+    a, b = ocr_shingles(a_text), ocr_shingles(b_text)
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def compute_minhash_bands(text):
+    """
+    文字シングルのMinHash署名をバンドごとにまとめ、インデックス用の整数のリストを返す。
+    撮り直しによる数文字のOCR揺れでは、いずれかのバンドの値が一致したまま残る。
+    空のテキストの場合はNoneを返す。
+    """
+    shingles = ocr_shingles(text)
+    if not shingles:
+        return None
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+              for shingle in shingles]
+    signature = [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _MINHASH_PERMUTATIONS]
+
+    bands = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = hashlib.blake2b(repr(rows).encode(), digest_size=4).digest()
+        # IntegerFieldに収まるよう31ビットに丸める
+        bands.append(int.from_bytes(digest, 'big') & 0x7FFFFFFF)
+    return bands
@@ -0,0 +1,135 @@
+"""
+ランク判定と特典付与のルールエンジン。
+RankTier・RewardRuleをプロセス内にキャッシュし、モデル・ビュー・バッチ処理から共通で使用する。
+ルールを変更するとキャッシュ上のバージョンを更新し、次回の参照時に読み直す。
+既定のキャッシュ (LocMemCache) はプロセスごとのため、即時に反映されるのは変更したプロセスのみで、
+他のワーカーには REWARD_RULES_MAX_AGE 秒以内に反映される（共有キャッシュを設定した場合は全プロセスで即時）。
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.lookups import GreaterThanOrEqual
+
+from core.models import RankTier, RewardRule
+
+RULES_VERSION_CACHE_KEY = 'core:reward_rules_version'
+DEFAULT_RANK = 'seed'
+
+
+class RewardEngine:
+    """読み込み済みのランク・特典ルールを評価する（評価時にクエリは発行しない）"""
+
+    def __init__(self, tiers, rules):
+        # tiers: [(必要ポイント, ランクコード)], rules: [(種別, ランクコード, 達成ポイント, クーポンID)]
+        self.tiers = sorted(tiers, reverse=True)
+        self.rank_order = {code: order for order, (_points, code) in enumerate(sorted(tiers))}
+        self.rank_coupons = {}
+        self.milestones = []
+        for kind, rank, points, coupon_id in rules:
+            if kind == 'rank_reached':
+                self.rank_coupons.setdefault(rank, []).append(coupon_id)
+            elif kind == 'points_milestone' and points:
+                self.milestones.append((points, coupon_id))
+        self.milestones.sort()
+
+    def rank_for_points(self, points):
+        """ポイント数に対応するランクを返す"""
+        for threshold, rank in self.tiers:
+            if points >= threshold:
+                return rank
+        return DEFAULT_RANK
+
+    def rank_expression(self, points='current_points'):
+        """一括更新用: ポイント（列名または式）からランクを求めるSQL式を返す"""
+        if isinstance(points, str):
+            points = F(points)
+        whens = [When(GreaterThanOrEqual(points, threshold), then=Value(rank)) for threshold, rank in self.tiers]
+        if not whens:
+            return Value(DEFAULT_RANK)
+        return Case(*whens, default=Value(DEFAULT_RANK), output_field=models.CharField())
+
+    def progress(self, points):
+        """現在のランクの必要ポイントと次のランクの必要ポイント（最高ランクの場合はNone）を返す"""
+        previous, following = 0, None
+        for threshold, _rank in self.tiers:
+            if points >= threshold:
+                previous = threshold
+                break
+            following = threshold
+        return previous, following
+
+    def rewards_for(self, old_points, new_points, old_rank=None):
+        """ポイントの変化で新たに得る特典クーポンのIDを返す"""
+        old_rank = old_rank or self.rank_for_points(old_points)
+        new_rank = self.rank_for_points(new_points)
+        coupon_ids = []
+        # ランクアップ特典
+        if self.rank_order.get(new_rank, -1) > self.rank_order.get(old_rank, -1):
+            coupon_ids.extend(self.rank_coupons.get(new_rank, []))
+        # ポイント達成特典
+        coupon_ids.extend(coupon_id for points, coupon_id in self.milestones if old_points < points <= new_points)
+        return coupon_ids
+
+    @staticmethod
+    def grant_pairs(pairs, batch_size=1000):
+        """(ユーザーID, クーポンID) を所持クーポンに一括登録する。所持済みの組み合わせは無視される。"""
+        from accounts.models import CustomUser
+        Through = CustomUser.current_coupons.through
+        Through.objects.bulk_create(
+            [Through(customuser_id=user_id, coupon_id=coupon_id) for user_id, coupon_id in dict.fromkeys(pairs)],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+        from core.services import CouponEligibilityService, CouponStatsService
+        transaction.on_commit(CouponStatsService.invalidate)
+        transaction.on_commit(lambda: CouponEligibilityService.invalidate({user_id for user_id, _coupon_id in pairs}))
+
+    def grant(self, changes):
+        """
+        (ユーザーID, 変更前ポイント, 変更後ポイント, 変更前ランク) のリストを評価し、
+        得た特典をまとめて付与する。付与対象がなければクエリは発行しない。
+        """
+        pairs = [
+            (user_id, coupon_id)
+            for user_id, old_points, new_points, old_rank in changes
+            for coupon_id in self.rewards_for(old_points, new_points, old_rank)
+        ]
+        if pairs:
+            self.grant_pairs(pairs)
+        return pairs
+
+
+_engine_lock = threading.Lock()
+_engine_cache = {'version': None, 'loaded_at': 0.0, 'engine': None}
+
+
+def get_reward_engine():
+    """
+    キャッシュ済みのルールエンジンを返す。
+    キャッシュ上のバージョンが変わったとき、または REWARD_RULES_MAX_AGE 秒経過したときのみDBから読み直す。
+    """
+    version = cache.get(RULES_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(RULES_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(RULES_VERSION_CACHE_KEY)
+    max_age = getattr(settings, 'REWARD_RULES_MAX_AGE', 300)
+    engine = _engine_cache['engine']
+    if engine is not None and _engine_cache['version'] == version and time.monotonic() - _engine_cache['loaded_at'] < max_age:
+        return engine
+
+    with _engine_lock:
+        tiers = list(RankTier.objects.values_list('min_points', 'code'))
+        rules = list(RewardRule.objects.filter(is_active=True).values_list('kind', 'rank', 'points', 'coupon_id'))
+        engine = RewardEngine(tiers, rules)
+        _engine_cache.update(version=version, loaded_at=time.monotonic(), engine=engine)
+    return engine
+
+
+def invalidate_reward_rules():
+    """ルールのバージョンを更新し、キャッシュを共有するプロセスのエンジンを無効にする"""
+    cache.set(RULES_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,25 @@
+"""
+アプリケーションのサービス層。機能ごとのモジュールに分け、ここからまとめて公開する。
+各モジュールの読み込み時にバックグラウンドジョブのハンドラが登録される。
+"""
+from core.services.coupons import (
+    CouponEligibility, CouponEligibilityService, CouponGrantService, CouponRedemptionError, CouponRedemptionService,
+    CouponStatsService, CouponTokenService, CouponUsageRollupService,
+)
+from core.services.inquiries import InquiryEmailService, InquiryService
+from core.services.jobs import BackgroundJobService
+from core.services.ledger import MonthlyRolloverService, PointLedgerService
+from core.services.receipts import (
+    DuplicateReceiptError, ReceiptReparseService, ReceiptRescoreService, ReceiptService, get_eco_product_matcher,
+)
+from core.services.reports import AIReportService
+from core.services.stores import GeocodingService, StoreMergeService, StoreResolutionService
+from core.services.summaries import UserMonthlySummaryService
+
+__all__ = [
+    'AIReportService', 'BackgroundJobService', 'CouponEligibility', 'CouponEligibilityService', 'CouponGrantService',
+    'CouponRedemptionError', 'CouponRedemptionService', 'CouponStatsService', 'CouponTokenService',
+    'CouponUsageRollupService', 'DuplicateReceiptError', 'GeocodingService', 'InquiryEmailService', 'InquiryService',
+    'MonthlyRolloverService', 'PointLedgerService', 'ReceiptReparseService', 'ReceiptRescoreService', 'ReceiptService',
+    'StoreMergeService', 'StoreResolutionService', 'UserMonthlySummaryService', 'get_eco_product_matcher',
+]
@@ -0,0 +1,561 @@
+"""
+クーポンの一括付与・統計・取得可否・利用・利用トークン・利用集計。
+"""
+import uuid
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncDay, TruncHour
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from accounts.models import CustomUser
+from core.coupon_tokens import CouponTokenError, issue_token, verify_token
+from core.models import Coupon, CouponUsage, CouponUsageRollup, RewardRule
+from core.services.jobs import BackgroundJobService
+
+
+class CouponGrantService:
+    """
+    クーポンを多数のユーザーへまとめて付与するサービスクラス。
+    対象ユーザーから所持者を除いた集合を1回のクエリで求め、所持クーポンの中間テーブルへチャンク単位で一括登録する。
+    """
+
+    JOB_KIND = 'grant_coupon'
+
+    @staticmethod
+    def qualifying_users(coupon):
+        """クーポンの必要ポイントを満たす一般ユーザーを返す"""
+        return CustomUser.objects.filter(role='user', current_points__gte=coupon.required_points)
+
+    @staticmethod
+    def missing_holders(coupon, users):
+        """usersのうち、まだクーポンを所持していないユーザーを返す"""
+        return users.exclude(current_coupons=coupon)
+
+    @classmethod
+    def _grant_chunks(cls, coupon, users, chunk_size, last_user_id=0):
+        """
+        未所持ユーザーを主キー順のチャンクで求めて付与し、(最後のユーザーID, 付与人数) を返すジェネレーター。
+        チャンクごとに「対象 − 所持者」の取得1回と一括登録1回のみを行う。
+        """
+        Through = CustomUser.current_coupons.through
+        missing = cls.missing_holders(coupon, users).order_by('pk').values_list('pk', flat=True)
+        while True:
+            user_ids = list(missing.filter(pk__gt=last_user_id)[:chunk_size])
+            if not user_ids:
+                return
+            Through.objects.bulk_create(
+                [Through(customuser_id=user_id, coupon_id=coupon.pk) for user_id in user_ids],
+                ignore_conflicts=True,
+            )
+            last_user_id = user_ids[-1]
+            transaction.on_commit(CouponStatsService.invalidate)
+            transaction.on_commit(lambda user_ids=user_ids: CouponEligibilityService.invalidate(user_ids))
+            yield last_user_id, len(user_ids)
+
+    @classmethod
+    def grant(cls, coupon, users=None, chunk_size=None):
+        """usersのうち未所持のユーザーにクーポンを付与し、付与人数を返す（usersの省略時は必要ポイントを満たす全員）"""
+        chunk_size = chunk_size or settings.COUPON_GRANT_CHUNK_SIZE
+        if users is None:
+            users = cls.qualifying_users(coupon)
+        return sum(count for _last_user_id, count in cls._grant_chunks(coupon, users, chunk_size))
+
+    @classmethod
+    def grant_rule_rewards(cls, chunk_size=None):
+        """
+        有効な特典ルールごとに、現在のランク・ポイントで受け取れるクーポンを未所持のユーザーへ付与する。
+        戻り値は {クーポン: 付与人数}。
+        """
+        granted = {}
+        for rule in RewardRule.objects.filter(is_active=True).select_related('coupon').order_by('pk'):
+            users = CustomUser.objects.filter(role='user')
+            if rule.kind == 'rank_reached':
+                users = users.filter(rank=rule.rank)
+            else:
+                users = users.filter(current_points__gte=rule.points)
+            granted[rule.coupon] = granted.get(rule.coupon, 0) + cls.grant(rule.coupon, users, chunk_size)
+        return granted
+
+    @classmethod
+    def schedule(cls, coupon, user=None, chunk_size=None):
+        """必要ポイントを満たす全員への付与をバックグラウンドジョブとして登録する"""
+        params = {'coupon_id': coupon.pk, 'coupon_title': coupon.title}
+        if chunk_size:
+            params['chunk_size'] = chunk_size
+        return BackgroundJobService.enqueue(cls.JOB_KIND, params=params, user=user)
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        coupon = Coupon.objects.get(pk=job.params['coupon_id'])
+        chunk_size = job.params.get('chunk_size', settings.COUPON_GRANT_CHUNK_SIZE)
+        users = cls.qualifying_users(coupon)
+        last_user_id = job.checkpoint.get('last_user_id', 0)
+        granted = job.checkpoint.get('granted', 0)
+        if not job.total:
+            job.update_progress(progress=granted, total=granted + cls.missing_holders(coupon, users).count())
+
+        chunks = cls._grant_chunks(coupon, users, chunk_size, last_user_id)
+        while True:
+            # 付与と進捗を同じトランザクションで保存し、中断しても続きから再開できるようにする
+            with transaction.atomic():
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                last_user_id, count = chunk
+                granted += count
+                job.update_progress(
+                    progress=granted, total=max(job.total, granted),
+                    checkpoint={'last_user_id': last_user_id, 'granted': granted},
+                )
+            if stdout:
+                stdout.write(f'{granted}/{job.total} 人に付与しました')
+        return {'coupon_id': coupon.pk, 'granted': granted}
+
+
+BackgroundJobService.register(CouponGrantService.JOB_KIND)(CouponGrantService.run)
+
+
+# --- Coupon Statistics ---
+
+class CouponStatsService:
+    """
+    スタッフホームのクーポン統計（発行数・利用数・自店利用数）を集計するサービスクラス。
+    全クーポン分を1回のクエリで集計し、店舗ごとにキャッシュする。
+    """
+
+    VERSION_CACHE_KEY = 'core:coupon_stats_version'
+
+    @staticmethod
+    def _count(queryset):
+        """クーポンごとの件数を返す相関サブクエリ（件数0は0に補う）"""
+        counts = queryset.order_by().values('coupon_id').annotate(count=Count('pk')).values('count')
+        return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+    @classmethod
+    def compute(cls, store=None):
+        """全クーポンの統計を1回のクエリで集計する。storeを指定すると自店での利用数も集計する"""
+        Through = CustomUser.current_coupons.through
+        coupons = Coupon.objects.annotate(
+            holders_count=cls._count(Through.objects.filter(coupon_id=OuterRef('pk'))),
+            usage_count=cls._count(CouponUsage.objects.filter(coupon_id=OuterRef('pk'))),
+        )
+        if store is not None:
+            coupons = coupons.annotate(
+                store_usage_count=cls._count(CouponUsage.objects.filter(coupon_id=OuterRef('pk'), store=store)))
+
+        stats = []
+        for coupon in coupons.order_by('pk'):
+            # 発行総数 = 所持者数 + 利用回数
+            issued_count = coupon.holders_count + coupon.usage_count
+            usage_ratio = coupon.usage_count / issued_count * 100 if issued_count else 0
+            stats.append({
+                'coupon': coupon,
+                'issued_count': issued_count,
+                'usage_count': coupon.usage_count,
+                'usage_ratio': round(usage_ratio, 1),
+                'store_usage_count': getattr(coupon, 'store_usage_count', coupon.usage_count),
+            })
+        return stats
+
+    @classmethod
+    def stats_for(cls, store=None):
+        """キャッシュ済みの統計を返す（storeごとに別のキャッシュ）"""
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(cls.VERSION_CACHE_KEY)
+        key = f'core:coupon_stats:{version}:{store.pk if store is not None else "all"}'
+        stats = cache.get(key)
+        if stats is None:
+            stats = cls.compute(store)
+            cache.set(key, stats, settings.COUPON_STATS_CACHE_TIMEOUT)
+        return stats
+
+    @classmethod
+    def invalidate(cls):
+        """付与・利用・クーポンの変更時に呼び出し、全店舗分のキャッシュを無効化する"""
+        cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+
+# --- Coupon Eligibility ---
+
+@dataclass(frozen=True)
+class CouponEligibility:
+    """ユーザーのクーポン関与状況（所持・使用済み・取得済みのポイント帯）"""
+    owned_ids: frozenset
+    used_ids: frozenset
+    owned_points: frozenset
+    used_points: frozenset
+
+    @property
+    def involved_ids(self):
+        return self.owned_ids | self.used_ids
+
+    def state(self, coupon):
+        """'owned' / 'used' / 'owned_tier' / 'used_tier' / 'available' のいずれかを返す"""
+        if coupon.pk in self.owned_ids:
+            return 'owned'
+        if coupon.pk in self.used_ids:
+            return 'used'
+        # 排他制御: 既に所持または使用済みのクーポンと同じ required_points のクーポンは取得できない
+        if coupon.required_points in self.owned_points:
+            return 'owned_tier'
+        if coupon.required_points in self.used_points:
+            return 'used_tier'
+        return 'available'
+
+
+class CouponEligibilityService:
+    """
+    ユーザーごとのクーポン取得可否を判定するサービスクラス。
+    関与したクーポン（所持・使用済み）を1回のクエリで求めてユーザー単位でキャッシュし、
+    付与・利用時にそのユーザーの分だけ無効化する。キャッシュは一覧表示用で、取得時の判定には使わない。
+    """
+
+    VERSION_CACHE_KEY = 'core:coupon_eligibility_version'
+
+    @classmethod
+    def _cache_key(cls, user_id):
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(cls.VERSION_CACHE_KEY)
+        return f'core:coupon_eligibility:{version}:{user_id}'
+
+    @staticmethod
+    def compute(user):
+        """所持・使用済みのクーポンとそのポイント帯を1回のクエリで求める"""
+        Through = CustomUser.current_coupons.through
+        involved = Coupon.objects.annotate(
+            owned=Exists(Through.objects.filter(customuser_id=user.pk, coupon_id=OuterRef('pk'))),
+            used=Exists(CouponUsage.objects.filter(user_id=user.pk, coupon_id=OuterRef('pk'))),
+        ).filter(Q(owned=True) | Q(used=True)).values_list('pk', 'required_points', 'owned', 'used')
+
+        owned_ids, used_ids, owned_points, used_points = set(), set(), set(), set()
+        for coupon_id, required_points, owned, used in involved:
+            if owned:
+                owned_ids.add(coupon_id)
+                owned_points.add(required_points)
+            if used:
+                used_ids.add(coupon_id)
+                used_points.add(required_points)
+        return CouponEligibility(*map(frozenset, (owned_ids, used_ids, owned_points, used_points)))
+
+    @classmethod
+    def for_user(cls, user):
+        """キャッシュ済みの関与状況を返す"""
+        key = cls._cache_key(user.pk)
+        eligibility = cache.get(key)
+        if eligibility is None:
+            eligibility = cls.compute(user)
+            cache.set(key, eligibility, settings.COUPON_ELIGIBILITY_CACHE_TIMEOUT)
+        return eligibility
+
+    @classmethod
+    def check(cls, user, coupon, eligibility=None):
+        """クーポンを取得できない理由を返す。取得できる場合はNone（eligibility省略時はキャッシュを使う）"""
+        if coupon.status != 'approved':
+            return 'not_approved'
+        state = (eligibility or cls.for_user(user)).state(coupon)
+        if state != 'available':
+            return state
+        if user.current_points < coupon.required_points:
+            return 'insufficient_points'
+        return None
+
+    @classmethod
+    def acquire(cls, user, coupon):
+        """
+        クーポンを所持クーポンに追加する。取得できない理由を返し、取得できた場合はNoneを返す。
+        キャッシュは他のワーカーの変更を反映していない場合があるため、判定はユーザー行をロックした
+        トランザクション内でキャッシュを使わずに行う（同じユーザーの同時取得は直列化される）。
+        """
+        with transaction.atomic():
+            locked = CustomUser.objects.select_for_update().get(pk=user.pk)
+            reason = cls.check(locked, coupon, cls.compute(locked))
+            if reason is None:
+                locked.current_coupons.add(coupon)
+        return reason
+
+    @classmethod
+    def coupons_for(cls, user):
+        """
+        所持・取得可能・使用済みのクーポンを1回のクエリで取得し、
+        (所持, 取得可能, 使用済み) に振り分けて返す。取得可能なクーポンは必要ポイント順。
+        """
+        eligibility = cls.for_user(user)
+        coupons = Coupon.objects.filter(
+            Q(status='approved') | Q(pk__in=eligibility.involved_ids)
+        ).prefetch_related('available_stores').order_by('required_points', 'pk')
+
+        owned, available, used = [], [], []
+        for coupon in coupons:
+            state = eligibility.state(coupon)
+            if state == 'owned':
+                owned.append(coupon)
+            elif state == 'used':
+                used.append(coupon)
+            elif state == 'available' and coupon.status == 'approved':
+                available.append(coupon)
+        return owned, available, used
+
+    @classmethod
+    def invalidate(cls, user_ids=None):
+        """指定ユーザーのキャッシュを無効化する（省略時はクーポン自体の変更として全ユーザー分）"""
+        if user_ids is None:
+            cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        else:
+            cache.delete_many([cls._cache_key(user_id) for user_id in user_ids])
+
+
+# --- Coupon Redemption ---
+
+class CouponRedemptionError(Exception):
+    """クーポンを利用できない場合に送出する例外。codeに理由を持つ"""
+
+    MESSAGES = {
+        'not_owned': 'このクーポンは所持していないか、既に利用済みです。',
+        'key_conflict': 'この冪等キーは別の利用で使用済みです。',
+        'invalid': '利用内容が正しくありません。',
+    }
+
+    def __init__(self, code):
+        self.code = code
+        super().__init__(self.MESSAGES[code])
+
+
+class CouponRedemptionService:
+    """
+    クーポン利用（所持クーポンの消費と利用履歴の記録）を行うサービスクラス。
+    所持クーポンの中間テーブル行を条件付きで削除し、削除できた1件だけが利用履歴を作成するため、
+    同時に送られた二重タップでも二重に利用されない。冪等キー付きの再送は最初の結果を返す。
+    """
+
+    @staticmethod
+    def _replay(user_id, coupon_id, idempotency_key):
+        """冪等キーで記録済みの利用を返す（なければNone）"""
+        usage = CouponUsage.objects.filter(idempotency_key=idempotency_key).first()
+        if usage is not None and (usage.user_id, usage.coupon_id) != (user_id, coupon_id):
+            raise CouponRedemptionError('key_conflict')
+        return usage
+
+    @classmethod
+    def redeem(cls, user_id, coupon_id, store_id=None, idempotency_key=None, rank=None):
+        """
+        クーポンを1件利用し、(利用履歴, 再送かどうか) を返す。rankは利用者の現在のランク（省略時は読み直す）。
+        利用できない場合は CouponRedemptionError を送出する。
+        """
+        if idempotency_key:
+            usage = cls._replay(user_id, coupon_id, idempotency_key)
+            if usage is not None:
+                return usage, True
+
+        Through = CustomUser.current_coupons.through
+        try:
+            with transaction.atomic():
+                # 条件付き削除: 所持行を削除できた処理だけが利用を記録する（同時実行の後続は0件になる）
+                deleted, _ = Through.objects.filter(customuser_id=user_id, coupon_id=coupon_id).delete()
+                if not deleted:
+                    raise CouponRedemptionError('not_owned')
+                usage = CouponUsage(
+                    user_id=user_id, coupon_id=coupon_id, store_id=store_id, idempotency_key=idempotency_key or None)
+                # 集計行に記録するランク（呼び出し元で読み込み済みの場合はランクの再取得を省く）
+                usage.user_rank = rank
+                usage.save()
+        except (CouponRedemptionError, IntegrityError):
+            # 同じ冪等キーの同時送信: 先に記録された利用があればそれを返す（こちらの変更はロールバック済み）
+            usage = cls._replay(user_id, coupon_id, idempotency_key) if idempotency_key else None
+            if usage is None:
+                raise
+            return usage, True
+        return usage, False
+
+    @classmethod
+    def redeem_batch(cls, redemptions, store_id=None):
+        """
+        POS端末から同期された複数の利用をまとめて処理し、1件ごとの結果を返す。
+        各要素は {'user_id', 'coupon_id', 'idempotency_key'} で、1件の失敗は他の利用に影響しない。
+        """
+        results = []
+        # 利用者のランクはまとめて1回で読み込む
+        user_ids = set()
+        for redemption in redemptions:
+            try:
+                user_ids.add(int(redemption['user_id']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        ranks = dict(CustomUser.objects.filter(pk__in=user_ids).values_list('pk', 'rank'))
+        for redemption in redemptions:
+            result = {'idempotency_key': redemption.get('idempotency_key')}
+            try:
+                user_id = int(redemption['user_id'])
+                usage, replayed = cls.redeem(
+                    user_id, int(redemption['coupon_id']),
+                    store_id=store_id, idempotency_key=redemption.get('idempotency_key'), rank=ranks.get(user_id),
+                )
+            except CouponRedemptionError as e:
+                result.update(success=False, error=e.code)
+            except (KeyError, TypeError, ValueError, IntegrityError):
+                result.update(success=False, error='invalid')
+            else:
+                result.update(success=True, usage_id=usage.pk, replayed=replayed)
+            results.append(result)
+        return results
+
+
+# --- Coupon Tokens ---
+
+class CouponTokenService:
+    """
+    店舗端末でオフライン検証できる署名付きクーポントークンの発行と、利用報告の受け付けを行うサービスクラス。
+    報告された利用はバックグラウンドジョブでまとめて記録し、トークンのノンスを冪等キーとして再利用を拒否する。
+    """
+
+    JOB_KIND = 'redeem_coupon_tokens'
+
+    @staticmethod
+    def key():
+        """店舗端末と共有する署名鍵"""
+        return settings.COUPON_TOKEN_KEY or salted_hmac('core.coupon_tokens', 'key').hexdigest()
+
+    @classmethod
+    def issue(cls, user, coupons):
+        """所持クーポンごとのトークンを {クーポンID: トークン} で返す（DBアクセスなし）"""
+        key = cls.key()
+        now = int(timezone.now().timestamp())
+        return {
+            coupon.pk: issue_token(user.pk, coupon.pk, key, settings.COUPON_TOKEN_TTL, now=now)
+            for coupon in coupons
+        }
+
+    @classmethod
+    def report(cls, tokens, store_id=None, user=None):
+        """
+        店舗端末から報告されたトークンを検証し、正しいものの利用記録をジョブとして登録する。
+        戻り値は (ジョブ, 受け付けた件数, [{'index', 'error'}])。受け付けた件数が0ならジョブはNone。
+        """
+        key = cls.key()
+        now = timezone.now().timestamp()
+        redemptions, rejected = [], []
+        for index, token in enumerate(tokens):
+            try:
+                claims = verify_token(token, key, now=now, leeway=settings.COUPON_TOKEN_REPORT_GRACE)
+            except CouponTokenError as e:
+                rejected.append({'index': index, 'error': e.code})
+                continue
+            redemptions.append({
+                'user_id': claims.user_id, 'coupon_id': claims.coupon_id, 'idempotency_key': claims.nonce,
+            })
+        if not redemptions:
+            return None, 0, rejected
+        job = BackgroundJobService.enqueue(
+            cls.JOB_KIND, params={'store_id': store_id, 'redemptions': redemptions}, user=user)
+        return job, len(redemptions), rejected
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        results = CouponRedemptionService.redeem_batch(job.params['redemptions'], store_id=job.params.get('store_id'))
+        redeemed = sum(1 for result in results if result['success'] and not result['replayed'])
+        replayed = sum(1 for result in results if result['success'] and result['replayed'])
+        job.update_progress(progress=len(results), total=len(results))
+        if stdout:
+            stdout.write(f'{redeemed} 件を記録しました（再送 {replayed} 件 / 失敗 {len(results) - redeemed - replayed} 件）')
+        return {'redeemed': redeemed, 'replayed': replayed, 'results': results}
+
+
+BackgroundJobService.register(CouponTokenService.JOB_KIND)(CouponTokenService.run)
+
+
+# --- Coupon Usage Rollups ---
+
+class CouponUsageRollupService:
+    """
+    クーポン利用数を クーポン × 店舗 × ランク × 時間/日 の単位で集計するサービスクラス。
+    利用の記録時に該当する集計行を加算し、統計画面は利用履歴ではなく集計行から読む。
+    """
+
+    TRUNCATE = {'hour': TruncHour, 'day': TruncDay}
+
+    @staticmethod
+    def buckets(used_at):
+        """利用日時が属する各集計期間の開始日時（現在のタイムゾーン）"""
+        hour = timezone.localtime(used_at).replace(minute=0, second=0, microsecond=0)
+        return {'hour': hour, 'day': hour.replace(hour=0)}
+
+    @classmethod
+    def record(cls, usage, rank):
+        """利用1件を時間・日の集計行に加算する"""
+        for granularity, bucket in cls.buckets(usage.used_at).items():
+            key = {
+                'coupon_id': usage.coupon_id, 'store_id': usage.store_id, 'rank': rank or '',
+                'granularity': granularity, 'bucket': bucket,
+            }
+            if CouponUsageRollup.objects.filter(**key).update(count=F('count') + 1):
+                continue
+            try:
+                with transaction.atomic():
+                    CouponUsageRollup.objects.create(count=1, **key)
+            except IntegrityError:
+                # 同時に作成された場合は加算し直す
+                CouponUsageRollup.objects.filter(**key).update(count=F('count') + 1)
+
+    @classmethod
+    def rebuild(cls, coupon_ids=None):
+        """利用履歴から集計行を作り直し、作成した行数を返す（ランクは現在のランクで集計する）"""
+        usages = CouponUsage.objects.all()
+        rollups = CouponUsageRollup.objects.all()
+        if coupon_ids is not None:
+            usages = usages.filter(coupon_id__in=coupon_ids)
+            rollups = rollups.filter(coupon_id__in=coupon_ids)
+
+        with transaction.atomic():
+            rollups.delete()
+            created = 0
+            for granularity, truncate in cls.TRUNCATE.items():
+                rows = usages.values('coupon_id', 'store_id', 'user__rank', bucket=truncate('used_at')) \
+                    .annotate(count=Count('pk')).order_by()
+                created += len(CouponUsageRollup.objects.bulk_create([
+                    CouponUsageRollup(
+                        coupon_id=row['coupon_id'], store_id=row['store_id'], rank=row['user__rank'] or '',
+                        granularity=granularity, bucket=row['bucket'], count=row['count'],
+                    ) for row in rows
+                ], batch_size=1000))
+        return created
+
+    @staticmethod
+    def _rollups(coupon, store=None):
+        rollups = CouponUsageRollup.objects.filter(coupon=coupon)
+        if store is not None:
+            rollups = rollups.filter(store=store)
+        return rollups
+
+    @classmethod
+    def total(cls, coupon, store=None):
+        """日単位の集計行から利用数の合計を返す"""
+        return cls._rollups(coupon, store).filter(granularity='day').aggregate(total=Sum('count'))['total'] or 0
+
+    @classmethod
+    def breakdown(cls, coupon, field, store=None):
+        """日単位の集計行からfield（'rank' や 'store__store_name'）ごとの利用数を返す"""
+        return list(
+            cls._rollups(coupon, store).filter(granularity='day').values(field)
+            .annotate(total=Sum('count')).order_by(field).values_list(field, 'total')
+        )
+
+    @classmethod
+    def timeline(cls, coupon, granularity, periods, store=None, now=None):
+        """直近periods期間分の利用数を [(期間の開始, 利用数)] で返す（利用のない期間は0）"""
+        step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+        latest = cls.buckets(now or timezone.now())[granularity]
+        starts = [latest - step * i for i in reversed(range(periods))]
+        totals = dict(
+            cls._rollups(coupon, store).filter(granularity=granularity, bucket__gte=starts[0])
+            .values('bucket').annotate(total=Sum('count')).values_list('bucket', 'total')
+        )
+        return [(start, totals.get(start, 0)) for start in starts]
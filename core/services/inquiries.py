@@ -1,13 +1,23 @@
+"""
+お問い合わせの受付・返信と、メール返信の取り込み。
+"""
+import email
+import imaplib
 import os
+import re
 import uuid
+from email.header import decode_header
+
 from django.conf import settings
-from django.core.files.storage import FileSystemStorage
 from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.utils import timezone
-from core.models import Inquiry, InquiryMessage
+
 from core.forms import InquiryForm
+from core.models import Inquiry, InquiryMessage
+
 
 class InquiryService:
     """
@@ -110,11 +120,6 @@ class InquiryService:
 
 # --- Email Service ---
 
-import imaplib
-import email
-from email.header import decode_header
-import re
-
 class InquiryEmailService:
     """
     問い合わせメールの取り込みと処理を行うサービスクラス。
@@ -0,0 +1,106 @@
+"""
+BackgroundJobテーブルを用いた簡易ジョブキュー。
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from core.models import BackgroundJob
+
+logger = logging.getLogger('core')
+
+
+class BackgroundJobService:
+    """
+    BackgroundJobテーブルを用いた簡易ジョブキュー。
+    種別ごとのハンドラをregisterで登録し、run_jobsコマンドが待機中のジョブを実行する。
+    ハンドラはjob.checkpointを参照して中断した位置から再開できるようにする。
+    """
+
+    handlers = {}
+
+    @classmethod
+    def register(cls, kind):
+        def decorator(handler):
+            cls.handlers[kind] = handler
+            return handler
+        return decorator
+
+    @staticmethod
+    def enqueue(kind, params=None, user=None, coalesce=False):
+        """
+        ジョブを登録する。coalesce=Trueの場合、同じ種別・パラメータの待機中ジョブがあればそれを返す。
+        """
+        params = params or {}
+        if coalesce:
+            for job in BackgroundJob.objects.filter(kind=kind, status='pending').order_by('pk'):
+                if job.params == params:
+                    return job
+        return BackgroundJob.objects.create(kind=kind, params=params, user=user)
+
+    @staticmethod
+    def claim(kinds=None, job_id=None):
+        """待機中のジョブを1件取得して実行中にする。他のワーカーと競合した場合は次を探す。"""
+        queryset = BackgroundJob.objects.filter(status='pending').order_by('pk')
+        if kinds:
+            queryset = queryset.filter(kind__in=kinds)
+        if job_id:
+            queryset = queryset.filter(pk=job_id)
+        for pk in queryset.values_list('pk', flat=True)[:20]:
+            claimed = BackgroundJob.objects.filter(pk=pk, status='pending').update(
+                status='running', started_at=timezone.now(), updated_at=timezone.now())
+            if claimed:
+                return BackgroundJob.objects.get(pk=pk)
+        return None
+
+    @classmethod
+    def execute(cls, job, **options):
+        """ジョブを実行し、結果またはエラーを記録する。optionsはハンドラへそのまま渡す。"""
+        handler = cls.handlers.get(job.kind)
+        try:
+            if handler is None:
+                raise ValueError(f"未登録のジョブ種別です: {job.kind}")
+            result = handler(job, **options)
+        except Exception as e:
+            logger.exception(f"Background job {job.pk} ({job.kind}) failed")
+            job.status = 'failed'
+            job.error = str(e)
+        else:
+            job.status = 'completed'
+            job.result = result
+            job.error = ''
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'result', 'error', 'finished_at', 'updated_at'])
+        return job
+
+    @staticmethod
+    def requeue(job):
+        """失敗・中断したジョブを待機中に戻す。チェックポイントは保持するため続きから再開される。"""
+        job.status = 'pending'
+        job.error = ''
+        job.finished_at = None
+        job.save(update_fields=['status', 'error', 'finished_at', 'updated_at'])
+        return job
+
+    @staticmethod
+    def resumable(kind, stale_minutes=None):
+        """
+        --resumeで再開できる直近のジョブを返す。
+        失敗したジョブと、一定時間更新のない実行中ジョブ（ワーカー停止など）のみを対象とし、
+        他のワーカーで実行中のジョブを二重に実行しないようにする。
+        """
+        if stale_minutes is None:
+            stale_minutes = settings.BACKGROUND_JOB_STALE_MINUTES
+        threshold = timezone.now() - timedelta(minutes=stale_minutes)
+        return BackgroundJob.objects.filter(kind=kind).filter(
+            Q(status='failed') | Q(status='running', updated_at__lt=threshold)).order_by('-pk').first()
+
+    @staticmethod
+    def requeue_stale(minutes):
+        """一定時間更新のない実行中ジョブ（ワーカー停止など）を待機中に戻す"""
+        threshold = timezone.now() - timedelta(minutes=minutes)
+        return BackgroundJob.objects.filter(status='running', updated_at__lt=threshold).update(
+            status='pending', updated_at=timezone.now())
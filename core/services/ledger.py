@@ -0,0 +1,111 @@
+"""
+ポイント台帳と月替わりのポイントリセット。
+"""
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from core.models import PointTransaction
+from core.rewards import get_reward_engine
+
+
+class PointLedgerService:
+    """
+    ポイントの増減をPointTransactionに記録し、ユーザー残高へ反映するサービスクラス。
+    """
+
+    @staticmethod
+    def apply_bulk(entries, reason):
+        """
+        (user_id, delta, receipt_id) のリストを台帳に一括登録し、残高とランクを更新する。
+        ユーザー数に関わらず、残高とランクはそれぞれ1回のUPDATEで反映する。
+        更新後の残高で閾値を超えたユーザーには特典を付与する。
+        """
+        entries = [entry for entry in entries if entry[1]]
+        if not entries:
+            return {}
+
+        PointTransaction.objects.bulk_create([
+            PointTransaction(user_id=user_id, delta=delta, receipt_id=receipt_id, reason=reason)
+            for user_id, delta, receipt_id in entries
+        ])
+
+        totals = {}
+        for user_id, delta, _receipt_id in entries:
+            totals[user_id] = totals.get(user_id, 0) + delta
+        users = CustomUser.objects.filter(pk__in=totals)
+        users.update(current_points=F('current_points') + Case(
+            *[When(pk=user_id, then=Value(delta)) for user_id, delta in totals.items()],
+            default=Value(0),
+        ))
+        users.update(rank=CustomUser.rank_expression())
+
+        # 加算されたユーザーの新しい残高を1回で読み出し、特典はまとめて付与する
+        gained = [user_id for user_id, delta in totals.items() if delta > 0]
+        if gained:
+            get_reward_engine().grant([
+                (user_id, points - totals[user_id], points, None)
+                for user_id, points in CustomUser.objects.filter(pk__in=gained).values_list('pk', 'current_points')
+            ])
+        return totals
+
+
+# --- Monthly Rollover ---
+
+class MonthlyRolloverService:
+    """
+    月替わりのポイントリセットを、全ユーザー分まとめて数回のSQLで行うサービスクラス。
+    last_reset_monthが対象月より前のユーザーだけを更新するため、何度実行しても結果は変わらない。
+    """
+
+    # 台帳へ一括登録する1バッチのユーザー数
+    BATCH_SIZE = 1000
+
+    @staticmethod
+    def month_start(day=None):
+        """指定日（省略時は今日）の月初日を返す"""
+        return (day or timezone.localdate()).replace(day=1)
+
+    @classmethod
+    def rollover(cls, month_start=None, user_ids=None):
+        """
+        先月ポイントの記録・残高リセット・ランク再計算・リセット月の記録を行う。
+        - 未導入のユーザー (last_reset_monthが空) はリセットせず、対象月を記録するのみ
+        - 残高が0でないユーザーは、リセット分を台帳に 'rollover' として記録する
+        戻り値は {'reset': リセットした人数, 'initialized': 記録のみ行った人数}。
+        """
+        month_start = month_start or cls.month_start()
+        users = CustomUser.objects.filter(role='user')
+        if user_ids is not None:
+            users = users.filter(pk__in=user_ids)
+        due = users.filter(last_reset_month__lt=month_start)
+
+        with transaction.atomic():
+            cls._record_rollover_transactions(due)
+            # SETの右辺は更新前の値で評価されるため、先月ポイントにはリセット前の残高が入る
+            reset = due.update(
+                lastmonth_point=F('current_points'),
+                current_points=0,
+                rank=CustomUser.rank_expression(Value(0)),
+                last_reset_month=month_start,
+            )
+            initialized = users.filter(last_reset_month__isnull=True).update(last_reset_month=month_start)
+        return {'reset': reset, 'initialized': initialized}
+
+    @classmethod
+    def _record_rollover_transactions(cls, due):
+        """
+        リセット対象ユーザーの残高の打ち消しを、ユーザーID順のバッチで台帳に一括登録する。
+        残高を読んでからリセットするまでに加算されないよう、対象ユーザーの行をロックする。
+        """
+        users = due.exclude(current_points=0).select_for_update().order_by('pk')
+        last_id = 0
+        while True:
+            rows = list(users.filter(pk__gt=last_id).values_list('pk', 'current_points')[:cls.BATCH_SIZE])
+            PointTransaction.objects.bulk_create([
+                PointTransaction(user_id=user_id, delta=-points, reason='rollover') for user_id, points in rows
+            ])
+            if len(rows) < cls.BATCH_SIZE:
+                break
+            last_id = rows[-1][0]
@@ -0,0 +1,536 @@
+"""
+レシートの保存・重複検出と、エコ商品カタログの変更・解析ロジックの更新に伴う再採点・再解析。
+"""
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from core.image_hash import hamming_distance
+from core.matching import EcoProductMatcher, catalog_entries, init_scoring_worker, score_item_rows
+from core.models import EcoProduct, Product, Receipt, ReceiptItem
+from core.receipt_parser import (
+    PARSER_VERSION, compute_minhash_bands, compute_ocr_fingerprint, parse_receipt_rows, shingle_similarity,
+)
+from core.services.jobs import BackgroundJobService
+from core.services.ledger import PointLedgerService
+from core.services.summaries import UserMonthlySummaryService
+
+
+_eco_matcher_lock = threading.Lock()
+_eco_matcher_cache = {'signature': None, 'matcher': None}
+
+
+def get_eco_product_matcher():
+    """
+    承認済みエコ商品から構築したマッチャーを返す。
+    カタログの件数と最終更新日時が変わった場合のみ再構築する。
+    """
+    approved = EcoProduct.objects.filter(status='approved')
+    signature = tuple(approved.aggregate(count=Count('id'), updated=Max('updated_at')).values())
+    with _eco_matcher_lock:
+        if _eco_matcher_cache['signature'] != signature:
+            _eco_matcher_cache['matcher'] = EcoProductMatcher(approved.order_by('pk'))
+            _eco_matcher_cache['signature'] = signature
+        return _eco_matcher_cache['matcher']
+
+
+# --- Receipt Service ---
+
+class DuplicateReceiptError(Exception):
+    """同じ内容のレシートが既に登録されている場合に送出される"""
+
+
+class ReceiptService:
+    """
+    スキャンしたレシートの保存に関するビジネスロジックを管理するサービスクラス。
+    """
+
+    @staticmethod
+    def build_receipt_items(items, store_id, matcher=None):
+        """
+        パース済み商品リストからReceiptItem（未保存・product未設定）と合計ポイントを求める。
+        商品名が空の行は除外する。
+        """
+        matcher = matcher or get_eco_product_matcher()
+        receipt_items = []
+        total_points = 0
+        for item_data in items or []:
+            # 商品名が空の場合はスキップ
+            if not item_data.get('name'):
+                continue
+            receipt_item = ReceiptItem(
+                quantity=item_data.get('quantity', 1),
+                price=item_data.get('price', 0),
+            )
+            # 部分一致を優先し、OCRの誤字は類似度判定で補う
+            eco_product, _score = matcher.match(item_data['name'], store_id)
+            if eco_product:
+                receipt_item.points = eco_product.points * receipt_item.quantity # 数量分ポイント加算
+                total_points += receipt_item.points
+            receipt_items.append((item_data['name'], receipt_item))
+        return receipt_items, total_points
+
+    @staticmethod
+    def resolve_product_ids(names):
+        """商品マスターを一括登録（既存の商品名は無視）し、商品名からIDへの辞書を返す"""
+        if not names:
+            return {}
+        Product.objects.bulk_create([Product(name=name) for name in names], ignore_conflicts=True)
+        return dict(Product.objects.filter(name__in=names).values_list('name', 'id'))
+
+    @staticmethod
+    def is_duplicate(user, ocr_text):
+        """同じOCRテキストのレシートが登録済みかを、指紋のインデックス参照1回で判定する"""
+        fingerprint = compute_ocr_fingerprint(ocr_text)
+        return fingerprint is not None and Receipt.objects.filter(user=user, ocr_fingerprint=fingerprint).exists()
+
+    @staticmethod
+    def minhash_band_values(ocr_text):
+        """OCRテキストのMinHashバンド値をReceiptのフィールド名をキーとする辞書で返す"""
+        bands = compute_minhash_bands(ocr_text) or [None] * len(Receipt.MINHASH_BAND_FIELDS)
+        return dict(zip(Receipt.MINHASH_BAND_FIELDS, bands))
+
+    @staticmethod
+    def find_near_duplicate(user, ocr_text, store=None, transaction_time=None, min_similarity=None):
+        """
+        撮り直しなどでOCRテキストがわずかに異なる同一レシートを探す。
+        ユーザーの履歴（店舗と取引日が分かる場合は同じ店舗・同日の全レシートも）から、
+        MinHashバンドのいずれかが一致するものだけをインデックス経由で取得し、文字シングルの類似度で確認する。
+        """
+        if min_similarity is None:
+            min_similarity = settings.RECEIPT_NEAR_DUPLICATE_SIMILARITY
+        bands = compute_minhash_bands(ocr_text)
+        if bands is None:
+            return None
+
+        band_match = Q()
+        for field, value in zip(Receipt.MINHASH_BAND_FIELDS, bands):
+            band_match |= Q(**{field: value})
+        scope = Q(user=user)
+        if store is not None and transaction_time is not None:
+            if timezone.is_aware(transaction_time):
+                transaction_time = timezone.localtime(transaction_time)
+            scope |= Q(store=store, transaction_time__date=transaction_time.date())
+
+        for candidate in Receipt.objects.filter(band_match).filter(scope).only('id', 'ocr_text'):
+            if shingle_similarity(ocr_text, candidate.ocr_text) >= min_similarity:
+                return candidate
+        return None
+
+    @staticmethod
+    def find_similar_image(user, image_hash, max_distance=None, lookback=None):
+        """
+        ユーザーの直近のレシートから、画像ハッシュのハミング距離が近いものを探してIDを返す。
+        OCRの前に呼び出し、同じレシートの再アップロードにOCR時間を使わないようにする。
+        """
+        if image_hash is None:
+            return None
+        if max_distance is None:
+            max_distance = settings.RECEIPT_IMAGE_HASH_MAX_DISTANCE
+        if lookback is None:
+            lookback = settings.RECEIPT_IMAGE_HASH_LOOKBACK
+        recent = (Receipt.objects.filter(user=user, image_hash__isnull=False)
+                  .order_by('-pk').values_list('pk', 'image_hash')[:lookback])
+        for receipt_id, other_hash in recent:
+            if hamming_distance(image_hash, other_hash) <= max_distance:
+                return receipt_id
+        return None
+
+    @staticmethod
+    def find_near_duplicate_clusters(min_similarity=None, same_user=False, max_bucket=200, chunk_size=2000):
+        """
+        レシート全体から、撮り直しなどによる重複登録のクラスタを検出する。
+        同じMinHashバンド値を持つレシート同士だけを候補ペアとし、文字シングルの類似度で確認してから併合する。
+        テンプレート的なOCR結果で膨らんだバンドは max_bucket 件で打ち切る。
+        戻り値は (レシートIDのリストのリスト（大きい順）, 統計の辞書)。
+        """
+        if min_similarity is None:
+            min_similarity = settings.RECEIPT_NEAR_DUPLICATE_SIMILARITY
+        fields = Receipt.MINHASH_BAND_FIELDS
+        buckets = {}
+        pairs = set()
+        truncated = set()
+        stats = {'scanned': 0, 'candidate_pairs': 0, 'confirmed_pairs': 0, 'truncated_buckets': 0}
+
+        rows = (Receipt.objects.filter(minhash_band0__isnull=False).order_by('pk')
+                .values_list('pk', 'user_id', *fields).iterator(chunk_size=chunk_size))
+        for receipt_id, user_id, *bands in rows:
+            stats['scanned'] += 1
+            for band, value in enumerate(bands):
+                bucket = buckets.setdefault((band, value), [])
+                for other_id, other_user_id in bucket:
+                    if not same_user or other_user_id == user_id:
+                        pairs.add((other_id, receipt_id))
+                if len(bucket) < max_bucket:
+                    bucket.append((receipt_id, user_id))
+                else:
+                    truncated.add((band, value))
+        buckets.clear()
+        stats['truncated_buckets'] = len(truncated)
+        stats['candidate_pairs'] = len(pairs)
+
+        # 候補に含まれるレシートのOCRテキストだけを読み込み、類似度で確認する
+        candidate_ids = sorted({receipt_id for pair in pairs for receipt_id in pair})
+        texts = {}
+        for start in range(0, len(candidate_ids), chunk_size):
+            chunk = candidate_ids[start:start + chunk_size]
+            texts.update(Receipt.objects.filter(pk__in=chunk).values_list('pk', 'ocr_text'))
+
+        parent = {}
+
+        def find(receipt_id):
+            parent.setdefault(receipt_id, receipt_id)
+            while parent[receipt_id] != receipt_id:
+                parent[receipt_id] = parent[parent[receipt_id]]
+                receipt_id = parent[receipt_id]
+            return receipt_id
+
+        for a, b in sorted(pairs):
+            if shingle_similarity(texts[a], texts[b]) >= min_similarity:
+                stats['confirmed_pairs'] += 1
+                root_a, root_b = find(a), find(b)
+                if root_a != root_b:
+                    parent[max(root_a, root_b)] = min(root_a, root_b)
+
+        clusters = {}
+        for receipt_id in parent:
+            clusters.setdefault(find(receipt_id), []).append(receipt_id)
+        clusters = sorted((sorted(ids) for ids in clusters.values() if len(ids) > 1), key=lambda ids: (-len(ids), ids[0]))
+        return clusters, stats
+
+    @staticmethod
+    def save_scanned_receipt(user, image_url, ocr_text, parsed_data, store=None, image_hash=None):
+        """
+        レシート本体・商品マスター・明細を保存し、獲得ポイントをユーザーに付与する。
+        明細の件数に関わらずクエリ数が一定になるよう、商品と明細は一括登録する。
+        同時アップロードによる重複はOCR指紋の一意制約で検出し、DuplicateReceiptErrorを送出する。
+        """
+        fingerprint = compute_ocr_fingerprint(ocr_text)
+        receipt_items, total_points = ReceiptService.build_receipt_items(
+            parsed_data.get('items'), store.pk if store else None)
+        names = list(dict.fromkeys(name for name, _item in receipt_items))
+
+        # parsed_dataからdatetimeオブジェクトを除いて保存する
+        data_to_save = parsed_data.copy()
+        data_to_save.pop('transaction_time', None)
+
+        try:
+            with transaction.atomic():
+                product_ids = ReceiptService.resolve_product_ids(names)
+
+                receipt = Receipt.objects.create(
+                    user=user,
+                    image_url=image_url,
+                    ocr_text=ocr_text,
+                    store=store,
+                    transaction_time=parsed_data.get('transaction_time'),
+                    parsed_data=data_to_save,
+                    points_earned=total_points,
+                    parser_version=PARSER_VERSION,
+                    ocr_fingerprint=fingerprint,
+                    image_hash=image_hash,
+                    **ReceiptService.minhash_band_values(ocr_text),
+                )
+
+                for name, receipt_item in receipt_items:
+                    receipt_item.receipt = receipt
+                    receipt_item.product_id = product_ids[name]
+                ReceiptItem.objects.bulk_create([receipt_item for _name, receipt_item in receipt_items])
+                UserMonthlySummaryService.record_receipt(receipt, receipt_items)
+
+                # 合計ポイントを加算してユーザー情報を更新
+                if total_points > 0:
+                    user.add_points(total_points, reason='scan', receipt=receipt)
+        except IntegrityError:
+            if fingerprint and Receipt.objects.filter(user=user, ocr_fingerprint=fingerprint).exists():
+                raise DuplicateReceiptError('このレシート（画像内容）は既に登録済みです。')
+            raise
+
+        return receipt
+
+
+# --- Receipt Rescoring ---
+
+class ReceiptRescoreService:
+    """
+    エコ商品カタログの変更後、過去のレシート明細を再採点するサービスクラス。
+    明細を主キー順のチャンクで読み出して採点はワーカープロセスで並列に行い、
+    変化した明細のみを一括で書き戻す。チェックポイントは書き込みと同じトランザクションで保存する。
+    """
+
+    JOB_KIND = 'rescore_receipts'
+
+    @classmethod
+    def schedule(cls):
+        """再採点ジョブを登録する。待機中のジョブがあれば新たには登録しない。"""
+        return BackgroundJobService.enqueue(cls.JOB_KIND, coalesce=True)
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        chunk_size = job.params.get('chunk_size', getattr(settings, 'RESCORE_CHUNK_SIZE', 1000))
+        workers = job.params.get('workers', getattr(settings, 'RESCORE_WORKERS', 1))
+        pause = job.params.get('pause', getattr(settings, 'RESCORE_PAUSE_SECONDS', 0.05))
+
+        matcher = get_eco_product_matcher()
+        last_id = job.checkpoint.get('last_item_id', 0)
+        if not job.total:
+            job.update_progress(total=ReceiptItem.objects.count())
+
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=init_scoring_worker,
+                initargs=(catalog_entries(matcher.eco_products), matcher.threshold, matcher.index.n),
+            )
+        try:
+            while True:
+                # ワーカー数分のチャンクを先読みする
+                chunks = []
+                for _ in range(max(workers, 1)):
+                    rows = list(
+                        ReceiptItem.objects.filter(pk__gt=last_id).order_by('pk').values_list(
+                            'pk', 'product__name', 'quantity', 'receipt__store_id', 'points')[:chunk_size]
+                    )
+                    if not rows:
+                        break
+                    chunks.append(rows)
+                    last_id = rows[-1][0]
+                if not chunks:
+                    break
+
+                if executor:
+                    results = executor.map(score_item_rows, chunks)
+                else:
+                    results = (score_item_rows(rows, matcher) for rows in chunks)
+                for rows, changes in zip(chunks, results):
+                    cls._apply_chunk(job, rows, changes)
+                    if stdout:
+                        stdout.write(f"{job.progress}/{job.total} 件処理 (変更 {job.checkpoint['changed_items']} 件)")
+                    # Webワーカーを圧迫しないよう、チャンクごとに待機する
+                    if pause:
+                        time.sleep(pause)
+        finally:
+            if executor:
+                executor.shutdown()
+
+        return {
+            'processed': job.progress,
+            'changed_items': job.checkpoint.get('changed_items', 0),
+            'point_delta': job.checkpoint.get('point_delta', 0),
+        }
+
+    @staticmethod
+    def _apply_chunk(job, rows, changes):
+        """1チャンク分の再採点結果を反映し、チェックポイントを進める"""
+        checkpoint = dict(job.checkpoint)
+        with transaction.atomic():
+            if changes:
+                new_points = dict(changes)
+                items = list(ReceiptItem.objects.filter(pk__in=new_points).only('pk', 'receipt_id', 'points', 'quantity'))
+                receipt_deltas = {}
+                eco_quantity_deltas = {}
+                for item in items:
+                    delta = new_points[item.pk] - item.points
+                    receipt_deltas[item.receipt_id] = receipt_deltas.get(item.receipt_id, 0) + delta
+                    # エコ商品になった・外れた明細の数量
+                    became_eco = (new_points[item.pk] > 0) - (item.points > 0)
+                    eco_quantity_deltas[item.receipt_id] = (
+                        eco_quantity_deltas.get(item.receipt_id, 0) + became_eco * item.quantity)
+                    item.points = new_points[item.pk]
+                ReceiptItem.objects.bulk_update(items, ['points'])
+
+                receipts = list(Receipt.objects.filter(pk__in=receipt_deltas).only('pk', 'user_id', 'points_earned', 'scanned_at'))
+                summary_deltas = {}
+                for receipt in receipts:
+                    receipt.points_earned += receipt_deltas[receipt.pk]
+                    key = (receipt.user_id, UserMonthlySummaryService.month_of(receipt.scanned_at))
+                    points, quantity = summary_deltas.get(key, (0, 0))
+                    summary_deltas[key] = (points + receipt_deltas[receipt.pk], quantity + eco_quantity_deltas[receipt.pk])
+                Receipt.objects.bulk_update(receipts, ['points_earned'])
+                UserMonthlySummaryService.apply_deltas(summary_deltas)
+
+                # 所持ポイントは月ごとにリセットされるため、今月のレシート分のみ残高へ反映する
+                month_start = timezone.localdate().replace(day=1)
+                PointLedgerService.apply_bulk(
+                    [(receipt.user_id, receipt_deltas[receipt.pk], receipt.pk)
+                     for receipt in receipts if receipt.scanned_at >= month_start],
+                    reason='rescore',
+                )
+                checkpoint['changed_items'] = checkpoint.get('changed_items', 0) + len(items)
+                checkpoint['point_delta'] = checkpoint.get('point_delta', 0) + sum(receipt_deltas.values())
+
+            checkpoint['last_item_id'] = rows[-1][0]
+            checkpoint.setdefault('changed_items', 0)
+            checkpoint.setdefault('point_delta', 0)
+            job.update_progress(progress=job.progress + len(rows), checkpoint=checkpoint)
+
+
+BackgroundJobService.register(ReceiptRescoreService.JOB_KIND)(ReceiptRescoreService.run)
+
+
+# --- Receipt Reparsing ---
+
+class ReceiptReparseService:
+    """
+    保存済みのOCRテキストを現在の解析ロジックで再解析するサービスクラス。
+    再OCRは行わず、parser_versionが古いレシートを主キー順のチャンクで読み出し、
+    解析はワーカープロセスで並列に行って差分を一括で反映する。
+    """
+
+    JOB_KIND = 'reparse_receipts'
+
+    @classmethod
+    def schedule(cls, params=None, user=None):
+        return BackgroundJobService.enqueue(cls.JOB_KIND, params=params, user=user, coalesce=True)
+
+    @staticmethod
+    def diff(receipt, parsed):
+        """既存の解析結果と再解析結果を比較し、変化した項目をフラグで返す"""
+        old = receipt.parsed_data if isinstance(receipt.parsed_data, dict) else {}
+        old_items = old.get('items') or (receipt.parsed_data if isinstance(receipt.parsed_data, list) else [])
+        return {
+            'items': old_items != parsed['items'],
+            'item_count': len(old_items) != len(parsed['items']),
+            'totals': (old.get('total_amount', 0) != parsed['total_amount']
+                       or old.get('total_quantity', 0) != parsed['total_quantity']),
+            'date': receipt.transaction_time != ReceiptReparseService._aware(parsed['transaction_time']),
+        }
+
+    @staticmethod
+    def _aware(value):
+        if value is not None and timezone.is_naive(value):
+            return timezone.make_aware(value)
+        return value
+
+    @staticmethod
+    def _parsed_chunks(last_id, chunk_size, workers):
+        """
+        parser_versionが古いレシートを読み出して解析し、
+        (最後のレシートID, {レシートID: 解析結果}) をチャンクごとに返す。
+        """
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while True:
+                chunks = []
+                for _ in range(max(workers, 1)):
+                    rows = list(
+                        Receipt.objects.filter(parser_version__lt=PARSER_VERSION, pk__gt=last_id)
+                        .order_by('pk').values_list('pk', 'ocr_text')[:chunk_size]
+                    )
+                    if not rows:
+                        break
+                    chunks.append(rows)
+                    last_id = rows[-1][0]
+                if not chunks:
+                    return
+                results = executor.map(parse_receipt_rows, chunks) if executor else map(parse_receipt_rows, chunks)
+                for rows, parsed_rows in zip(chunks, results):
+                    yield rows[-1][0], dict(parsed_rows)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    @classmethod
+    def dry_run(cls, chunk_size=500, workers=1):
+        """書き込みは行わず、再解析で変化するレシート数を集計して返す"""
+        counts = {'examined': 0, 'changed': 0, 'item_count': 0, 'totals': 0, 'date': 0}
+        for _last_id, parsed_by_id in cls._parsed_chunks(0, chunk_size, workers):
+            receipts = Receipt.objects.filter(pk__in=parsed_by_id).only('pk', 'parsed_data', 'transaction_time')
+            for receipt in receipts:
+                cls._count(counts, cls.diff(receipt, parsed_by_id[receipt.pk]))
+        return counts
+
+    @staticmethod
+    def _count(counts, flags):
+        counts['examined'] += 1
+        if any(flags.values()):
+            counts['changed'] += 1
+        for key in ('item_count', 'totals', 'date'):
+            if flags[key]:
+                counts[key] += 1
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        chunk_size = job.params.get('chunk_size', getattr(settings, 'REPARSE_CHUNK_SIZE', 500))
+        workers = job.params.get('workers', getattr(settings, 'RESCORE_WORKERS', 1))
+        pause = job.params.get('pause', getattr(settings, 'RESCORE_PAUSE_SECONDS', 0.05))
+
+        if not job.total:
+            job.update_progress(total=Receipt.objects.filter(parser_version__lt=PARSER_VERSION).count())
+        last_id = job.checkpoint.get('last_receipt_id', 0)
+        for last_id, parsed_by_id in cls._parsed_chunks(last_id, chunk_size, workers):
+            cls._apply_chunk(job, last_id, parsed_by_id)
+            if stdout:
+                stdout.write(f"{job.progress}/{job.total} 件処理 (変更 {job.checkpoint['changed']} 件)")
+            if pause:
+                time.sleep(pause)
+        return {key: job.checkpoint.get(key, 0) for key in ('examined', 'changed', 'item_count', 'totals', 'date')}
+
+    @classmethod
+    def _apply_chunk(cls, job, last_id, parsed_by_id):
+        """1チャンク分の再解析結果を反映し、チェックポイントを進める"""
+        counts = {key: job.checkpoint.get(key, 0) for key in ('examined', 'changed', 'item_count', 'totals', 'date')}
+        with transaction.atomic():
+            receipts = list(Receipt.objects.filter(pk__in=parsed_by_id).only(
+                'pk', 'user_id', 'store_id', 'parsed_data', 'transaction_time', 'points_earned', 'scanned_at'))
+            item_changes = []
+            for receipt in receipts:
+                parsed = parsed_by_id[receipt.pk]
+                flags = cls.diff(receipt, parsed)
+                cls._count(counts, flags)
+                data_to_save = parsed.copy()
+                data_to_save.pop('transaction_time', None)
+                receipt.parsed_data = data_to_save
+                receipt.transaction_time = cls._aware(parsed['transaction_time'])
+                receipt.parser_version = PARSER_VERSION
+                if flags['items']:
+                    item_changes.append((receipt, parsed['items']))
+            Receipt.objects.bulk_update(receipts, ['parsed_data', 'transaction_time', 'parser_version'])
+            if item_changes:
+                cls._replace_items(item_changes)
+
+            checkpoint = dict(counts, last_receipt_id=last_id)
+            job.update_progress(progress=counts['examined'], checkpoint=checkpoint)
+
+    @staticmethod
+    def _replace_items(item_changes):
+        """商品リストが変わったレシートの明細を作り直し、獲得ポイントの差分を台帳へ反映する"""
+        matcher = get_eco_product_matcher()
+        built = []
+        names = []
+        for receipt, items in item_changes:
+            receipt_items, total_points = ReceiptService.build_receipt_items(items, receipt.store_id, matcher)
+            built.append((receipt, receipt_items, total_points))
+            names.extend(name for name, _item in receipt_items)
+        product_ids = ReceiptService.resolve_product_ids(list(dict.fromkeys(names)))
+
+        ReceiptItem.objects.filter(receipt__in=[receipt for receipt, _items in item_changes]).delete()
+        new_items = []
+        ledger_entries = []
+        month_start = timezone.localdate().replace(day=1)
+        for receipt, receipt_items, total_points in built:
+            for name, receipt_item in receipt_items:
+                receipt_item.receipt = receipt
+                receipt_item.product_id = product_ids[name]
+                new_items.append(receipt_item)
+            # 所持ポイントは月ごとにリセットされるため、今月のレシート分のみ残高へ反映する
+            if receipt.scanned_at >= month_start:
+                ledger_entries.append((receipt.user_id, total_points - receipt.points_earned, receipt.pk))
+            receipt.points_earned = total_points
+        ReceiptItem.objects.bulk_create(new_items)
+        Receipt.objects.bulk_update([receipt for receipt, _items, _points in built], ['points_earned'])
+        PointLedgerService.apply_bulk(ledger_entries, reason='reparse')
+        # 明細が作り直されたユーザー・月の集計を作り直す
+        UserMonthlySummaryService.refresh(
+            {receipt.user_id for receipt, _items in item_changes},
+            {UserMonthlySummaryService.month_of(receipt.scanned_at) for receipt, _items in item_changes},
+        )
+
+
+BackgroundJobService.register(ReceiptReparseService.JOB_KIND)(ReceiptReparseService.run)
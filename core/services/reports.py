@@ -0,0 +1,200 @@
+"""
+AIレポートの生成ジョブ。
+"""
+import logging
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from core.ai_reports import ReportClientPool, ReportGenerationError, build_prompt
+from core.models import BackgroundJob, EcoProduct, Report, UserMonthlySummary
+from core.services.jobs import BackgroundJobService
+from core.services.summaries import UserMonthlySummaryService
+
+logger = logging.getLogger('core')
+
+
+class AIReportService:
+    """
+    月間のAIレポートを生成するサービスクラス。
+    画面からの依頼はユーザーごとのジョブとして登録し、実行時は待機中の他の依頼もまとめて取得して、
+    生成モデルへの問い合わせを ReportClientPool で並列に行う（リクエスト処理中に生成を待たない）。
+    月末の一括生成 (generate_monthly_reports) は対象ユーザーをID順のバッチで処理する。
+    """
+
+    JOB_KIND = 'generate_ai_report'
+    MONTHLY_JOB_KIND = 'generate_monthly_reports'
+    EMPTY_MESSAGE = '今月の購入履歴がありません。'
+
+    @staticmethod
+    def score(eco_points, total_quantity):
+        """エコスコア（獲得ポイントの購入商品数に対する割合、100点満点）"""
+        if total_quantity <= 0:
+            return 0
+        return int(min(eco_points / (total_quantity * 10) * 100, 100))
+
+    @staticmethod
+    def reports_in_month(year, month):
+        return Report.objects.filter(generated_at__year=year, generated_at__month=month)
+
+    @classmethod
+    def request(cls, user, year, month):
+        """レポート生成を依頼する。同じ月の依頼が待機中であればそれを返す"""
+        return BackgroundJobService.enqueue(
+            cls.JOB_KIND, params={'user_id': user.pk, 'year': year, 'month': month}, user=user, coalesce=True)
+
+    @classmethod
+    def pending_job(cls, user, year, month):
+        """待機中・実行中の生成依頼を返す（なければNone）"""
+        return BackgroundJob.objects.filter(
+            kind=cls.JOB_KIND, user=user, status__in=['pending', 'running'],
+            params__year=year, params__month=month,
+        ).order_by('-pk').first()
+
+    @classmethod
+    def generate(cls, user_ids, year, month, pool=None):
+        """
+        指定ユーザーの月間レポートを生成して保存し、{'generated', 'empty', 'failed': {user_id: エラー}} を返す。
+        購入履歴のないユーザーは生成しない。生成に失敗したユーザーの既存レポートは残す。
+        """
+        month_start = date(year, month, 1)
+        users = CustomUser.objects.in_bulk(user_ids)
+        summaries = {
+            summary.user_id: summary
+            for summary in UserMonthlySummary.objects.filter(user_id__in=users, month=month_start)
+        }
+        missing = [user_id for user_id in users if user_id not in summaries]
+        if missing:
+            UserMonthlySummaryService.refresh(missing, [month_start])
+            summaries.update({
+                summary.user_id: summary
+                for summary in UserMonthlySummary.objects.filter(user_id__in=missing, month=month_start)
+            })
+        eco_products = list(EcoProduct.objects.values_list('name', flat=True))
+
+        pending = []
+        empty = []
+        for user_id, user in users.items():
+            summary = summaries.get(user_id)
+            if summary is None or not summary.products:
+                empty.append(user_id)
+                continue
+            points = summary.eco_points
+            score = cls.score(points, summary.total_quantity)
+            prompt = build_prompt(score, summary.total_quantity, summary.eco_quantity, points,
+                                  summary.products_display(), eco_products)
+            pending.append((user, score, points, prompt))
+
+        # 問い合わせ中はDBに触れない
+        prompts = [prompt for _user, _score, _points, _prompt in pending]
+        if pool is None:
+            with ReportClientPool() as pool:
+                texts = pool.generate_all(prompts)
+        else:
+            texts = pool.generate_all(prompts)
+
+        reports = []
+        failed = {}
+        for (user, score, points, _prompt), text in zip(pending, texts):
+            if isinstance(text, Exception):
+                logger.warning("AIレポートの生成に失敗しました (user=%s): %s", user.pk, text)
+                failed[user.pk] = str(text) or text.__class__.__name__
+                continue
+            reports.append(Report(
+                user=user, description=text, score=score, rank=user.get_rank_display(),
+                monthly_points=points, held_points=user.current_points,
+            ))
+
+        with transaction.atomic():
+            cls.reports_in_month(year, month).filter(user_id__in=[report.user_id for report in reports]).delete()
+            created = Report.objects.bulk_create(reports)
+            # 翌月に入ってから生成した場合も、対象月のレポートとして扱う
+            next_month = UserMonthlySummaryService._next_month(month_start)
+            month_end = timezone.make_aware(datetime(next_month.year, next_month.month, 1)) - timedelta(seconds=1)
+            if created and timezone.now() > month_end:
+                Report.objects.filter(pk__in=[report.pk for report in created]).update(generated_at=month_end)
+        return {'generated': len(reports), 'empty': len(empty), 'failed': failed, 'empty_user_ids': empty}
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        # 待機中の他の依頼もまとめて取得し、1回の並列問い合わせで処理する
+        jobs = [job]
+        while len(jobs) < settings.AI_REPORT_BATCH_SIZE:
+            extra = BackgroundJobService.claim(kinds=[cls.JOB_KIND])
+            if extra is None:
+                break
+            jobs.append(extra)
+
+        by_month = {}
+        for batch_job in jobs:
+            by_month.setdefault((batch_job.params['year'], batch_job.params['month']), []).append(batch_job)
+        outcomes = {}
+        with ReportClientPool() as pool:
+            for (year, month), month_jobs in by_month.items():
+                result = cls.generate([batch_job.params['user_id'] for batch_job in month_jobs], year, month, pool)
+                for batch_job in month_jobs:
+                    user_id = batch_job.params['user_id']
+                    outcomes[batch_job.pk] = (
+                        result['failed'].get(user_id),
+                        {'empty': user_id in result['empty_user_ids'], 'batch_size': len(jobs)},
+                    )
+
+        for batch_job in jobs[1:]:
+            error, result = outcomes[batch_job.pk]
+            batch_job.status = 'failed' if error else 'completed'
+            batch_job.error = error or ''
+            batch_job.result = None if error else result
+            batch_job.finished_at = timezone.now()
+            batch_job.save(update_fields=['status', 'result', 'error', 'finished_at', 'updated_at'])
+
+        error, result = outcomes[job.pk]
+        if error:
+            raise ReportGenerationError(error)
+        return result
+
+    @classmethod
+    def active_user_ids(cls, year, month):
+        """対象月にレシートを読み取った利用者のID"""
+        month_start = date(year, month, 1)
+        users = CustomUser.objects.filter(role='user', is_active=True)
+        # 集計行のないユーザー（導入前のレシートのみの月）は先に集計する
+        missing = users.filter(receipt__scanned_at__gte=month_start,
+                               receipt__scanned_at__lt=UserMonthlySummaryService._next_month(month_start)) \
+            .exclude(monthly_summaries__month=month_start).values_list('pk', flat=True).distinct()
+        UserMonthlySummaryService.refresh(list(missing), [month_start])
+        return users.filter(monthly_summaries__month=month_start, monthly_summaries__receipt_count__gt=0)
+
+    @classmethod
+    def run_monthly(cls, job, stdout=None):
+        year, month = job.params['year'], job.params['month']
+        batch_size = job.params.get('batch_size', settings.AI_REPORT_BATCH_SIZE)
+        counts = {key: job.checkpoint.get(key, 0) for key in ('generated', 'empty', 'failed')}
+        last_id = job.checkpoint.get('last_user_id', 0)
+        users = cls.active_user_ids(year, month)
+        if not job.total:
+            job.update_progress(total=users.filter(pk__gt=last_id).count())
+        # 全バッチで1つのプール（イベントループと生成モデルのクライアント）を使い続ける
+        with ReportClientPool(requests_per_minute=job.params.get(
+                'requests_per_minute', settings.AI_REPORT_REQUESTS_PER_MINUTE)) as pool:
+            while True:
+                user_ids = list(users.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+                if not user_ids:
+                    break
+                result = cls.generate(user_ids, year, month, pool)
+                counts['generated'] += result['generated']
+                counts['empty'] += result['empty']
+                counts['failed'] += len(result['failed'])
+                last_id = user_ids[-1]
+                job.update_progress(
+                    progress=job.progress + len(user_ids), checkpoint=dict(counts, last_user_id=last_id))
+                if stdout:
+                    stdout.write(
+                        f"{job.progress}/{job.total} 人処理 (生成 {counts['generated']} 件 / 失敗 {counts['failed']} 件)")
+        return counts
+
+
+BackgroundJobService.register(AIReportService.JOB_KIND)(AIReportService.run)
+BackgroundJobService.register(AIReportService.MONTHLY_JOB_KIND)(AIReportService.run_monthly)
@@ -0,0 +1,405 @@
+"""
+店舗のジオコーディング、レシートのヘッダーと店舗の照合、重複店舗の統合。
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from core.geocoding import GeocodingError, get_geocoders, normalize_address
+from core.models import (
+    Coupon, CouponUsage, CouponUsageRollup, EcoProduct, GeocodeCache, Receipt, Store, StoreAlias,
+    UnresolvedStoreHeader,
+)
+from core.services.coupons import CouponStatsService
+from core.services.jobs import BackgroundJobService
+from core.store_index import invalidate_store_index
+from core.store_resolver import StoreResolver, extract_tels, normalize_store_name, normalize_tel
+
+logger = logging.getLogger('core')
+
+
+class GeocodingService:
+    """
+    店舗住所のジオコーディングを行うサービスクラス。
+    結果は正規化した住所ごとに GeocodeCache へ保存し（見つからなかった住所も短期間保存）、
+    店舗の保存時はキャッシュだけを参照して、未取得の住所はバックグラウンドジョブで問い合わせる。
+    ジョブは店舗をバッチ単位で処理し、キャッシュにない住所だけをスレッドで並列に問い合わせる。
+    """
+
+    JOB_KIND = 'geocode_stores'
+
+    @staticmethod
+    def address_key(address):
+        return normalize_address(address)[:255]
+
+    @classmethod
+    def cached(cls, address):
+        """有効期限内のキャッシュを返す（なければNone）"""
+        return GeocodeCache.objects.filter(
+            address_key=cls.address_key(address), expires_at__gt=timezone.now()).first()
+
+    @staticmethod
+    def cached_many(address_keys):
+        """有効期限内のキャッシュを {住所キー: GeocodeCache} で返す（1クエリ）"""
+        entries = GeocodeCache.objects.filter(address_key__in=set(address_keys), expires_at__gt=timezone.now())
+        return {entry.address_key: entry for entry in entries}
+
+    @classmethod
+    def apply_cached(cls, store):
+        """キャッシュに結果があれば店舗の位置に反映し、キャッシュが見つかったかどうかを返す"""
+        entry = cls.cached(store.address)
+        if entry is None:
+            return False
+        if entry.found:
+            store.lat, store.lng = entry.lat, entry.lng
+        return True
+
+    @classmethod
+    def remember(cls, address, location, provider=''):
+        """結果をキャッシュする。locationがNoneの場合は見つからなかったことを短期間キャッシュする"""
+        cls.remember_many([(cls.address_key(address), location, provider)])
+
+    @staticmethod
+    def remember_many(results):
+        """(住所キー, 位置, プロバイダー名) のリストをまとめてキャッシュする（既存の行は上書き）"""
+        now = timezone.now()
+        entries = []
+        for address_key, location, provider in results:
+            if location:
+                expires_at = now + timedelta(days=settings.GEOCODE_CACHE_TTL_DAYS)
+                lat, lng = location
+            else:
+                expires_at = now + timedelta(hours=settings.GEOCODE_NEGATIVE_CACHE_TTL_HOURS)
+                lat = lng = None
+            entries.append(GeocodeCache(
+                address_key=address_key, lat=lat, lng=lng, provider=provider or '', expires_at=expires_at))
+        GeocodeCache.objects.bulk_create(
+            entries, update_conflicts=True, unique_fields=['address_key'],
+            update_fields=['lat', 'lng', 'provider', 'expires_at', 'updated_at'],
+        )
+
+    @staticmethod
+    def query(address, geocoders):
+        """
+        プロバイダーに順に問い合わせ、(位置, プロバイダー名, 一時的な失敗があったか) を返す。
+        DBにはアクセスしないため、ワーカースレッドから呼び出せる。
+        """
+        failed = False
+        for geocoder in geocoders:
+            try:
+                location = geocoder.geocode(address)
+            except GeocodingError as e:
+                logger.warning("%s でのジオコーディングに失敗しました: %s - %s", geocoder.name, address, e)
+                failed = True
+                continue
+            if location:
+                return location, geocoder.name, failed
+        return None, '', failed
+
+    @staticmethod
+    def pending_stores():
+        """位置が未設定で住所のある店舗"""
+        return Store.objects.filter(lat=0.0, lng=0.0).exclude(address='')
+
+    @classmethod
+    def schedule(cls, user=None):
+        """未設定の店舗のジオコーディングをコミット後にジョブとして登録する（待機中のジョブがあればまとめる）"""
+        transaction.on_commit(lambda: BackgroundJobService.enqueue(cls.JOB_KIND, user=user, coalesce=True))
+
+    @classmethod
+    def run(cls, job, stdout=None):
+        batch_size = job.params.get('batch_size', settings.GEOCODING_BATCH_SIZE)
+        workers = max(job.params.get('workers', settings.GEOCODING_WORKERS), 1)
+
+        geocoders = get_geocoders()
+        counts = {key: job.checkpoint.get(key, 0) for key in ('found', 'missed', 'cache_hits', 'errors')}
+        last_id = job.checkpoint.get('last_store_id', 0)
+        if not job.total:
+            job.update_progress(total=cls.pending_stores().filter(pk__gt=last_id).count())
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                stores = list(
+                    cls.pending_stores().filter(pk__gt=last_id).order_by('pk').only('pk', 'address')[:batch_size])
+                if not stores:
+                    break
+                last_id = stores[-1].pk
+                cls._geocode_batch(job, stores, geocoders, executor, counts, last_id)
+                if stdout:
+                    stdout.write(f"{job.progress}/{job.total} 件処理 (取得 {counts['found']} 件)")
+
+        # 位置はbulk_updateで保存するためシグナルが発火しない。ジョブを実行したプロセスのインデックスはここで無効にし、
+        # 他のワーカーのインデックスには STORE_INDEX_MAX_AGE 秒以内に反映される
+        if counts['found']:
+            transaction.on_commit(invalidate_store_index)
+        return dict(counts, processed=job.progress)
+
+    @classmethod
+    def _geocode_batch(cls, job, stores, geocoders, executor, counts, last_id):
+        """1バッチ分の店舗をキャッシュと並列問い合わせで処理し、位置とチェックポイントをまとめて保存する"""
+        keys = {store.pk: cls.address_key(store.address) for store in stores}
+        locations = {
+            key: (entry.lat, entry.lng) if entry.found else None
+            for key, entry in cls.cached_many(keys.values()).items()
+        }
+        counts['cache_hits'] += sum(1 for key in keys.values() if key in locations)
+
+        # 同じ住所は1回だけ問い合わせる
+        addresses = {}
+        for store in stores:
+            if keys[store.pk] not in locations:
+                addresses.setdefault(keys[store.pk], store.address)
+        results = dict(zip(addresses, executor.map(lambda address: cls.query(address, geocoders), addresses.values())))
+
+        updated = []
+        for store in stores:
+            key = keys[store.pk]
+            if key in locations:
+                location = locations[key]
+            else:
+                location, _provider, failed = results[key]
+                if not location and failed:
+                    counts['errors'] += 1
+            if location:
+                store.lat, store.lng = location
+                updated.append(store)
+        counts['found'] += len(updated)
+        counts['missed'] += len(stores) - len(updated)
+
+        with transaction.atomic():
+            # 一時的な失敗で見つからなかった住所はキャッシュしない
+            cls.remember_many([
+                (key, location, provider) for key, (location, provider, failed) in results.items()
+                if location or not failed
+            ])
+            # save() を経由せず位置だけを更新する
+            Store.objects.bulk_update(updated, ['lat', 'lng'])
+            job.update_progress(progress=job.progress + len(stores), checkpoint=dict(counts, last_store_id=last_id))
+
+
+BackgroundJobService.register(GeocodingService.JOB_KIND)(GeocodingService.run)
+
+
+# --- Store Resolution ---
+
+_store_resolver_lock = threading.Lock()
+_store_resolver_cache = {'version': None, 'loaded_at': 0.0, 'resolver': None}
+
+
+class StoreResolutionService:
+    """
+    レシートのヘッダーを既存の店舗に照合するサービスクラス。
+    店舗名・別名・電話番号のインデックスはプロセス内に保持し、店舗か別名が変わったとき、
+    または STORE_RESOLVER_MAX_AGE 秒経過したときのみ作り直す（他のワーカーでの変更はこの間隔で反映される）。
+    照合できなかったヘッダーは店舗を作らず UnresolvedStoreHeader に登録し、管理者の確認を待つ。
+    """
+
+    VERSION_CACHE_KEY = 'core:store_resolver_version'
+
+    @classmethod
+    def resolver(cls):
+        version = cache.get(cls.VERSION_CACHE_KEY)
+        if version is None:
+            cache.add(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+            version = cache.get(cls.VERSION_CACHE_KEY)
+        max_age = getattr(settings, 'STORE_RESOLVER_MAX_AGE', 60)
+        resolver = _store_resolver_cache['resolver']
+        if (resolver is not None and _store_resolver_cache['version'] == version
+                and time.monotonic() - _store_resolver_cache['loaded_at'] < max_age):
+            return resolver
+
+        with _store_resolver_lock:
+            resolver = StoreResolver(
+                Store.objects.order_by('pk').values_list('pk', 'store_name', 'tel'),
+                StoreAlias.objects.order_by('pk').values_list('store_id', 'name_key'),
+                threshold=settings.STORE_RESOLVE_THRESHOLD,
+            )
+            _store_resolver_cache.update(version=version, loaded_at=time.monotonic(), resolver=resolver)
+        return resolver
+
+    @classmethod
+    def invalidate(cls):
+        """店舗・別名の変更時に呼び出し、キャッシュを共有するプロセスのインデックスを無効にする"""
+        cache.set(cls.VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+
+    @classmethod
+    def match(cls, header, ocr_text=''):
+        """ヘッダーとOCRテキスト中の電話番号から StoreMatch を返す（該当なしはNone）"""
+        return cls.resolver().resolve(header, extract_tels(ocr_text))
+
+    @classmethod
+    def resolve(cls, header, ocr_text=''):
+        """ヘッダーに該当する店舗を返す（該当なしはNone）"""
+        match = cls.match(header, ocr_text)
+        return Store.objects.filter(pk=match.store_id).first() if match else None
+
+    @staticmethod
+    def queue(header, ocr_text='', receipt=None):
+        """照合できなかったヘッダーを確認待ちに登録し（同じ表記は出現回数を加算）、レシートを関連付ける"""
+        name_key = normalize_store_name(header)[:255]
+        if not name_key:
+            return None
+        tels = extract_tels(ocr_text)
+        with transaction.atomic():
+            entry, _created = UnresolvedStoreHeader.objects.get_or_create(
+                name_key=name_key, defaults={'header': header[:255], 'tel': tels[0] if tels else ''})
+            UnresolvedStoreHeader.objects.filter(pk=entry.pk).update(occurrences=F('occurrences') + 1)
+            if receipt is not None:
+                entry.receipts.add(receipt)
+        return entry
+
+    @staticmethod
+    def resolve_header(entry, store):
+        """確認待ちのヘッダーを店舗の別名として登録し、関連付けたレシートに店舗を設定する"""
+        with transaction.atomic():
+            StoreAlias.objects.update_or_create(
+                name_key=entry.name_key, defaults={'store': store, 'name': entry.header, 'source': 'review'})
+            updated = Receipt.objects.filter(unresolved_store_headers=entry, store__isnull=True).update(store=store)
+            entry.status = 'resolved'
+            entry.store = store
+            entry.save(update_fields=['status', 'store', 'last_seen'])
+        return updated
+
+    @classmethod
+    def create_store(cls, entry, **fields):
+        """確認待ちのヘッダーから新しい店舗を登録する（住所などは後から管理画面で補う）"""
+        fields = {'category': 'other', 'address': '不明', 'tel': entry.tel, **fields}
+        with transaction.atomic():
+            store = Store.objects.create(store_name=entry.header[:64], **fields)
+            cls.resolve_header(entry, store)
+        return store
+
+
+class StoreMergeService:
+    """重複した店舗を1つの店舗に統合するサービスクラス"""
+
+    @staticmethod
+    def find_duplicates(fuzzy=False):
+        """
+        正規化した店舗名または電話番号が一致する店舗のグループを [[店舗ID, ...], ...] で返す（店舗IDの昇順）。
+        fuzzy=Trueの場合は、店舗名の照合で類似と判定された店舗も同じグループにする。
+        """
+        stores = list(Store.objects.order_by('pk').values_list('pk', 'store_name', 'tel'))
+        parent = {store_id: store_id for store_id, _name, _tel in stores}
+
+        def find(store_id):
+            while parent[store_id] != store_id:
+                parent[store_id] = parent[parent[store_id]]
+                store_id = parent[store_id]
+            return store_id
+
+        def union(a, b):
+            a, b = find(a), find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+        first_by_key = {}
+        for store_id, name, tel in stores:
+            for key in (('name', normalize_store_name(name)), ('tel', normalize_tel(tel))):
+                if key[1]:
+                    union(store_id, first_by_key.setdefault(key, store_id))
+
+        if fuzzy:
+            # インデックスは全店舗で1回だけ構築し、各店舗名に最も類似する他の店舗名と同じグループにする
+            resolver = StoreResolver(stores, threshold=settings.STORE_RESOLVE_THRESHOLD)
+            for store_id, name, _tel in stores:
+                for match in resolver.similar(name, limit=1):
+                    union(store_id, match.store_id)
+
+        groups = {}
+        for store_id, _name, _tel in stores:
+            groups.setdefault(find(store_id), []).append(store_id)
+        return [group for group in groups.values() if len(group) > 1]
+
+    @staticmethod
+    def merge(target, sources):
+        """
+        sourcesの店舗を参照するレシート・クーポン・利用履歴・集計・ユーザーなどをtargetへ付け替え、
+        店舗名を別名として残してから削除する。付け替えは種類ごとに一括のUPDATEで行う。
+        """
+        source_ids = [store.pk for store in sources if store.pk != target.pk]
+        if not source_ids:
+            return {}
+        counts = {}
+        with transaction.atomic():
+            for label, model, field in (
+                ('receipts', Receipt, 'store'),
+                ('coupon_usages', CouponUsage, 'store'),
+                ('coupons', Coupon, 'store'),
+                ('eco_products', EcoProduct, 'store'),
+                ('users', CustomUser, 'store'),
+                ('unresolved_headers', UnresolvedStoreHeader, 'store'),
+                ('aliases', StoreAlias, 'store'),
+            ):
+                counts[label] = model.objects.filter(**{f'{field}_id__in': source_ids}).update(**{field: target})
+
+            # 利用可能店舗 (M2M)
+            Through = Coupon.available_stores.through
+            coupon_ids = set(Through.objects.filter(store_id__in=source_ids).values_list('coupon_id', flat=True))
+            Through.objects.bulk_create(
+                [Through(coupon_id=coupon_id, store_id=target.pk) for coupon_id in coupon_ids], ignore_conflicts=True)
+            Through.objects.filter(store_id__in=source_ids).delete()
+
+            # 集計行は同じ区分の行があれば加算し、なければ付け替える
+            existing = {
+                (row.coupon_id, row.rank, row.granularity, row.bucket): row
+                for row in CouponUsageRollup.objects.filter(store=target)
+            }
+            moved, merged, merged_ids = [], {}, []
+            for row in CouponUsageRollup.objects.filter(store_id__in=source_ids).order_by('pk'):
+                key = (row.coupon_id, row.rank, row.granularity, row.bucket)
+                if key in existing:
+                    existing[key].count += row.count
+                    merged[key] = existing[key]
+                    merged_ids.append(row.pk)
+                else:
+                    row.store_id = target.pk
+                    existing[key] = row
+                    moved.append(row)
+            CouponUsageRollup.objects.filter(pk__in=merged_ids).delete()
+            CouponUsageRollup.objects.bulk_update(moved, ['store'])
+            CouponUsageRollup.objects.bulk_update(list(merged.values()), ['count'])
+
+            # 統合される店舗の名前は別名として残し、同じヘッダーのレシートが統合先に照合されるようにする
+            target_key = normalize_store_name(target.store_name)
+            StoreAlias.objects.bulk_create([
+                StoreAlias(store=target, name=store.store_name, name_key=normalize_store_name(store.store_name)[:255],
+                           source='merge')
+                for store in sources
+                if store.pk in source_ids and normalize_store_name(store.store_name) not in ('', target_key)
+            ], ignore_conflicts=True)
+
+            # 統合先に電話番号・位置がなければ統合される店舗の値で補う
+            update_fields = []
+            for store in sources:
+                if store.pk not in source_ids:
+                    continue
+                if not target.tel and store.tel:
+                    target.tel = store.tel
+                    update_fields.append('tel')
+                if (target.lat, target.lng) == (0.0, 0.0) and (store.lat, store.lng) != (0.0, 0.0):
+                    target.lat, target.lng = store.lat, store.lng
+                    if target.address in ('', '不明'):
+                        target.address = store.address
+                        update_fields.append('address')
+                    update_fields += ['lat', 'lng']
+            if update_fields:
+                target.save(update_fields=sorted(set(update_fields)))
+
+            Store.objects.filter(pk__in=source_ids).delete()
+            counts['stores'] = len(source_ids)
+
+            # 一括UPDATEはシグナルを経由しないため、利用数の集計と照合用インデックスを明示的に無効化する
+            transaction.on_commit(CouponStatsService.invalidate)
+            transaction.on_commit(StoreResolutionService.invalidate)
+        return counts
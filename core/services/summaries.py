@@ -0,0 +1,195 @@
+"""
+ユーザーの月別集計。
+"""
+from datetime import date
+
+from django.db import transaction
+from django.db.models import Count, DateField, Exists, F, Min, OuterRef, Q, Sum
+from django.db.models.functions import TruncMonth
+
+from core.models import Receipt, ReceiptItem, UserMonthlySummary
+
+
+class UserMonthlySummaryService:
+    """
+    ユーザーの月別集計 (UserMonthlySummary) を管理するサービスクラス。
+    レシートの保存時は同じトランザクションで加算し、再採点はポイントの差分を加算、
+    明細が作り直される再解析は対象のユーザー・月だけを集計し直す。
+    集計し直しは ReceiptItem と Product を結合したGROUP BYで行い、
+    明細を持たない旧形式のレシートのみ parsed_data のJSONから補う。
+    """
+
+    @staticmethod
+    def month_of(day):
+        return day.replace(day=1)
+
+    @classmethod
+    def for_month(cls, user, year, month):
+        """指定月の集計を返す。行がなければ（導入前の月など）集計して作成する"""
+        month_start = date(year, month, 1)
+        summary = UserMonthlySummary.objects.filter(user=user, month=month_start).first()
+        if summary is None:
+            summary, _created = cls._get_or_create_locked(user.pk, month_start)
+        return summary
+
+    @classmethod
+    def _get_or_create_locked(cls, user_id, month):
+        """
+        集計行を取得し、なければ作成して既存のレシートから集計する（行はロックして返す）。
+        同時に作成しようとした処理は一意制約で待たされ、集計済みの行を取得する。
+        """
+        with transaction.atomic():
+            summary, created = UserMonthlySummary.objects.get_or_create(user_id=user_id, month=month)
+            summary = UserMonthlySummary.objects.select_for_update().get(pk=summary.pk)
+            if created:
+                values = cls._aggregate([user_id], [month]).get((user_id, month))
+                if values:
+                    for field, value in cls._row_values(values).items():
+                        setattr(summary, field, value)
+                    summary.save()
+        return summary, created
+
+    @classmethod
+    def record_receipt(cls, receipt, receipt_items):
+        """
+        保存したレシートの分を集計に加算する（レシートの保存と同じトランザクションで呼び出す）。
+        receipt_items は (商品名, ReceiptItem) のリスト。
+        """
+        month = cls.month_of(receipt.scanned_at)
+        summary, created = cls._get_or_create_locked(receipt.user_id, month)
+        if created:
+            # 初めての月は既存のレシートを含めて集計済み（保存したレシートも含まれる）
+            return
+
+        products = dict(summary.products)
+        for name, item in receipt_items:
+            products[name] = products.get(name, 0) + item.quantity
+            summary.total_quantity += item.quantity
+            if item.points > 0:
+                summary.eco_quantity += item.quantity
+        summary.products = [[name, quantity] for name, quantity in products.items()]
+        summary.receipt_count += 1
+        summary.eco_points += receipt.points_earned
+        summary.save()
+
+    @staticmethod
+    def apply_deltas(deltas):
+        """
+        {(user_id, 月初日): (エコポイントの差分, エコ商品数の差分)} を加算する（再採点用）。
+        行のない月は次に参照したときに集計されるため更新しない。
+        """
+        for (user_id, month), (points, quantity) in deltas.items():
+            if points or quantity:
+                UserMonthlySummary.objects.filter(user_id=user_id, month=month).update(
+                    eco_points=F('eco_points') + points, eco_quantity=F('eco_quantity') + quantity)
+
+    @classmethod
+    def refresh(cls, user_ids, months=None):
+        """
+        指定ユーザー（monthsを指定した場合はその月のみ）の集計をレシートと明細から作り直し、作成した行数を返す。
+        ユーザー・月の数に関わらず、集計は3回のクエリで行う。
+        """
+        user_ids = list(user_ids)
+        months = sorted(set(months)) if months is not None else None
+        if not user_ids or months == []:
+            return 0
+        summaries = cls._aggregate(user_ids, months)
+
+        with transaction.atomic():
+            stale = UserMonthlySummary.objects.filter(user_id__in=user_ids)
+            if months is not None:
+                stale = stale.filter(month__in=months)
+            stale.delete()
+            # 同時に作成された行（レシートの保存など）は同じ時点の集計のため、そちらを残す
+            created = UserMonthlySummary.objects.bulk_create([
+                UserMonthlySummary(user_id=user_id, month=month, **cls._row_values(values))
+                for (user_id, month), values in summaries.items()
+            ], batch_size=500, ignore_conflicts=True)
+        return len(created)
+
+    @staticmethod
+    def _row_values(values):
+        return dict(values, products=[[name, quantity] for name, quantity in values['products'].items()])
+
+    @classmethod
+    def _aggregate(cls, user_ids, months=None):
+        """レシートと明細から {(user_id, 月初日): 集計値} を求める（クエリは3回）"""
+        receipts = Receipt.objects.filter(user_id__in=user_ids)
+        if months is not None:
+            receipts = receipts.filter(scanned_at__gte=months[0], scanned_at__lt=cls._next_month(months[-1]))
+
+        summaries = {}
+
+        def summary_for(user_id, month):
+            if months is not None and month not in months:
+                return None
+            if (user_id, month) not in summaries:
+                summaries[user_id, month] = {'receipt_count': 0, 'eco_points': 0, 'total_quantity': 0,
+                                             'eco_quantity': 0, 'products': {}}
+            return summaries[user_id, month]
+
+        receipt_rows = receipts.annotate(month=TruncMonth('scanned_at', output_field=DateField())) \
+            .values('user_id', 'month').annotate(count=Count('pk'), points=Sum('points_earned')).order_by()
+        for row in receipt_rows:
+            summary = summary_for(row['user_id'], row['month'])
+            if summary is not None:
+                summary['receipt_count'] = row['count']
+                summary['eco_points'] = row['points'] or 0
+
+        item_rows = (
+            ReceiptItem.objects.filter(receipt__in=receipts)
+            .annotate(month=TruncMonth('receipt__scanned_at', output_field=DateField()))
+            .values('receipt__user_id', 'month', 'product__name')
+            .annotate(
+                total=Sum('quantity'),
+                eco_total=Sum('quantity', filter=Q(points__gt=0), default=0),
+                first_item=Min('pk'),
+            )
+            .order_by('first_item')
+        )
+        for row in item_rows:
+            summary = summary_for(row['receipt__user_id'], row['month'])
+            if summary is not None:
+                products = summary['products']
+                products[row['product__name']] = products.get(row['product__name'], 0) + row['total']
+                summary['total_quantity'] += row['total']
+                summary['eco_quantity'] += row['eco_total']
+
+        # 明細の保存導入前のレシートは解析結果のJSONから集計する
+        legacy = receipts.exclude(Exists(ReceiptItem.objects.filter(receipt_id=OuterRef('pk')))) \
+            .exclude(parsed_data=None).order_by('pk').values_list('user_id', 'scanned_at', 'parsed_data', 'points_earned')
+        for user_id, scanned_at, parsed_data, points_earned in legacy:
+            summary = summary_for(user_id, cls.month_of(scanned_at))
+            if summary is None or not isinstance(parsed_data, dict):
+                continue
+            for item_data in parsed_data.get('items') or []:
+                name = item_data.get('name', 'Unknown')
+                quantity = item_data.get('quantity', 1)
+                summary['products'][name] = summary['products'].get(name, 0) + quantity
+                summary['total_quantity'] += quantity
+                # 商品ごとのポイントがないため、レシート全体にポイントがあればエコ商品として数える
+                if points_earned > 0:
+                    summary['eco_quantity'] += quantity
+        return summaries
+
+    @staticmethod
+    def _next_month(month):
+        return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+    @classmethod
+    def rebuild(cls, chunk_size=500, stdout=None):
+        """全ユーザーの集計をユーザーIDの順にチャンク単位で作り直し、作成した行数を返す"""
+        created = 0
+        last_id = 0
+        while True:
+            user_ids = list(Receipt.objects.filter(user_id__gt=last_id).order_by('user_id')
+                            .values_list('user_id', flat=True).distinct()[:chunk_size])
+            if not user_ids:
+                break
+            created += cls.refresh(user_ids)
+            last_id = user_ids[-1]
+            if stdout:
+                stdout.write(f"ユーザーID {last_id} まで集計しました（{created} 行）")
+        # レシートのないユーザーに残った行を削除する
+        UserMonthlySummary.objects.exclude(user_id__in=Receipt.objects.values('user_id')).delete()
+        return created
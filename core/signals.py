@@ -0,0 +1,102 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from accounts.models import CustomUser
+from core.models import Coupon, CouponUsage, EcoProduct, RankTier, RewardRule, Store, StoreAlias
+from core.rewards import invalidate_reward_rules
+from core.store_index import invalidate_store_index
+
+
+@receiver(pre_save, sender=EcoProduct)
+def remember_eco_product_status(sender, instance, **kwargs):
+    # 承認を取り消した場合も再採点できるよう、保存前のステータスを保持する
+    instance._previous_status = (
+        EcoProduct.objects.filter(pk=instance.pk).values_list('status', flat=True).first() if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=EcoProduct)
+def schedule_rescore_on_eco_product_save(sender, instance, **kwargs):
+    # 承認済みエコ商品の追加・編集時、承認済みから差し戻した場合は過去レシートを再採点する
+    if instance.status == 'approved' or getattr(instance, '_previous_status', None) == 'approved':
+        from core.services import ReceiptRescoreService
+        transaction.on_commit(ReceiptRescoreService.schedule)
+
+
+@receiver(post_delete, sender=EcoProduct)
+def schedule_rescore_on_eco_product_delete(sender, instance, **kwargs):
+    if instance.status == 'approved':
+        from core.services import ReceiptRescoreService
+        transaction.on_commit(ReceiptRescoreService.schedule)
+
+
+@receiver([post_save, post_delete], sender=RankTier)
+@receiver([post_save, post_delete], sender=RewardRule)
+def invalidate_reward_rules_on_change(sender, **kwargs):
+    # 変更したプロセスは直ちに、他のプロセスはコミット後のバージョン更新で読み直す
+    invalidate_reward_rules()
+    transaction.on_commit(invalidate_reward_rules)
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+@receiver([post_save, post_delete], sender=CouponUsage)
+@receiver(m2m_changed, sender=CustomUser.current_coupons.through)
+def invalidate_coupon_stats_on_change(sender, **kwargs):
+    # m2m_changed は変更後 (post_*) のみ。コミット前の値がキャッシュされないようコミット後に無効化する
+    if kwargs.get('action', 'post_').startswith('post_'):
+        from core.services import CouponStatsService
+        transaction.on_commit(CouponStatsService.invalidate)
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+def invalidate_coupon_eligibility_on_coupon_change(sender, **kwargs):
+    # ステータスや必要ポイントの変更は全ユーザーの判定に影響する
+    from core.services import CouponEligibilityService
+    transaction.on_commit(CouponEligibilityService.invalidate)
+
+
+@receiver([post_save, post_delete], sender=CouponUsage)
+def invalidate_coupon_eligibility_on_usage(sender, instance, **kwargs):
+    from core.services import CouponEligibilityService
+    transaction.on_commit(lambda: CouponEligibilityService.invalidate([instance.user_id]))
+
+
+@receiver(m2m_changed, sender=CustomUser.current_coupons.through)
+def invalidate_coupon_eligibility_on_grant(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    from core.services import CouponEligibilityService
+    if not reverse:
+        user_ids = [instance.pk]
+    elif pk_set is not None:
+        # coupon.customuser_set 側からの変更
+        user_ids = list(pk_set)
+    else:
+        user_ids = None
+    transaction.on_commit(lambda: CouponEligibilityService.invalidate(user_ids))
+
+
+@receiver(post_save, sender=CouponUsage)
+def record_coupon_usage_rollup(sender, instance, created, **kwargs):
+    # 利用の記録と同じトランザクションで時間・日別の集計に加算する
+    if created:
+        from core.services import CouponUsageRollupService
+        rank = getattr(instance, 'user_rank', None)
+        if rank is None:
+            rank = CustomUser.objects.filter(pk=instance.user_id).values_list('rank', flat=True).first()
+        CouponUsageRollupService.record(instance, rank)
+
+
+@receiver([post_save, post_delete], sender=Store)
+def invalidate_store_index_on_change(sender, **kwargs):
+    invalidate_store_index()
+    transaction.on_commit(invalidate_store_index)
+
+
+@receiver([post_save, post_delete], sender=Store)
+@receiver([post_save, post_delete], sender=StoreAlias)
+def invalidate_store_resolver_on_change(sender, **kwargs):
+    from core.services import StoreResolutionService
+    StoreResolutionService.invalidate()
+    transaction.on_commit(StoreResolutionService.invalidate)
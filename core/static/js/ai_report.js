@@ -1,4 +1,25 @@
 document.addEventListener('DOMContentLoaded', function() {
+    // レポート生成中は状況を問い合わせ、完了したら再読み込みする
+    const pending = document.getElementById('report-pending');
+    if (pending) {
+        const poll = function() {
+            fetch(pending.dataset.statusUrl, { headers: { 'Accept': 'application/json' } })
+                .then(function(response) { return response.json(); })
+                .then(function(data) {
+                    if (data.status === 'completed') {
+                        window.location.reload();
+                    } else if (data.status === 'failed') {
+                        pending.classList.add('failed');
+                        pending.textContent = data.error;
+                    } else {
+                        setTimeout(poll, 2000);
+                    }
+                })
+                .catch(function() { setTimeout(poll, 5000); });
+        };
+        setTimeout(poll, 2000);
+    }
+
     const ctx = document.getElementById('scoreChart');
     if (!ctx) return;
 
@@ -1,15 +1,4 @@
 document.addEventListener('DOMContentLoaded', function() {
-    // データ取得
-    var stores = [];
-    const storesDataElement = document.getElementById('stores-data');
-    if (storesDataElement) {
-        try {
-            stores = JSON.parse(storesDataElement.textContent);
-        } catch (e) {
-            console.warn('stores_json parse error:', e);
-        }
-    }
-
     // マップ初期化
     const mapElement = document.getElementById('map');
     if (!mapElement) return; // マップ要素がなければ終了
@@ -109,51 +98,60 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 
     var markersLayer = L.layerGroup().addTo(map);
+    const categoryMap = { 'restaurant': '飲食店', 'retail': '小売店', 'service': 'サービス業', 'other': 'その他' };
+    const dataUrl = mapElement.dataset.storesUrl;
+    const responseCache = new Map();
+    let requestSeq = 0;
 
-    function renderMarkers(filteredStores) {
-        markersLayer.clearLayers();
-        const categoryMap = { 'restaurant': '飲食店', 'retail': '小売店', 'service': 'サービス業', 'other': 'その他' };
-
-        filteredStores.forEach(function (s) {
-            if (s.fields.lat && s.fields.lng && s.fields.lat !== 0 && s.fields.lng !== 0) {
-                var open_time = s.fields.open_time ? s.fields.open_time.substring(0, 5) : '';
-                var close_time = s.fields.close_time ? s.fields.close_time.substring(0, 5) : '';
-                var hours = (open_time && close_time) ? `${open_time} - ${close_time}` : '営業時間情報なし';
-                var categoryLabel = categoryMap[s.fields.category] || s.fields.category;
-
-                var popupContent = `
-                        <div class="store-popup">
-                            <div class="store-name">${s.fields.store_name}</div>
-                            <div class="info-row"><span class="info-label">カテゴリ:</span> ${categoryLabel}</div>
-                            <div class="info-row"><span class="info-label">住所:</span> ${s.fields.address}</div>
-                            <div class="info-row"><span class="info-label">電話:</span> ${s.fields.tel || '－'}</div>
-                            <div class="info-row"><span class="info-label">時間:</span> ${hours}</div>
-                        </div>`;
-                L.marker([s.fields.lat, s.fields.lng], {icon: storeIcon}).bindPopup(popupContent).addTo(markersLayer);
-            }
+    function escapeHtml(value) {
+        const div = document.createElement('div');
+        div.textContent = value == null ? '' : String(value);
+        return div.innerHTML;
+    }
+
+    function clusterIcon(count) {
+        const size = count < 10 ? 32 : count < 100 ? 40 : 48;
+        return L.divIcon({
+            html: `<div style="width:${size}px;height:${size}px;line-height:${size}px;background:rgba(34,197,94,0.85);color:#fff;border:3px solid #fff;border-radius:50%;text-align:center;font-weight:700;box-shadow:0 0 8px rgba(0,0,0,0.3);">${count}</div>`,
+            className: 'store-cluster-icon',
+            iconSize: [size, size],
+            iconAnchor: [size / 2, size / 2]
         });
     }
 
-    function filterMarkers() {
-        const keywordInput = document.getElementById('keyword-input');
-        const categorySelect = document.getElementById('category-select');
-        
-        const keyword = keywordInput ? keywordInput.value.toLowerCase() : '';
-        const category = categorySelect ? categorySelect.value : '';
-        
-        const filtered = stores.filter(function(s) {
-            const matchKeyword = !keyword || s.fields.store_name.toLowerCase().includes(keyword);
-            const matchCategory = !category || s.fields.category === category;
-            return matchKeyword && matchCategory;
+    function renderMarkers(data) {
+        markersLayer.clearLayers();
+
+        data.clusters.forEach(function (c) {
+            // クラスターをタップすると拡大して内訳を表示する
+            L.marker([c.lat, c.lng], { icon: clusterIcon(c.count) })
+                .on('click', function () { map.setView([c.lat, c.lng], map.getZoom() + 2); })
+                .addTo(markersLayer);
         });
-        renderMarkers(filtered);
+
+        data.stores.forEach(function (s) {
+            var hours = (s.open && s.close) ? `${s.open} - ${s.close}` : '営業時間情報なし';
+            var categoryLabel = categoryMap[s.category] || s.category;
+
+            var popupContent = `
+                    <div class="store-popup">
+                        <div class="store-name">${escapeHtml(s.name)}</div>
+                        <div class="info-row"><span class="info-label">カテゴリ:</span> ${escapeHtml(categoryLabel)}</div>
+                        <div class="info-row"><span class="info-label">住所:</span> ${escapeHtml(s.address)}</div>
+                        <div class="info-row"><span class="info-label">電話:</span> ${escapeHtml(s.tel || '－')}</div>
+                        <div class="info-row"><span class="info-label">時間:</span> ${escapeHtml(hours)}</div>
+                    </div>`;
+            L.marker([s.lat, s.lng], {icon: storeIcon}).bindPopup(popupContent).addTo(markersLayer);
+        });
+        updateAutocomplete(data.stores);
     }
 
-    function initAutocomplete() {
+    function updateAutocomplete(stores) {
         const datalist = document.getElementById('store-names');
         if (!datalist) return;
-        
-        const uniqueNames = new Set(stores.map(s => s.fields.store_name));
+
+        datalist.innerHTML = '';
+        const uniqueNames = new Set(stores.map(s => s.name));
         uniqueNames.forEach(name => {
             const option = document.createElement('option');
             option.value = name;
@@ -161,19 +159,63 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    renderMarkers(stores);
-    initAutocomplete();
-    
-    // イベントリスナー設定
+    // 表示範囲をズームごとのグリッドに揃えて取得し、同じ範囲はキャッシュ（ETagで再検証）を使う
+    function tileBounds() {
+        const zoom = map.getZoom();
+        const step = 360 / Math.pow(2, zoom) * 2;
+        const b = map.getBounds();
+        const snap = (v, fn) => Math.round(fn(v / step) * step * 1e6) / 1e6;
+        return {
+            zoom: zoom,
+            bbox: [
+                Math.max(snap(b.getSouth(), Math.floor), -90), snap(b.getWest(), Math.floor),
+                Math.min(snap(b.getNorth(), Math.ceil), 90), snap(b.getEast(), Math.ceil)
+            ].join(',')
+        };
+    }
+
+    function loadStores() {
+        if (!dataUrl) return;
+        const keywordInput = document.getElementById('keyword-input');
+        const categorySelect = document.getElementById('category-select');
+        const view = tileBounds();
+        const params = new URLSearchParams({ bbox: view.bbox, zoom: view.zoom });
+        if (keywordInput && keywordInput.value) params.set('q', keywordInput.value);
+        if (categorySelect && categorySelect.value) params.set('category', categorySelect.value);
+        const url = `${dataUrl}?${params.toString()}`;
+
+        if (responseCache.has(url)) {
+            renderMarkers(responseCache.get(url));
+            return;
+        }
+        const seq = ++requestSeq;
+        fetch(url, { credentials: 'same-origin' })
+            .then(r => r.ok ? r.json() : Promise.reject(r.status))
+            .then(data => {
+                responseCache.set(url, data);
+                if (seq === requestSeq) renderMarkers(data);
+            })
+            .catch(e => console.warn('店舗データの取得に失敗しました:', e));
+    }
+
+    let loadTimer = null;
+    function scheduleLoad() {
+        clearTimeout(loadTimer);
+        loadTimer = setTimeout(loadStores, 250);
+    }
+
+    map.on('moveend', scheduleLoad);
+    loadStores();
+
     // イベントリスナー設定
     const keywordInput = document.getElementById('keyword-input');
-    if (keywordInput) keywordInput.addEventListener('input', filterMarkers);
-    
+    if (keywordInput) keywordInput.addEventListener('input', scheduleLoad);
+
     const categorySelect = document.getElementById('category-select');
-    if (categorySelect) categorySelect.addEventListener('change', filterMarkers);
+    if (categorySelect) categorySelect.addEventListener('change', loadStores);
 
     const filterButton = document.getElementById('filter-button');
-    if (filterButton) filterButton.addEventListener('click', filterMarkers);
+    if (filterButton) filterButton.addEventListener('click', loadStores);
 
     // 位置情報取得のオプション設定
     // スマホの個体差（GPS起動の遅さなど）に対応するため、タイムアウトを長めに設定
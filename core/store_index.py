@@ -0,0 +1,179 @@
+"""
+店舗の位置検索インデックス。
+全店舗の緯度経度をNumPy配列とグリッド（セル → 店舗の添字）でプロセス内に保持し、
+地図の表示範囲検索・ズームに応じたクラスタリング・近い店舗の検索をクエリなしで行う。
+店舗を変更するとキャッシュ上のバージョンが更新され、次回の参照時に作り直す。
+既定のキャッシュ (LocMemCache) はプロセスごとのため、即時に反映されるのは変更したプロセスのみで、
+他のワーカーには STORE_INDEX_MAX_AGE 秒以内に反映される（共有キャッシュを設定した場合は全プロセスで即時）。
+"""
+import hashlib
+import math
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+from core.models import Store
+
+INDEX_VERSION_CACHE_KEY = 'core:store_index_version'
+# グリッドのセルの大きさ（度）。約5km四方
+GRID_DEGREES = 0.05
+EARTH_RADIUS_KM = 6371.0088
+# クラスタリングで1つにまとめる画面上の大きさ（ピクセル）
+CLUSTER_PIXELS = 60
+TILE_PIXELS = 256
+
+STORE_FIELDS = ('store_id', 'store_name', 'category', 'lat', 'lng', 'address', 'tel', 'open_time', 'close_time')
+
+
+def _cell(lat, lng):
+    return int(math.floor(lat / GRID_DEGREES)), int(math.floor(lng / GRID_DEGREES))
+
+
+class StoreIndex:
+    """読み込み済みの店舗位置を検索する（検索時にクエリは発行しない）"""
+
+    def __init__(self, rows, version=''):
+        # rows: STORE_FIELDS の順の値のタプル。位置未設定 (0, 0) の店舗は除外する
+        rows = [row for row in rows if row[3] or row[4]]
+        self.version = version
+        self.records = [self._compact(row) for row in rows]
+        self.lat = np.array([row[3] for row in rows], dtype=np.float64)
+        self.lng = np.array([row[4] for row in rows], dtype=np.float64)
+        self.categories = np.array([row[2] or '' for row in rows], dtype=object)
+        self.names = [(row[1] or '').lower() for row in rows]
+        self.lat_rad = np.radians(self.lat)
+        self.lng_rad = np.radians(self.lng)
+        self.cos_lat = np.cos(self.lat_rad)
+
+        cells = {}
+        for i, (lat, lng) in enumerate(zip(self.lat, self.lng)):
+            cells.setdefault(_cell(lat, lng), []).append(i)
+        self.cells = {cell: np.array(indices, dtype=np.int64) for cell, indices in cells.items()}
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def _compact(row):
+        """地図表示に必要な項目だけの辞書"""
+        store_id, name, category, lat, lng, address, tel, open_time, close_time = row
+        return {
+            'id': store_id, 'name': name, 'category': category, 'lat': lat, 'lng': lng,
+            'address': address, 'tel': tel,
+            'open': open_time.strftime('%H:%M') if open_time else '',
+            'close': close_time.strftime('%H:%M') if close_time else '',
+        }
+
+    def _candidates(self, south, west, north, east):
+        """範囲に掛かるグリッドセルの店舗の添字（セル数が多い場合は全店舗）"""
+        (min_row, min_col), (max_row, max_col) = _cell(south, west), _cell(north, east)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            return np.arange(len(self.records))
+        parts = [
+            self.cells[(row, col)]
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)
+            if (row, col) in self.cells
+        ]
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _filter(self, indices, category=None, keyword=None):
+        if category:
+            indices = indices[self.categories[indices] == category]
+        if keyword:
+            keyword = keyword.lower()
+            indices = np.array([i for i in indices if keyword in self.names[i]], dtype=np.int64)
+        return indices
+
+    def in_bbox(self, south, west, north, east, category=None, keyword=None):
+        """緯度経度の範囲内にある店舗の添字を返す"""
+        indices = self._candidates(south, west, north, east)
+        lat, lng = self.lat[indices], self.lng[indices]
+        indices = indices[(lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)]
+        return self._filter(indices, category, keyword)
+
+    def clusters(self, indices, zoom):
+        """
+        ズームレベルに応じた画面上のグリッドで店舗をまとめ、(クラスター, 単独の店舗) を返す。
+        クラスターは {'lat', 'lng', 'count'}（位置は所属店舗の平均）。
+        """
+        if not len(indices):
+            return [], []
+        cell_degrees = 360.0 / (2 ** zoom) * CLUSTER_PIXELS / TILE_PIXELS
+        keys = np.stack([
+            np.floor(self.lat[indices] / cell_degrees), np.floor(self.lng[indices] / cell_degrees),
+        ], axis=1)
+        _unique, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.reshape(-1)
+        lat_sums = np.bincount(inverse, weights=self.lat[indices])
+        lng_sums = np.bincount(inverse, weights=self.lng[indices])
+
+        clusters = [
+            {'lat': round(lat_sums[group] / count, 6), 'lng': round(lng_sums[group] / count, 6), 'count': int(count)}
+            for group, count in enumerate(counts) if count > 1
+        ]
+        singles = [self.records[i] for i, group in zip(indices, inverse) if counts[group] == 1]
+        return clusters, singles
+
+    def nearest(self, lat, lng, k=10, radius_km=5.0, category=None):
+        """
+        (lat, lng) から半径radius_km以内の近い店舗を最大k件、[(店舗, 距離km)] で返す。
+        グリッドで候補を絞ってから、候補だけにベクトル化したハバーサイン距離を計算する。
+        """
+        lat_delta = radius_km / 111.32
+        lng_delta = radius_km / max(111.32 * math.cos(math.radians(lat)), 1e-6)
+        indices = self._filter(
+            self._candidates(lat - lat_delta, lng - lng_delta, lat + lat_delta, lng + lng_delta), category)
+        if not len(indices):
+            return []
+
+        lat_rad, lng_rad = math.radians(lat), math.radians(lng)
+        a = (np.sin((self.lat_rad[indices] - lat_rad) / 2) ** 2
+             + math.cos(lat_rad) * self.cos_lat[indices] * np.sin((self.lng_rad[indices] - lng_rad) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        within = np.flatnonzero(distances <= radius_km)
+        if len(within) > k:
+            within = within[np.argpartition(distances[within], k - 1)[:k]]
+        within = within[np.argsort(distances[within], kind='stable')]
+        return [(self.records[indices[i]], float(distances[i])) for i in within]
+
+    def etag(self, *params):
+        """インデックスのバージョンと検索条件から ETag を作る"""
+        key = '|'.join([self.version, *map(str, params)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+_index_lock = threading.Lock()
+_index_cache = {'version': None, 'loaded_at': 0.0, 'index': None}
+
+
+def get_store_index():
+    """
+    キャッシュ済みの店舗インデックスを返す。
+    キャッシュ上のバージョンが変わったとき、または STORE_INDEX_MAX_AGE 秒経過したときのみ作り直す。
+    ETag に使うインデックスのバージョンは店舗データから求めるため、プロセス間で一致する。
+    """
+    version = cache.get(INDEX_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
+        version = cache.get(INDEX_VERSION_CACHE_KEY)
+    max_age = getattr(settings, 'STORE_INDEX_MAX_AGE', 60)
+    index = _index_cache['index']
+    if index is not None and _index_cache['version'] == version and time.monotonic() - _index_cache['loaded_at'] < max_age:
+        return index
+
+    with _index_lock:
+        rows = list(Store.objects.order_by('pk').values_list(*STORE_FIELDS))
+        index = StoreIndex(rows, version=hashlib.sha1(repr(rows).encode('utf-8')).hexdigest())
+        _index_cache.update(version=version, loaded_at=time.monotonic(), index=index)
+    return index
+
+
+def invalidate_store_index():
+    """インデックスのバージョンを更新し、キャッシュを共有するプロセスのインデックスを無効にする"""
+    cache.set(INDEX_VERSION_CACHE_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,143 @@
+"""
+レシートのヘッダー（OCRした店舗名）を既存の店舗に照合するためのアルゴリズム群。
+モデルに依存しないため、管理コマンドやワーカーからも読み込める。
+照合は 電話番号 → 正規化した店舗名・別名の完全一致 → n-gramで絞り込んだ候補との編集距離 の順に行う。
+"""
+import re
+import unicodedata
+from typing import NamedTuple
+
+from core.matching import NGramIndex
+
+# 店舗名の比較では無視する法人格の表記
+CORPORATE_MARKS = ('株式会社', '有限会社', '(株)', '(有)')
+NAME_NOISE_PATTERN = re.compile(r'[\s・.,、。/\\|\'"「」『』()\[\]【】<>]+')
+# ハイフン・括弧区切りの電話番号、または「TEL」「電話」に続く数字のみの電話番号
+TEL_PATTERNS = (
+    re.compile(r'(?<!\d)(0\d{1,4})\s?[-(]\s?(\d{1,4})\s?[-)]\s?(\d{3,4})(?!\d)'),
+    re.compile(r'(?:tel|電話)\D{0,3}(0\d{9,10})(?!\d)', re.IGNORECASE),
+)
+
+
+def normalize_store_name(name):
+    """店舗名をNFKC正規化し、法人格・空白・記号を除去して小文字化する"""
+    name = unicodedata.normalize('NFKC', name or '').lower()
+    for mark in CORPORATE_MARKS:
+        name = name.replace(mark, '')
+    return NAME_NOISE_PATTERN.sub('', name)
+
+
+def normalize_tel(value):
+    """電話番号を数字のみにする。国内の電話番号として不正な場合は空文字を返す"""
+    digits = re.sub(r'\D', '', unicodedata.normalize('NFKC', value or ''))
+    return digits if digits.startswith('0') and len(digits) in (10, 11) else ''
+
+
+def extract_tels(text):
+    """OCRテキストに含まれる電話番号を出現順に返す"""
+    text = unicodedata.normalize('NFKC', text or '')
+    tels = []
+    for pattern in TEL_PATTERNS:
+        for match in pattern.finditer(text):
+            tel = normalize_tel(''.join(match.groups()))
+            if tel and tel not in tels:
+                tels.append(tel)
+    return tels
+
+
+def edit_distance(a, b, max_distance):
+    """aとbの編集距離を返す。max_distanceを超える場合はNoneを返す"""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ch in enumerate(a, start=1):
+        current = [i]
+        for j, other in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ch != other)))
+        if min(current) > max_distance:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= max_distance else None
+
+
+class StoreMatch(NamedTuple):
+    store_id: int
+    method: str  # 'tel' / 'exact' / 'fuzzy'
+    score: float
+
+
+class StoreResolver:
+    """
+    店舗名・別名・電話番号の正規化済みインデックス。照合時にクエリは発行しない。
+    同じ名前・電話番号を持つ店舗が複数ある場合、名前は先に登録した店舗を優先し、電話番号は照合に使わない。
+    """
+
+    def __init__(self, stores, aliases=(), threshold=0.85, ngram_size=2):
+        # stores: (店舗ID, 店舗名, 電話番号)、aliases: (店舗ID, 正規化済みの別名)
+        self.threshold = threshold
+        self.index = NGramIndex(ngram_size)
+        self.by_name = {}
+        self.store_ids = []
+        self.by_tel = {}
+        ambiguous_tels = set()
+        for store_id, name, tel in stores:
+            self._add(normalize_store_name(name), store_id)
+            tel = normalize_tel(tel)
+            if tel and self.by_tel.setdefault(tel, store_id) != store_id:
+                ambiguous_tels.add(tel)
+        for store_id, name_key in aliases:
+            self._add(name_key, store_id)
+        for tel in ambiguous_tels:
+            del self.by_tel[tel]
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def _add(self, key, store_id):
+        if not key or key in self.by_name:
+            return
+        self.by_name[key] = store_id
+        self.index.add(key)
+        self.store_ids.append(store_id)
+
+    def max_edits(self, key):
+        """キーの長さと閾値から許容する編集回数を求める"""
+        return int(len(key) * (1 - self.threshold) + 1e-9)
+
+    def resolve(self, name, tels=()):
+        """ヘッダーの店舗名と電話番号に該当する店舗を StoreMatch で返す（該当なしはNone）"""
+        for tel in tels:
+            if tel in self.by_tel:
+                return StoreMatch(self.by_tel[tel], 'tel', 1.0)
+
+        key = normalize_store_name(name)
+        if not key:
+            return None
+        if key in self.by_name:
+            return StoreMatch(self.by_name[key], 'exact', 1.0)
+        matches = self.similar(name, limit=1)
+        return matches[0] if matches else None
+
+    def similar(self, name, limit=5):
+        """
+        店舗名と類似する店舗を類似度の高い順に最大limit件、StoreMatch で返す。
+        正規化した名前が完全に一致するエントリ（自分自身）は含めない。
+        """
+        key = normalize_store_name(name)
+        if not key:
+            return []
+        matches = []
+        for entry_id in self.index.candidates(key, self.max_edits):
+            candidate = self.index.keys[entry_id]
+            if candidate == key:
+                continue
+            length = max(len(candidate), len(key))
+            distance = edit_distance(key, candidate, self.max_edits(candidate))
+            if distance is None:
+                continue
+            score = 1 - distance / length
+            if score >= self.threshold:
+                matches.append(StoreMatch(self.store_ids[entry_id], 'fuzzy', score))
+        # 同じ類似度の場合は先に登録した店舗を優先する
+        matches.sort(key=lambda match: -match.score)
+        return matches[:limit]
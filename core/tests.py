@@ -1,3 +1,1314 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# テストをここに作成
+import cv2
+import numpy as np
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from core.ai_reports import ReportClientPool, ReportGenerationError, RequestRateLimiter
+from core.coupon_tokens import CouponTokenError, issue_token, verify_token
+from core.image_hash import compute_image_hash
+from core.matching import EcoProductMatcher, NGramIndex, bounded_substring_distance
+from core.middleware import MonthlyPointResetMiddleware
+from core.models import (
+    BackgroundJob, Coupon, CouponUsage, CouponUsageRollup, EcoProduct, GeocodeCache, PointTransaction, RankTier, Receipt,
+    Report, RewardRule, Store, StoreAlias, UnresolvedStoreHeader, UserMonthlySummary,
+)
+from core.receipt_parser import PARSER_VERSION, compute_ocr_fingerprint
+from core.store_index import StoreIndex, get_store_index
+from core.store_resolver import StoreResolver, extract_tels, normalize_store_name
+from core.rewards import get_reward_engine, invalidate_reward_rules
+from core.services import (
+    AIReportService, BackgroundJobService, CouponEligibilityService, CouponGrantService, CouponRedemptionError,
+    CouponRedemptionService, CouponStatsService, CouponTokenService, CouponUsageRollupService, DuplicateReceiptError,
+    GeocodingService, MonthlyRolloverService, PointLedgerService, ReceiptReparseService, ReceiptRescoreService,
+    ReceiptService, StoreMergeService, StoreResolutionService, UserMonthlySummaryService,
+)
+
+
+def _eco(pk, name, points=10, is_common=True, store_id=None):
+    return SimpleNamespace(pk=pk, name=name, points=points, is_common=is_common, store_id=store_id)
+
+
+class EcoProductMatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.catalog = [
+            _eco(1, 'エコバッグ'),
+            _eco(2, 'つめかえ用シャンプー'),
+            _eco(3, '再生紙ノート', is_common=False, store_id=5),
+            _eco(4, '茶'),
+            _eco(5, '量り売り洗剤', is_common=False, store_id=None),
+        ]
+        self.matcher = EcoProductMatcher(self.catalog, threshold=0.8)
+
+    def test_substring_match(self):
+        eco_product, score = self.matcher.match('ＥＣＯ エコバッグ L')
+        self.assertEqual(eco_product.pk, 1)
+        self.assertEqual(score, 1.0)
+
+    def test_ocr_misspelling_matches_fuzzily(self):
+        # 1文字脱落
+        eco_product, score = self.matcher.match('つめかえ用シャプー 400ml')
+        self.assertEqual(eco_product.pk, 2)
+        self.assertGreaterEqual(score, 0.8)
+
+    def test_short_keyword_requires_exact_match(self):
+        self.assertEqual(self.matcher.match('緑茶 500ml')[0].pk, 4)
+        self.assertIsNone(self.matcher.match('牛乳')[0])
+
+    def test_store_restriction(self):
+        self.assertIsNone(self.matcher.match('再生紙ノート', store_id=None)[0])
+        self.assertEqual(self.matcher.match('再生紙ノート', store_id=5)[0].pk, 3)
+
+    def test_storeless_receipt_gets_only_common_products(self):
+        # 店舗未設定の店舗限定商品は、店舗不明のレシートにも付与しない
+        self.assertIsNone(self.matcher.match('量り売り洗剤', store_id=None)[0])
+
+    def test_unrelated_name_does_not_match(self):
+        self.assertEqual(self.matcher.match('ポテトチップス'), (None, 0.0))
+
+
+class NGramIndexTests(SimpleTestCase):
+    def test_candidates_are_filtered_by_shared_grams(self):
+        index = NGramIndex(n=2)
+        for key in ['abcdef', 'uvwxyz', 'a']:
+            index.add(key)
+        self.assertEqual(index.candidates('xxabcdefxx'), [0, 2])
+        self.assertEqual(index.candidates('abxdef', max_edits=lambda key: 1), [0, 2])
+
+    def test_bounded_substring_distance(self):
+        self.assertEqual(bounded_substring_distance('abcd', 'xxabcdxx', 1), 0)
+        self.assertEqual(bounded_substring_distance('abcd', 'xxabdxx', 1), 1)
+        self.assertIsNone(bounded_substring_distance('abcd', 'xxxx', 1))
+
+
+class ReceiptServiceTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='scanner', email='scanner@example.com', password='pass')
+        EcoProduct.objects.create(name='エコバッグ', points=10, is_common=True)
+        # マッチャーのキャッシュを温めておく
+        ReceiptService.save_scanned_receipt(self.user, '/media/r0.jpg', 'warmup', self._parsed(1, 'warmup'))
+
+    def _parsed(self, count, prefix):
+        items = [{'name': f'{prefix}商品{i}', 'quantity': 1, 'price': 100} for i in range(count)]
+        items.append({'name': 'エコバッグ', 'quantity': 2, 'price': 50})
+        return {'store_name': '不明', 'transaction_time': None, 'items': items, 'total_quantity': count + 2, 'total_amount': 0}
+
+    def test_saves_items_and_points(self):
+        receipt = ReceiptService.save_scanned_receipt(self.user, '/media/r1.jpg', 'ocr', self._parsed(3, 'a'))
+        self.assertEqual(receipt.items.count(), 4)
+        self.assertEqual(receipt.points_earned, 20)
+        self.assertEqual(receipt.items.get(product__name='エコバッグ').points, 20)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.current_points, 40)
+
+    def test_query_count_does_not_depend_on_item_count(self):
+        with CaptureQueriesContext(connection) as few:
+            ReceiptService.save_scanned_receipt(self.user, '/media/r2.jpg', 'ocr2', self._parsed(2, 'b'))
+        with CaptureQueriesContext(connection) as many:
+            ReceiptService.save_scanned_receipt(self.user, '/media/r3.jpg', 'ocr3', self._parsed(40, 'c'))
+        self.assertEqual(len(few), len(many))
+
+
+class ReceiptRescoreServiceTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='rescore', email='rescore@example.com', password='pass')
+        parsed = {'items': [{'name': 'つめかえ用シャンプー', 'quantity': 2, 'price': 300},
+                            {'name': 'ポテトチップス', 'quantity': 1, 'price': 150}]}
+        self.receipts = [
+            ReceiptService.save_scanned_receipt(self.user, f'/media/{i}.jpg', f'ocr{i}', dict(parsed))
+            for i in range(3)
+        ]
+        self.assertEqual(self.receipts[0].points_earned, 0)
+
+    def _run(self, **params):
+        with self.captureOnCommitCallbacks(execute=True):
+            EcoProduct.objects.create(name='つめかえ用シャンプー', points=15, is_common=True)
+        job = BackgroundJob.objects.get(kind=ReceiptRescoreService.JOB_KIND, status='pending')
+        job.params.update(params)
+        job.save()
+        return BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+
+    def test_catalog_change_rescores_items_receipts_and_balances(self):
+        job = self._run(chunk_size=2, pause=0)
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(job.result, {'processed': 6, 'changed_items': 3, 'point_delta': 90})
+        for receipt in self.receipts:
+            receipt.refresh_from_db()
+            self.assertEqual(receipt.points_earned, 30)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.current_points, 90)
+        self.assertEqual(self.user.rank, 'seed')
+        self.assertEqual(PointTransaction.objects.filter(user=self.user, reason='rescore').count(), 3)
+
+    def test_resumes_from_checkpoint(self):
+        first_item_of_last_receipt = self.receipts[2].items.order_by('pk').first().pk
+        with self.captureOnCommitCallbacks(execute=True):
+            EcoProduct.objects.create(name='つめかえ用シャンプー', points=15, is_common=True)
+        job = BackgroundJob.objects.get(kind=ReceiptRescoreService.JOB_KIND)
+        job.params = {'pause': 0}
+        job.checkpoint = {'last_item_id': first_item_of_last_receipt - 1, 'changed_items': 2, 'point_delta': 60}
+        job.save()
+        job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+        self.assertEqual(job.result['changed_items'], 3)
+        self.receipts[0].refresh_from_db()
+        self.receipts[2].refresh_from_db()
+        self.assertEqual(self.receipts[0].points_earned, 0)
+        self.assertEqual(self.receipts[2].points_earned, 30)
+
+    def test_resume_skips_running_job_until_stale(self):
+        job = BackgroundJobService.enqueue(ReceiptRescoreService.JOB_KIND, params={'pause': 0})
+        BackgroundJobService.claim(job_id=job.pk)
+        with self.assertRaises(CommandError):
+            call_command('rescore_receipts', '--resume', '--pause', '0', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+
+        # 一定時間更新のない実行中ジョブはワーカー停止とみなして再開する
+        BackgroundJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        call_command('rescore_receipts', '--resume', '--pause', '0', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'completed')
+
+    def test_unapproving_product_rescores(self):
+        self._run(chunk_size=10, pause=0)
+        eco_product = EcoProduct.objects.get(name='つめかえ用シャンプー')
+        eco_product.status = 'rejected'
+        with self.captureOnCommitCallbacks(execute=True):
+            eco_product.save()
+        job = BackgroundJob.objects.get(kind=ReceiptRescoreService.JOB_KIND, status='pending')
+        job.params = {'pause': 0}
+        job.save()
+        job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+        self.assertEqual(job.result['point_delta'], -90)
+        self.receipts[0].refresh_from_db()
+        self.assertEqual(self.receipts[0].points_earned, 0)
+
+    def test_parallel_workers(self):
+        job = self._run(chunk_size=1, workers=2, pause=0)
+        self.assertEqual(job.status, 'completed', job.error)
+        self.assertEqual(job.result['changed_items'], 3)
+
+
+class ReceiptReparseServiceTests(TestCase):
+    OCR_TEXT = "\n".join([
+        'エコマート',
+        '渋谷店',
+        '2025年1月10日(金) 12:30',
+        '0001 つめかえ用シャンプー ¥300',
+        '0002 ポテトチップス ¥150',
+        '小計 ¥450',
+    ])
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='reparse', email='reparse@example.com', password='pass')
+        EcoProduct.objects.create(name='ポテトチップス', points=5, is_common=True)
+        # 古い解析ロジックで保存されたレシート（1商品しか抽出できていない）
+        stale = {'items': [{'name': 'つめかえ用シャンプー', 'quantity': 1, 'price': 300}],
+                 'total_quantity': 1, 'total_amount': 0}
+        self.receipt = ReceiptService.save_scanned_receipt(self.user, '/media/old.jpg', self.OCR_TEXT, stale)
+        Receipt.objects.filter(pk=self.receipt.pk).update(parser_version=0)
+
+    def test_dry_run_reports_without_writing(self):
+        counts = ReceiptReparseService.dry_run()
+        self.assertEqual(counts, {'examined': 1, 'changed': 1, 'item_count': 1, 'totals': 1, 'date': 1})
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.parser_version, 0)
+        self.assertEqual(self.receipt.items.count(), 1)
+
+    def test_reparse_applies_changes(self):
+        job = BackgroundJobService.execute(ReceiptReparseService.schedule(params={'pause': 0}))
+        self.assertEqual(job.status, 'completed', job.error)
+        self.receipt.refresh_from_db()
+        self.assertEqual(self.receipt.parser_version, PARSER_VERSION)
+        self.assertEqual(self.receipt.parsed_data['total_amount'], 450)
+        self.assertEqual(self.receipt.transaction_time.year, 2025)
+        self.assertEqual(self.receipt.items.count(), 2)
+        self.assertEqual(self.receipt.points_earned, 5)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.current_points, 5)
+        # 最新バージョンのレシートは対象外
+        self.assertEqual(ReceiptReparseService.dry_run()['examined'], 0)
+
+
+class ReceiptFingerprintTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='dup', email='dup@example.com', password='pass')
+        self.parsed = {'items': [{'name': '牛乳', 'quantity': 1, 'price': 200}]}
+
+    def test_fingerprint_ignores_whitespace_and_width(self):
+        self.assertEqual(compute_ocr_fingerprint('ＡＢＣ 合計\n¥200'), compute_ocr_fingerprint('abc合計 ¥200 '))
+        self.assertIsNone(compute_ocr_fingerprint(' \n'))
+
+    def test_duplicate_is_rejected_by_constraint(self):
+        ReceiptService.save_scanned_receipt(self.user, '/media/a.jpg', '店A\n合計 ¥200', self.parsed)
+        self.assertTrue(ReceiptService.is_duplicate(self.user, '店A 合計 ¥200'))
+        # 事前チェックをすり抜けた同時アップロードもDBで拒否される
+        with self.assertRaises(DuplicateReceiptError):
+            ReceiptService.save_scanned_receipt(self.user, '/media/b.jpg', '店A 合計 ¥200', self.parsed)
+        self.assertEqual(Receipt.objects.filter(user=self.user).count(), 1)
+
+    def test_same_text_allowed_for_other_users(self):
+        other = CustomUser.objects.create_user(username='other', email='other@example.com', password='pass')
+        ReceiptService.save_scanned_receipt(self.user, '/media/a.jpg', '店A', self.parsed)
+        ReceiptService.save_scanned_receipt(other, '/media/b.jpg', '店A', self.parsed)
+        self.assertFalse(ReceiptService.is_duplicate(self.user, '店B'))
+
+
+class NearDuplicateReceiptTests(TestCase):
+    OCR_TEXT = "\n".join([
+        'エコマート', '渋谷店', '2025年1月10日(金) 12:30',
+        '0001 つめかえ用シャンプー ¥300', '0002 ポテトチップス ¥150', '0003 牛乳 ¥198', '0004 食パン ¥158',
+        '小計 ¥806', '合計 ¥870', 'お預り ¥1000', 'お釣り ¥130', 'レジ001 担当 山田',
+    ])
+    # 撮り直しによるOCR揺れ
+    RESHOT_TEXT = OCR_TEXT.replace('シャンプー', 'シャンブー').replace('¥150', '¥15O')
+    OTHER_TEXT = "\n".join([
+        'グリーンストア', '新宿店', '2025年2月3日(月) 09:12',
+        '0001 再生紙ノート ¥220', '0002 緑茶 ¥130', '小計 ¥350', '合計 ¥378', 'レジ002 担当 佐藤',
+    ])
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='near', email='near@example.com', password='pass')
+        self.other = CustomUser.objects.create_user(username='far', email='far@example.com', password='pass')
+        self.receipt = ReceiptService.save_scanned_receipt(self.user, '/media/a.jpg', self.OCR_TEXT, {'items': []})
+
+    def test_reshot_receipt_is_found_via_bands(self):
+        with CaptureQueriesContext(connection) as queries:
+            found = ReceiptService.find_near_duplicate(self.user, self.RESHOT_TEXT)
+        self.assertEqual(found.pk, self.receipt.pk)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('minhash_band', queries[0]['sql'])
+        self.assertIsNone(ReceiptService.find_near_duplicate(self.user, self.OTHER_TEXT))
+        # 他のユーザーの履歴は、同じ店舗・同日でなければ対象外
+        self.assertIsNone(ReceiptService.find_near_duplicate(self.other, self.RESHOT_TEXT))
+
+    def test_audit_clusters_near_duplicates(self):
+        duplicate = ReceiptService.save_scanned_receipt(self.user, '/media/b.jpg', self.RESHOT_TEXT, {'items': []})
+        ReceiptService.save_scanned_receipt(self.user, '/media/c.jpg', self.OTHER_TEXT, {'items': []})
+        ReceiptService.save_scanned_receipt(self.other, '/media/d.jpg', self.OCR_TEXT, {'items': []})
+        clusters, stats = ReceiptService.find_near_duplicate_clusters()
+        self.assertEqual(stats['scanned'], 4)
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual(len(clusters[0]), 3)
+        clusters, _stats = ReceiptService.find_near_duplicate_clusters(same_user=True)
+        self.assertEqual(clusters, [[self.receipt.pk, duplicate.pk]])
+
+
+class ReceiptImageHashTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='photo', email='photo@example.com', password='pass')
+        rng = np.random.default_rng(0)
+        self.image = cv2.GaussianBlur((rng.random((400, 300)) * 255).astype(np.uint8), (51, 51), 0)
+
+    def _encode(self, image):
+        _ok, buffer = cv2.imencode('.jpg', image)
+        return buffer.tobytes()
+
+    def test_reshot_image_is_detected(self):
+        image_hash = compute_image_hash(self._encode(self.image))
+        receipt = ReceiptService.save_scanned_receipt(
+            self.user, '/media/a.jpg', 'ocr', {'items': []}, image_hash=image_hash)
+        # 明るさと縮尺が異なる撮り直し
+        reshot = cv2.resize(np.clip(self.image * 1.1 + 10, 0, 255).astype(np.uint8), (250, 330))
+        self.assertEqual(ReceiptService.find_similar_image(self.user, compute_image_hash(self._encode(reshot))), receipt.pk)
+        rotated = np.ascontiguousarray(self.image.T)
+        self.assertIsNone(ReceiptService.find_similar_image(self.user, compute_image_hash(self._encode(rotated))))
+        self.assertIsNone(compute_image_hash(b'not an image'))
+
+    def test_backfill_command_hashes_stored_images(self):
+        with tempfile.TemporaryDirectory() as media_root:
+            os.makedirs(os.path.join(media_root, 'receipts'))
+            with open(os.path.join(media_root, 'receipts', 'a.jpg'), 'wb') as f:
+                f.write(self._encode(self.image))
+            stored = ReceiptService.save_scanned_receipt(self.user, '/media/receipts/a.jpg', 'ocr1', {'items': []})
+            missing = ReceiptService.save_scanned_receipt(self.user, '/media/receipts/gone.jpg', 'ocr2', {'items': []})
+            with self.settings(MEDIA_ROOT=media_root):
+                call_command('backfill_image_hashes', workers=1, stdout=StringIO())
+        stored.refresh_from_db()
+        missing.refresh_from_db()
+        self.assertEqual(stored.image_hash, compute_image_hash(self._encode(self.image)))
+        self.assertIsNone(missing.image_hash)
+
+
+class PointLedgerTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='ledger', email='ledger@example.com', password='pass')
+
+    def test_stale_instances_do_not_lose_updates(self):
+        first = CustomUser.objects.get(pk=self.user.pk)
+        second = CustomUser.objects.get(pk=self.user.pk)
+        first.add_points(60, reason='scan')
+        self.assertEqual(second.add_points(50, reason='scan'), 110)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.current_points, 110)
+        self.assertEqual(self.user.rank, 'sprout')
+        self.assertEqual(list(self.user.point_transactions.order_by('pk').values_list('delta', flat=True)), [60, 50])
+
+    def test_rank_reward_uses_returned_balance(self):
+        coupon = Coupon.objects.create(title='ブロンズランク特典', description='特典', type='absolute', discount_value=100)
+        RewardRule.objects.create(kind='rank_reached', rank='sprout', coupon=coupon)
+        self.addCleanup(invalidate_reward_rules)
+        stale = CustomUser.objects.get(pk=self.user.pk)
+        self.user.add_points(90, reason='scan')
+        stale.add_points(20, reason='scan')
+        self.assertTrue(self.user.current_coupons.filter(pk=coupon.pk).exists())
+
+
+class MonthlyRolloverTests(TestCase):
+    def setUp(self):
+        self.month_start = MonthlyRolloverService.month_start()
+        last_month = (self.month_start - timedelta(days=1)).replace(day=1)
+        self.active = CustomUser.objects.create_user(username='active', email='active@example.com', password='pass')
+        self.active.add_points(350, reason='scan')
+        self.idle = CustomUser.objects.create_user(username='idle', email='idle@example.com', password='pass')
+        self.new = CustomUser.objects.create_user(username='new', email='new@example.com', password='pass')
+        CustomUser.objects.filter(pk__in=[self.active.pk, self.idle.pk]).update(last_reset_month=last_month)
+
+    def test_rollover_is_set_based_and_idempotent(self):
+        with CaptureQueriesContext(connection) as queries:
+            counts = MonthlyRolloverService.rollover(self.month_start)
+        self.assertEqual(counts, {'reset': 2, 'initialized': 1})
+        self.assertLessEqual(len(queries), 6)
+
+        self.active.refresh_from_db()
+        self.assertEqual((self.active.current_points, self.active.lastmonth_point, self.active.rank), (0, 350, 'seed'))
+        self.assertEqual(self.active.last_reset_month, self.month_start)
+        self.assertEqual(self.active.point_transactions.filter(reason='rollover').get().delta, -350)
+        self.assertFalse(self.idle.point_transactions.exists())
+        self.new.refresh_from_db()
+        self.assertEqual(self.new.last_reset_month, self.month_start)
+
+        call_command('rollover_month', stdout=StringIO())
+        self.assertEqual(MonthlyRolloverService.rollover(self.month_start), {'reset': 0, 'initialized': 0})
+        self.assertEqual(PointTransaction.objects.filter(reason='rollover').count(), 1)
+
+    def test_rollover_transactions_are_recorded_in_batches(self):
+        self.idle.add_points(40, reason='scan')
+        with mock.patch.object(MonthlyRolloverService, 'BATCH_SIZE', 1):
+            MonthlyRolloverService.rollover(self.month_start)
+        self.assertEqual(
+            sorted(PointTransaction.objects.filter(reason='rollover').values_list('user_id', 'delta')),
+            [(self.active.pk, -350), (self.idle.pk, -40)],
+        )
+
+    def test_middleware_does_not_query_after_rollover(self):
+        MonthlyRolloverService.rollover(self.month_start)
+        middleware = MonthlyPointResetMiddleware(lambda request: None)
+        request = SimpleNamespace(user=CustomUser.objects.get(pk=self.active.pk))
+        with CaptureQueriesContext(connection) as queries:
+            middleware(request)
+        self.assertEqual(len(queries), 0)
+
+
+class RewardEngineTests(TestCase):
+    def setUp(self):
+        self.addCleanup(invalidate_reward_rules)
+        self.bronze = Coupon.objects.create(title='芽特典', description='特典', type='absolute', discount_value=100)
+        self.milestone = Coupon.objects.create(title='500pt記念', description='特典', type='absolute', discount_value=50)
+        RewardRule.objects.create(kind='rank_reached', rank='sprout', coupon=self.bronze)
+        RewardRule.objects.create(kind='points_milestone', points=500, coupon=self.milestone)
+        self.users = [
+            CustomUser.objects.create_user(username=f'rule{i}', email=f'rule{i}@example.com', password='pass')
+            for i in range(3)
+        ]
+
+    def test_rules_are_evaluated_without_queries(self):
+        get_reward_engine()
+        with CaptureQueriesContext(connection) as queries:
+            engine = get_reward_engine()
+            self.assertEqual(engine.rank_for_points(150), 'sprout')
+            self.assertEqual(engine.progress(150), (100, 300))
+            self.assertEqual(engine.rewards_for(90, 150), [self.bronze.pk])
+            self.assertEqual(engine.rewards_for(450, 520), [self.milestone.pk])
+        self.assertEqual(len(queries), 0)
+
+    def test_tier_change_invalidates_cache(self):
+        self.assertEqual(CustomUser.rank_for_points(150), 'sprout')
+        RankTier.objects.filter(code='sprout').update(min_points=200)
+        RankTier.objects.get(code='sprout').save()
+        self.assertEqual(CustomUser.rank_for_points(150), 'seed')
+
+    def test_bulk_rewards_use_one_insert(self):
+        entries = [(user.pk, 120, None) for user in self.users]
+        with CaptureQueriesContext(connection) as queries:
+            PointLedgerService.apply_bulk(entries, reason='adjustment')
+        inserts = [q['sql'] for q in queries if q['sql'].startswith('INSERT') and 'accounts_customuser_current_coupons' in q['sql']]
+        self.assertEqual(len(inserts), 1)
+        for user in self.users:
+            self.assertEqual(list(user.current_coupons.values_list('pk', flat=True)), [self.bronze.pk])
+
+
+class CouponGrantServiceTests(TestCase):
+    def setUp(self):
+        self.coupon = Coupon.objects.create(
+            title='100pt以上', description='特典', type='absolute', discount_value=100, required_points=100)
+        self.users = [
+            CustomUser.objects.create_user(username=f'grant{i}', email=f'grant{i}@example.com', password='pass')
+            for i in range(7)
+        ]
+        CustomUser.objects.filter(pk__in=[user.pk for user in self.users[:5]]).update(current_points=150)
+        self.users[0].current_coupons.add(self.coupon)
+
+    def test_grant_skips_holders_with_constant_queries_per_chunk(self):
+        with CaptureQueriesContext(connection) as queries:
+            granted = CouponGrantService.grant(self.coupon, chunk_size=2)
+        self.assertEqual(granted, 4)
+        # 2人ずつ2チャンク: (取得 + 一括登録) × 2 + 終端の取得
+        self.assertEqual(len(queries), 5)
+        self.assertEqual(self.coupon.customuser_set.count(), 5)
+        self.assertEqual(CouponGrantService.grant(self.coupon), 0)
+
+    def test_background_job_reports_progress(self):
+        job = CouponGrantService.schedule(self.coupon, chunk_size=3)
+        job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+        self.assertEqual(job.status, 'completed', job.error)
+        self.assertEqual((job.progress, job.total, job.result['granted']), (4, 4, 4))
+
+    def test_rule_rewards_grant_by_rank(self):
+        RewardRule.objects.create(kind='rank_reached', rank='sprout', coupon=self.coupon)
+        self.addCleanup(invalidate_reward_rules)
+        CustomUser.objects.filter(pk=self.users[5].pk).update(rank='sprout')
+        granted = CouponGrantService.grant_rule_rewards()
+        self.assertEqual(granted, {self.coupon: 1})
+
+
+class CouponStatsServiceTests(TestCase):
+    def setUp(self):
+        self.store = Store.objects.create(store_name='A店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.other_store = Store.objects.create(store_name='B店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.coupons = [
+            Coupon.objects.create(title=f'クーポン{i}', description='特典', type='absolute', discount_value=100)
+            for i in range(3)
+        ]
+        self.users = [
+            CustomUser.objects.create_user(username=f'stats{i}', email=f'stats{i}@example.com', password='pass')
+            for i in range(3)
+        ]
+        for user in self.users:
+            user.current_coupons.add(self.coupons[0])
+        CouponUsage.objects.create(user=self.users[0], coupon=self.coupons[0], store=self.store)
+        CouponUsage.objects.create(user=self.users[1], coupon=self.coupons[0], store=self.other_store)
+        CouponUsage.objects.create(user=self.users[2], coupon=self.coupons[1], store=self.store)
+        CouponStatsService.invalidate()
+
+    def test_compute_in_single_query(self):
+        with self.assertNumQueries(1):
+            stats = {stat['coupon'].pk: stat for stat in CouponStatsService.compute(self.store)}
+        first = stats[self.coupons[0].pk]
+        self.assertEqual((first['issued_count'], first['usage_count'], first['store_usage_count']), (5, 2, 1))
+        self.assertEqual(first['usage_ratio'], 40.0)
+        self.assertEqual(stats[self.coupons[1].pk]['issued_count'], 1)
+        self.assertEqual(stats[self.coupons[2].pk]['usage_ratio'], 0)
+
+    def test_cached_per_store_and_invalidated_on_use(self):
+        CouponStatsService.stats_for(self.store)
+        with self.assertNumQueries(0):
+            CouponStatsService.stats_for(self.store)
+        with self.assertNumQueries(1):
+            CouponStatsService.stats_for(self.other_store)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CouponUsage.objects.create(user=self.users[2], coupon=self.coupons[2], store=self.store)
+        stats = {stat['coupon'].pk: stat for stat in CouponStatsService.stats_for(self.store)}
+        self.assertEqual(stats[self.coupons[2].pk]['store_usage_count'], 1)
+
+    def test_staff_index_queries_do_not_grow_with_coupons(self):
+        staff = CustomUser.objects.create_user(
+            username='staff', email='staff@example.com', password='pass', role='store', store=self.store, is_staff=True)
+        self.client.force_login(staff)
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(reverse('core:staff_index'))
+        for i in range(5):
+            Coupon.objects.create(title=f'追加{i}', description='特典', type='absolute', discount_value=100)
+        CouponStatsService.invalidate()
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get(reverse('core:staff_index'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['coupon_stats']), 8)
+        self.assertEqual(len(before), len(after))
+
+
+class CouponEligibilityServiceTests(TestCase):
+    def setUp(self):
+        def coupon(title, required_points, status='approved'):
+            return Coupon.objects.create(
+                title=title, description='特典', type='absolute', discount_value=100,
+                required_points=required_points, status=status)
+
+        self.owned = coupon('所持', 100)
+        self.used = coupon('使用済み', 200)
+        self.same_tier = coupon('同じポイント帯', 100)
+        self.available = coupon('取得可能', 300)
+        self.expensive = coupon('ポイント不足', 1000)
+        self.pending = coupon('申請中', 400, status='pending')
+        self.user = CustomUser.objects.create_user(username='eligible', email='eligible@example.com', password='pass')
+        CustomUser.objects.filter(pk=self.user.pk).update(current_points=500)
+        self.user.refresh_from_db()
+        self.user.current_coupons.add(self.owned)
+        CouponUsage.objects.create(user=self.user, coupon=self.used)
+        CouponEligibilityService.invalidate()
+
+    def test_states_from_single_query(self):
+        with self.assertNumQueries(1):
+            eligibility = CouponEligibilityService.for_user(self.user)
+        self.assertEqual(eligibility.state(self.owned), 'owned')
+        self.assertEqual(eligibility.state(self.used), 'used')
+        self.assertEqual(eligibility.state(self.same_tier), 'owned_tier')
+        self.assertEqual(eligibility.state(self.available), 'available')
+        with self.assertNumQueries(0):
+            self.assertEqual(CouponEligibilityService.check(self.user, self.expensive), 'insufficient_points')
+            self.assertEqual(CouponEligibilityService.check(self.user, self.pending), 'not_approved')
+            self.assertIsNone(CouponEligibilityService.check(self.user, self.available))
+
+    def test_coupons_for_partitions_coupons(self):
+        owned, available, used = CouponEligibilityService.coupons_for(self.user)
+        self.assertEqual(owned, [self.owned])
+        self.assertEqual(available, [self.available, self.expensive])
+        self.assertEqual(used, [self.used])
+
+    def test_acquire_invalidates_cached_eligibility(self):
+        self.client.force_login(self.user)
+        CouponEligibilityService.for_user(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('core:acquire_coupon', args=[self.available.pk]))
+        self.assertTrue(response.json()['success'])
+
+        response = self.client.post(reverse('core:acquire_coupon', args=[self.available.pk]))
+        self.assertEqual(response.json()['error'], '既にこのクーポンを持っています。')
+        response = self.client.post(reverse('core:acquire_coupon', args=[self.same_tier.pk]))
+        self.assertEqual(response.json()['error'], 'このポイント帯のクーポンは既に取得済みです。')
+        response = self.client.get(reverse('core:coupon_list'))
+        self.assertEqual(response.context['coupons'], [self.owned, self.available])
+
+    def test_acquire_does_not_trust_stale_cache(self):
+        # 他のワーカーで付与されたが、このプロセスのキャッシュには反映されていない状態
+        CouponEligibilityService.for_user(self.user)
+        CustomUser.current_coupons.through.objects.create(customuser_id=self.user.pk, coupon_id=self.available.pk)
+        other_tier = Coupon.objects.create(
+            title='同じポイント帯2', description='特典', type='absolute', discount_value=100, required_points=300,
+            status='approved')
+        self.assertEqual(CouponEligibilityService.acquire(self.user, self.available), 'owned')
+        self.assertEqual(CouponEligibilityService.acquire(self.user, other_tier), 'owned_tier')
+        self.assertFalse(self.user.current_coupons.filter(pk=other_tier.pk).exists())
+
+
+class CouponRedemptionServiceTests(TestCase):
+    def setUp(self):
+        self.store = Store.objects.create(store_name='POS店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.coupons = [
+            Coupon.objects.create(title=f'利用{i}', description='特典', type='absolute', discount_value=100)
+            for i in range(2)
+        ]
+        self.user = CustomUser.objects.create_user(username='redeem', email='redeem@example.com', password='pass')
+        self.user.current_coupons.add(*self.coupons)
+
+    def test_redeem_once(self):
+        usage, replayed = CouponRedemptionService.redeem(self.user.pk, self.coupons[0].pk, store_id=self.store.pk)
+        self.assertFalse(replayed)
+        self.assertEqual(usage.store, self.store)
+        self.assertFalse(self.user.current_coupons.filter(pk=self.coupons[0].pk).exists())
+        with self.assertRaises(CouponRedemptionError) as raised:
+            CouponRedemptionService.redeem(self.user.pk, self.coupons[0].pk)
+        self.assertEqual(raised.exception.code, 'not_owned')
+        self.assertEqual(CouponUsage.objects.count(), 1)
+
+    def test_idempotency_key_replays_first_result(self):
+        usage, _ = CouponRedemptionService.redeem(self.user.pk, self.coupons[0].pk, idempotency_key='pos-1')
+        replay, replayed = CouponRedemptionService.redeem(self.user.pk, self.coupons[0].pk, idempotency_key='pos-1')
+        self.assertTrue(replayed)
+        self.assertEqual(replay.pk, usage.pk)
+        with self.assertRaises(CouponRedemptionError) as raised:
+            CouponRedemptionService.redeem(self.user.pk, self.coupons[1].pk, idempotency_key='pos-1')
+        self.assertEqual(raised.exception.code, 'key_conflict')
+
+    def test_batch_endpoint_records_store_and_per_item_results(self):
+        staff = CustomUser.objects.create_user(
+            username='pos', email='pos@example.com', password='pass', role='store', store=self.store)
+        self.client.force_login(staff)
+        payload = {'redemptions': [
+            {'user_id': self.user.pk, 'coupon_id': self.coupons[0].pk, 'idempotency_key': 'a'},
+            {'user_id': self.user.pk, 'coupon_id': self.coupons[0].pk, 'idempotency_key': 'a'},
+            {'user_id': self.user.pk, 'coupon_id': self.coupons[0].pk, 'idempotency_key': 'b'},
+            {'user_id': self.user.pk, 'coupon_id': self.coupons[1].pk, 'idempotency_key': 'c'},
+            {'user_id': 'x', 'coupon_id': self.coupons[1].pk},
+        ]}
+        response = self.client.post(reverse('core:redeem_coupons'), payload, content_type='application/json')
+        results = response.json()['results']
+        self.assertEqual([result['success'] for result in results], [True, True, False, True, False])
+        self.assertTrue(results[1]['replayed'])
+        self.assertEqual((results[2]['error'], results[4]['error']), ('not_owned', 'invalid'))
+        self.assertEqual(set(CouponUsage.objects.values_list('store', flat=True)), {self.store.pk})
+        self.assertEqual(CouponUsage.objects.count(), 2)
+
+
+class ConcurrentCouponRedemptionTests(TransactionTestCase):
+    def test_concurrent_redemptions_use_coupon_once(self):
+        coupon = Coupon.objects.create(title='同時利用', description='特典', type='absolute', discount_value=100)
+        user = CustomUser.objects.create_user(username='tap', email='tap@example.com', password='pass')
+        user.current_coupons.add(coupon)
+        outcomes = []
+        barrier = threading.Barrier(8)
+
+        def tap():
+            barrier.wait()
+            try:
+                CouponRedemptionService.redeem(user.pk, coupon.pk)
+                outcomes.append('redeemed')
+            except CouponRedemptionError:
+                outcomes.append('rejected')
+            except OperationalError:
+                # sqlite はテーブルロック中の書き込みを即時にエラーとする
+                outcomes.append('locked')
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=tap) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes.count('redeemed'), 1)
+        self.assertEqual(CouponUsage.objects.filter(user=user, coupon=coupon).count(), 1)
+
+
+class CouponTokenTests(SimpleTestCase):
+    def test_round_trip_and_tampering(self):
+        token = issue_token(12, 34, 'shared-key', ttl=60, now=1000, nonce='abc')
+        self.assertEqual(verify_token(token, 'shared-key', now=1030), (12, 34, 1060, 'abc'))
+
+        for bad_token, code in [
+            (token, 'bad_signature'),
+            ('not-a-token', 'malformed'),
+            (token.replace('.', '.A', 1), 'bad_signature'),
+        ]:
+            key = 'other-key' if bad_token is token else 'shared-key'
+            with self.assertRaises(CouponTokenError) as raised:
+                verify_token(bad_token, key, now=1030)
+            self.assertEqual(raised.exception.code, code)
+
+    def test_expiry_with_leeway(self):
+        token = issue_token(1, 2, 'shared-key', ttl=60, now=1000)
+        with self.assertRaises(CouponTokenError) as raised:
+            verify_token(token, 'shared-key', now=1061)
+        self.assertEqual(raised.exception.code, 'expired')
+        self.assertEqual(verify_token(token, 'shared-key', now=1061, leeway=10).coupon_id, 2)
+
+
+class CouponTokenServiceTests(TestCase):
+    def setUp(self):
+        self.store = Store.objects.create(store_name='端末店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.coupon = Coupon.objects.create(title='トークン', description='特典', type='absolute', discount_value=100)
+        self.user = CustomUser.objects.create_user(username='holder', email='holder@example.com', password='pass')
+        self.user.current_coupons.add(self.coupon)
+        self.staff = CustomUser.objects.create_user(
+            username='till', email='till@example.com', password='pass', role='store', store=self.store)
+
+    def test_coupon_list_issues_verifiable_tokens(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('core:coupon_list'))
+        token = response.context['coupons'][0].token
+        self.assertContains(response, token)
+        claims = verify_token(token, CouponTokenService.key())
+        self.assertEqual((claims.user_id, claims.coupon_id), (self.user.pk, self.coupon.pk))
+
+    def test_reported_tokens_are_redeemed_once(self):
+        token = CouponTokenService.issue(self.user, [self.coupon])[self.coupon.pk]
+        self.client.force_login(self.staff)
+        response = self.client.post(
+            reverse('core:report_coupon_tokens'), {'tokens': [token, 'forged.token']}, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['rejected'], [{'index': 1, 'error': 'malformed'}])
+
+        # 同じトークンの再報告はノンスで重複と判定される
+        self.client.post(reverse('core:report_coupon_tokens'), {'tokens': [token]}, content_type='application/json')
+        jobs = BackgroundJob.objects.filter(kind=CouponTokenService.JOB_KIND).order_by('pk')
+        results = [BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk)).result for job in jobs]
+        self.assertEqual([(result['redeemed'], result['replayed']) for result in results], [(1, 0), (0, 1)])
+        usage = CouponUsage.objects.get()
+        self.assertEqual((usage.user, usage.store), (self.user, self.store))
+        self.assertFalse(self.user.current_coupons.exists())
+
+
+class CouponUsageRollupTests(TestCase):
+    def setUp(self):
+        self.store = Store.objects.create(store_name='集計店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.coupon = Coupon.objects.create(title='集計', description='特典', type='absolute', discount_value=100)
+        self.users = [
+            CustomUser.objects.create_user(username=f'rollup{i}', email=f'rollup{i}@example.com', password='pass')
+            for i in range(5)
+        ]
+        CustomUser.objects.filter(pk=self.users[0].pk).update(rank='tree')
+        for user in self.users:
+            user.current_coupons.add(self.coupon)
+            CouponRedemptionService.redeem(user.pk, self.coupon.pk, store_id=self.store.pk)
+
+    def test_redemptions_increment_rollups(self):
+        self.assertEqual(CouponUsageRollupService.total(self.coupon), 5)
+        self.assertEqual(CouponUsageRollupService.breakdown(self.coupon, 'rank', store=self.store),
+                         [('seed', 4), ('tree', 1)])
+        self.assertEqual(sum(count for _start, count in CouponUsageRollupService.timeline(self.coupon, 'hour', 3)), 5)
+
+        rows = CouponUsageRollup.objects.count()
+        CouponUsageRollup.objects.all().delete()
+        self.assertEqual(CouponUsageRollupService.rebuild(), rows)
+        self.assertEqual(CouponUsageRollupService.total(self.coupon), 5)
+
+    def test_storeless_rollups_are_unique(self):
+        for user in self.users[1:3]:
+            user.current_coupons.add(self.coupon)
+            CouponRedemptionService.redeem(user.pk, self.coupon.pk, rank=user.rank)
+        row = CouponUsageRollup.objects.get(store=None, granularity='day')
+        self.assertEqual((row.rank, row.count), ('seed', 2))
+        # 同時に最初の利用を記録した場合も、店舗なしの集計行は重複しない
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CouponUsageRollup.objects.create(
+                coupon=self.coupon, store=None, rank='seed', granularity='day', bucket=row.bucket, count=1)
+
+    def test_redeem_uses_given_rank(self):
+        counts = []
+        for user, rank in ((self.users[1], None), (self.users[2], 'seed')):
+            user.current_coupons.add(self.coupon)
+            with CaptureQueriesContext(connection) as queries:
+                CouponRedemptionService.redeem(user.pk, self.coupon.pk, store_id=self.store.pk, rank=rank)
+            counts.append(len(queries))
+        # ランクを渡した場合はランクの読み直しを省く
+        self.assertEqual(counts[1], counts[0] - 1)
+
+    def test_stats_detail_pages_history_by_keyset(self):
+        admin = CustomUser.objects.create_user(
+            username='rollup_admin', email='rollup_admin@example.com', password='pass', role='admin', is_staff=True)
+        self.client.force_login(admin)
+        url = reverse('core:coupon_stats_detail', args=[self.coupon.pk])
+        seen = []
+        with self.settings(COUPON_HISTORY_PAGE_SIZE=2):
+            response = self.client.get(url)
+            self.assertEqual(response.context['chart_data'], '[5]')
+            while True:
+                seen.extend(usage.pk for usage in response.context['usage_history'])
+                if not response.context['next_cursor']:
+                    break
+                response = self.client.get(url, {'before': response.context['next_cursor']})
+        self.assertEqual(seen, list(CouponUsage.objects.order_by('-used_at', '-id').values_list('pk', flat=True)))
+
+
+class StoreIndexTests(SimpleTestCase):
+    def setUp(self):
+        rows = [
+            (1, '東京駅店', 'retail', 35.6812, 139.7671, '東京都千代田区', '', None, None),
+            (2, '有楽町店', 'restaurant', 35.6751, 139.7630, '東京都千代田区', '', None, None),
+            (3, '新宿店', 'retail', 35.6896, 139.7006, '東京都新宿区', '', None, None),
+            (4, '大阪店', 'retail', 34.7025, 135.4959, '大阪府大阪市', '', None, None),
+            (5, '未設定店', 'retail', 0.0, 0.0, '不明', '', None, None),
+        ]
+        self.index = StoreIndex(rows, version='v1')
+
+    def ids(self, indices):
+        return sorted(self.index.records[i]['id'] for i in indices)
+
+    def test_bbox_and_filters(self):
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.ids(self.index.in_bbox(35.6, 139.6, 35.8, 139.8)), [1, 2, 3])
+        self.assertEqual(self.ids(self.index.in_bbox(35.6, 139.6, 35.8, 139.8, category='retail')), [1, 3])
+        self.assertEqual(self.ids(self.index.in_bbox(35.6, 139.6, 35.8, 139.8, keyword='新宿')), [3])
+        self.assertEqual(self.ids(self.index.in_bbox(20, 120, 50, 150)), [1, 2, 3, 4])
+
+    def test_clusters_by_zoom(self):
+        indices = self.index.in_bbox(20, 120, 50, 150)
+        clusters, singles = self.index.clusters(indices, zoom=4)
+        self.assertEqual(sum(cluster['count'] for cluster in clusters) + len(singles), 4)
+        self.assertEqual([store['id'] for store in singles], [4])
+        clusters, singles = self.index.clusters(indices, zoom=14)
+        self.assertEqual((clusters, len(singles)), ([], 4))
+
+    def test_nearest_within_radius(self):
+        nearest = self.index.nearest(35.6812, 139.7671, k=2, radius_km=10)
+        self.assertEqual([store['id'] for store, _distance in nearest], [1, 2])
+        self.assertAlmostEqual(nearest[1][1], 0.77, places=1)
+        self.assertEqual(len(self.index.nearest(35.6812, 139.7671, k=5, radius_km=10)), 3)
+        self.assertEqual(self.index.nearest(35.6812, 139.7671, radius_km=10, category='restaurant')[0][0]['id'], 2)
+        self.assertEqual(self.index.nearest(0.5, 0.5), [])
+
+
+class StoreMapDataTests(TestCase):
+    def setUp(self):
+        Store.objects.create(store_name='地図店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        user = CustomUser.objects.create_user(username='mapper', email='mapper@example.com', password='pass')
+        self.client.force_login(user)
+        self.url = reverse('core:store_map_data')
+        self.params = {'bbox': '35.6,139.6,35.8,139.8', 'zoom': 16}
+
+    def test_compact_stores_with_etag(self):
+        response = self.client.get(self.url, self.params)
+        store = response.json()['stores'][0]
+        self.assertEqual(set(store), {'id', 'name', 'category', 'lat', 'lng', 'address', 'tel', 'open', 'close'})
+        etag = response['ETag']
+
+        response = self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Store.objects.create(store_name='新店', category='retail', address='東京都', lat=35.70, lng=139.70)
+        response = self.client.get(self.url, self.params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.json()['stores']), 2)
+
+    def test_index_is_rebuilt_after_max_age(self):
+        index = get_store_index()
+        # シグナルを経由しない変更（他のプロセスでの変更）は STORE_INDEX_MAX_AGE 秒以内は反映されない
+        Store.objects.filter(store_name='地図店').update(lat=35.70)
+        self.assertIs(get_store_index(), index)
+
+        with self.settings(STORE_INDEX_MAX_AGE=0):
+            rebuilt = get_store_index()
+            self.assertEqual(rebuilt.records[0]['lat'], 35.70)
+            self.assertNotEqual(rebuilt.etag('q'), index.etag('q'))
+            # 店舗データが同じであれば作り直してもETagは変わらない
+            self.assertEqual(get_store_index().etag('q'), rebuilt.etag('q'))
+
+    def test_invalid_bbox(self):
+        self.assertEqual(self.client.get(self.url, {'bbox': 'tokyo'}).status_code, 400)
+
+    def test_nearest_stores(self):
+        response = self.client.get(reverse('core:nearest_stores'), {'lat': 35.681, 'lng': 139.767, 'k': 3})
+        stores = response.json()['stores']
+        self.assertEqual([store['name'] for store in stores], ['地図店'])
+        self.assertLess(stores[0]['distance_km'], 1)
+
+
+# 外部サービスに接続しないスタブのプロバイダーを使う
+@override_settings(GEOCODING_PROVIDERS=['stub'])
+class GeocodingServiceTests(TestCase):
+    def _run_job(self):
+        job = BackgroundJob.objects.get(kind=GeocodingService.JOB_KIND, status='pending')
+        return BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+
+    def test_save_enqueues_job_instead_of_geocoding(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            store = Store.objects.create(store_name='新店', category='retail', address='東京都千代田区丸の内1')
+        self.assertEqual((store.lat, store.lng), (0.0, 0.0))
+
+        job = self._run_job()
+        self.assertEqual((job.result['found'], job.result['missed']), (1, 0))
+        store.refresh_from_db()
+        self.assertNotEqual(store.lat, 0.0)
+
+        # 同じ住所（表記揺れ）の店舗はキャッシュから位置が入り、ジョブは登録されない
+        with self.captureOnCommitCallbacks(execute=True):
+            other = Store.objects.create(store_name='二号店', category='retail', address='東京都 千代田区丸の内１')
+        self.assertEqual((other.lat, other.lng), (store.lat, store.lng))
+        self.assertFalse(BackgroundJob.objects.filter(kind=GeocodingService.JOB_KIND, status='pending').exists())
+
+    def test_other_workers_index_picks_up_geocoded_stores(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            store = Store.objects.create(store_name='新店', category='retail', address='東京都千代田区丸の内1')
+        index = get_store_index()
+        self.assertEqual(len(index), 0)
+
+        # 別プロセスでジョブが実行された場合、このプロセスのキャッシュは無効にならない
+        with mock.patch('core.services.stores.invalidate_store_index'), self.captureOnCommitCallbacks(execute=True):
+            self._run_job()
+        self.assertIs(get_store_index(), index)
+
+        with self.settings(STORE_INDEX_MAX_AGE=0):
+            self.assertEqual([record['id'] for record in get_store_index().records], [store.pk])
+
+    def test_not_found_is_cached_briefly(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Store.objects.create(store_name='不明店', category='other', address='住所不明')
+        result = self._run_job().result
+        self.assertEqual((result['found'], result['missed']), (0, 1))
+        entry = GeocodeCache.objects.get()
+        self.assertFalse(entry.found)
+        self.assertLess(entry.expires_at, timezone.now() + timedelta(days=2))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Store.objects.create(store_name='不明店2', category='other', address='住所不明')
+        self.assertFalse(BackgroundJob.objects.filter(kind=GeocodingService.JOB_KIND, status='pending').exists())
+
+    def test_pending_jobs_are_coalesced(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Store.objects.create(store_name='A', category='retail', address='大阪府大阪市北区')
+            Store.objects.create(store_name='B', category='retail', address='福岡県福岡市中央区')
+        self.assertEqual(BackgroundJob.objects.filter(kind=GeocodingService.JOB_KIND).count(), 1)
+        result = self._run_job().result
+        self.assertEqual((result['found'], result['missed']), (2, 0))
+
+    def test_command_batches_and_resumes_from_checkpoint(self):
+        stores = [
+            Store.objects.create(store_name=f'店{i}', category='retail', address=f'東京都港区{i % 3}丁目', lat=35.0, lng=139.0)
+            for i in range(7)
+        ]
+        Store.objects.filter(pk__in=[store.pk for store in stores]).update(lat=0.0, lng=0.0)
+        job = BackgroundJobService.enqueue(GeocodingService.JOB_KIND, params={'batch_size': 2, 'workers': 3})
+        # 先頭2件を処理済みとして中断したジョブ
+        job.status = 'failed'
+        job.checkpoint = {'last_store_id': stores[1].pk, 'found': 2, 'missed': 0, 'cache_hits': 0, 'errors': 0}
+        job.progress = 2
+        job.save()
+
+        out = StringIO()
+        call_command('geocode_stores', '--resume', '--batch-size', '2', stdout=out)
+        job.refresh_from_db()
+        self.assertEqual(job.result['processed'], 7)
+        self.assertEqual(job.result['found'], 7)
+        # 住所は3種類のみのため、それ以降はキャッシュから取得される
+        self.assertEqual(job.result['cache_hits'], 2)
+        self.assertIn('件/秒', out.getvalue())
+        self.assertEqual(Store.objects.filter(pk__in=[s.pk for s in stores[:2]], lat=0.0).count(), 2)
+        self.assertFalse(Store.objects.filter(pk__in=[s.pk for s in stores[2:]], lat=0.0).exists())
+
+
+    def test_resume_skips_job_running_in_another_worker(self):
+        job = BackgroundJobService.enqueue(GeocodingService.JOB_KIND, params={'batch_size': 2})
+        BackgroundJobService.claim(job_id=job.pk)
+        with self.assertRaises(CommandError):
+            call_command('geocode_stores', '--resume', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'running')
+        self.assertEqual(job.progress, 0)
+
+class StoreResolverTests(SimpleTestCase):
+    def setUp(self):
+        self.resolver = StoreResolver(
+            [(1, 'ファミリーマート幕張本郷店', '043-123-4567'), (2, 'ファミリーマート幕張駅前店', ''), (3, 'イオン 船橋店', '')],
+            aliases=[(3, normalize_store_name('AEON船橋'))],
+        )
+
+    def test_normalization_and_tel_extraction(self):
+        self.assertEqual(normalize_store_name('株式会社 イオン　船橋店'), 'イオン船橋店')
+        self.assertEqual(extract_tels('TEL 03-1234-5678\n電話:０４７１２３４５６７\n2024/05/01 12:30'),
+                         ['0312345678', '0471234567'])
+
+    def test_resolution_order(self):
+        self.assertEqual(self.resolver.resolve('不明なヘッダー', ['0431234567'])[:2], (1, 'tel'))
+        self.assertEqual(self.resolver.resolve('イオン船橋店')[:2], (3, 'exact'))
+        self.assertEqual(self.resolver.resolve('ＡＥＯＮ 船橋')[:2], (3, 'exact'))
+        # OCRの誤認識 (ト → 卜) は類似度で照合し、別の支店には照合しない
+        self.assertEqual(self.resolver.resolve('ファミリーマー卜幕張本郷店')[:2], (1, 'fuzzy'))
+        self.assertIsNone(self.resolver.resolve('ファミリーマート幕張新都心店'))
+
+    def test_similar_excludes_self(self):
+        self.assertEqual([match.store_id for match in self.resolver.similar('ファミリーマート幕張本郷店')], [])
+        self.assertEqual([match.store_id for match in self.resolver.similar('ファミリーマー卜幕張本郷店')], [1])
+
+
+class StoreResolutionServiceTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='resolver', email='resolver@example.com', password='pass')
+        self.store = Store.objects.create(
+            store_name='ローソン丸の内店', category='retail', address='東京都', tel='03-1111-2222', lat=35.68, lng=139.76)
+
+    def _receipt(self, store=None):
+        return Receipt.objects.create(user=self.user, store=store, image_url='http://example.com/r.jpg')
+
+    def test_resolves_existing_store_by_name_or_tel(self):
+        self.assertEqual(StoreResolutionService.resolve('ローソン 丸の内店'), self.store)
+        self.assertEqual(StoreResolutionService.resolve('LAWSON', 'TEL 03-1111-2222'), self.store)
+        self.assertIsNone(StoreResolutionService.resolve('ローソン大手町店'))
+
+    def test_resolver_picks_up_stores_added_by_other_workers(self):
+        resolver = StoreResolutionService.resolver()
+        # 別プロセスでの追加はこのプロセスのキャッシュを無効にしない
+        with mock.patch.object(StoreResolutionService, 'invalidate'):
+            store = Store.objects.create(
+                store_name='ローソン大手町店', category='retail', address='東京都', lat=35.68, lng=139.76)
+        self.assertIs(StoreResolutionService.resolver(), resolver)
+
+        with self.settings(STORE_RESOLVER_MAX_AGE=0):
+            self.assertEqual(StoreResolutionService.resolve('ローソン大手町店'), store)
+
+    def test_unknown_headers_are_queued_and_resolved_by_review(self):
+        receipts = [self._receipt(), self._receipt()]
+        for receipt in receipts:
+            StoreResolutionService.queue('LAWSON 丸の内', 'TEL 03-9999-0000', receipt)
+        self.assertEqual(Store.objects.count(), 1)
+        entry = UnresolvedStoreHeader.objects.get()
+        entry.refresh_from_db()
+        self.assertEqual((entry.occurrences, entry.tel), (2, '0399990000'))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(StoreResolutionService.resolve_header(entry, self.store), 2)
+        self.assertEqual(Receipt.objects.filter(store=self.store).count(), 2)
+        self.assertEqual(StoreResolutionService.resolve('lawson丸の内'), self.store)
+
+    def test_merge_stores_command(self):
+        duplicate = Store.objects.create(store_name='ローソン 丸の内店', category='other', address='不明', lat=35.0, lng=139.0)
+        same_tel = Store.objects.create(
+            store_name='LAWSON丸の内', category='other', address='不明', tel='0311112222', lat=35.0, lng=139.0)
+        for _ in range(2):
+            self._receipt(duplicate)
+        self._receipt(self.store)
+        coupon = Coupon.objects.create(title='統合', description='特典', type='absolute', discount_value=100)
+        for store in (self.store, duplicate):
+            self.user.current_coupons.add(coupon)
+            CouponRedemptionService.redeem(self.user.pk, coupon.pk, store_id=store.pk)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('merge_stores', stdout=StringIO())
+        # レシートの多い店舗が統合先になる
+        self.assertEqual(list(Store.objects.values_list('pk', flat=True)), [duplicate.pk])
+        self.assertEqual(Receipt.objects.filter(store=duplicate).count(), 3)
+        self.assertEqual(CouponUsageRollupService.total(coupon), 2)
+        self.assertEqual(CouponUsageRollupService.breakdown(coupon, 'store_id'), [(duplicate.pk, 2)])
+        self.assertTrue(StoreAlias.objects.filter(store=duplicate, name='LAWSON丸の内').exists())
+        self.assertEqual(StoreResolutionService.resolve('LAWSON丸の内'), duplicate)
+
+    def test_find_duplicates_fuzzy(self):
+        typo = Store.objects.create(store_name='ローソン丸の內店', category='other', address='不明', lat=35.0, lng=139.0)
+        Store.objects.create(store_name='イオン船橋店', category='other', address='不明', lat=35.0, lng=139.0)
+        self.assertEqual(StoreMergeService.find_duplicates(), [])
+        self.assertEqual(StoreMergeService.find_duplicates(fuzzy=True), [[self.store.pk, typo.pk]])
+
+
+class UserMonthlySummaryTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='report', email='report@example.com', password='pass')
+        EcoProduct.objects.create(name='エコバッグ', points=10, is_common=True)
+        self.count = 0
+
+    def _scan(self, *names):
+        self.count += 1
+        items = [{'name': name, 'quantity': 1, 'price': 100} for name in names]
+        parsed = {'store_name': '不明', 'transaction_time': None, 'items': items, 'total_quantity': len(items), 'total_amount': 0}
+        return ReceiptService.save_scanned_receipt(self.user, f'/media/m{self.count}.jpg', f'ocr{self.count}', parsed)
+
+    def test_refresh_aggregates_items_and_legacy_receipts(self):
+        self._scan('牛乳', 'エコバッグ')
+        self._scan('牛乳')
+        Receipt.objects.create(user=self.user, image_url='http://example.com/legacy.jpg', points_earned=0,
+                               parsed_data={'items': [{'name': 'パン', 'quantity': 2}, {'name': '牛乳', 'quantity': 1}]})
+        today = timezone.localdate()
+        # 旧形式のレシートは保存時に加算されないため、集計し直す
+        UserMonthlySummaryService.refresh([self.user.pk])
+        summary = UserMonthlySummaryService.for_month(self.user, today.year, today.month)
+        self.assertEqual(summary.products, [['牛乳', 3], ['エコバッグ', 1], ['パン', 2]])
+        self.assertEqual((summary.receipt_count, summary.total_quantity, summary.eco_quantity), (3, 6, 1))
+        self.assertEqual(summary.products_display()[0], '牛乳 (3点)')
+        self.assertEqual(summary.top_products(1), [('牛乳', 3)])
+
+    def test_report_query_count_does_not_depend_on_receipt_count(self):
+        self.client.force_login(self.user)
+        self._scan('牛乳')
+        self.client.get(reverse('core:ai_report'))
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(reverse('core:ai_report'))
+        for i in range(10):
+            self._scan(f'商品{i}', 'エコバッグ')
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse('core:ai_report'))
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(len(response.context['purchased_products']), 12)
+
+    def test_first_read_of_month_creates_row_once(self):
+        # 月初の画面表示で集計行を作成し、その後のレシートは同じ行に加算される
+        Receipt.objects.create(user=self.user, image_url='http://example.com/legacy.jpg', points_earned=0,
+                               parsed_data={'items': [{'name': 'パン', 'quantity': 2}]})
+        today = timezone.localdate()
+        summary = UserMonthlySummaryService.for_month(self.user, today.year, today.month)
+        self.assertEqual((summary.receipt_count, summary.total_quantity), (1, 2))
+        self._scan('牛乳')
+        self.assertEqual(UserMonthlySummaryService.for_month(self.user, today.year, today.month).receipt_count, 2)
+        self.assertEqual(UserMonthlySummary.objects.filter(user=self.user).count(), 1)
+
+    def _summary_values(self):
+        return list(UserMonthlySummary.objects.filter(user=self.user).values(
+            'month', 'receipt_count', 'eco_points', 'total_quantity', 'eco_quantity', 'products'))
+
+    def test_incremental_updates_match_rebuild(self):
+        self._scan('牛乳', 'エコバッグ')
+        self._scan('つめかえ用シャンプー', '牛乳')
+        summary = UserMonthlySummary.objects.get(user=self.user)
+        self.assertEqual((summary.receipt_count, summary.eco_points, summary.eco_quantity), (2, 10, 1))
+
+        # 再採点でエコ商品が増えると、同じトランザクションで集計に加算される
+        with self.captureOnCommitCallbacks(execute=True):
+            EcoProduct.objects.create(name='つめかえ用シャンプー', points=15, is_common=True)
+        job = BackgroundJob.objects.get(kind=ReceiptRescoreService.JOB_KIND, status='pending')
+        BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+        summary.refresh_from_db()
+        self.assertEqual((summary.eco_points, summary.eco_quantity), (25, 2))
+
+        incremental = self._summary_values()
+        call_command('rebuild_monthly_summaries', stdout=StringIO())
+        self.assertEqual(self._summary_values(), incremental)
+
+
+class FlakyReportModel:
+    """指定回数だけ失敗し、同時に実行中の問い合わせ数の最大値を記録するテスト用モデル"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def generate(self, prompt):
+        self.calls += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.01)
+            if self.failures > 0:
+                self.failures -= 1
+                raise ReportGenerationError('503 Service Unavailable')
+            return f'report: {prompt}'
+        finally:
+            self.running -= 1
+
+
+class LoopBoundReportModel:
+    """gRPCの非同期クライアントと同様に、最初に使用したイベントループ以外からの呼び出しを失敗させるモデル"""
+
+    def __init__(self):
+        self.loop = None
+
+    async def generate(self, prompt):
+        loop = asyncio.get_running_loop()
+        if self.loop is None:
+            self.loop = loop
+        elif self.loop is not loop:
+            raise ReportGenerationError('attached to a different loop')
+        return f'report: {prompt}'
+
+
+class ReportClientPoolTests(SimpleTestCase):
+    def test_retries_transient_errors(self):
+        model = FlakyReportModel(failures=2)
+        pool = ReportClientPool(model, concurrency=1, requests_per_minute=0, max_retries=2, backoff=0)
+        self.assertEqual(pool.generate_all(['a']), ['report: a'])
+        self.assertEqual(model.calls, 3)
+
+        model = FlakyReportModel(failures=5)
+        pool = ReportClientPool(model, concurrency=1, requests_per_minute=0, max_retries=1, backoff=0)
+        results = pool.generate_all(['a', 'b'])
+        self.assertIsInstance(results[0], ReportGenerationError)
+
+    def test_concurrency_is_bounded(self):
+        model = FlakyReportModel()
+        pool = ReportClientPool(model, concurrency=3, requests_per_minute=0, max_retries=0, backoff=0)
+        prompts = [str(i) for i in range(10)]
+        self.assertEqual(pool.generate_all(prompts), [f'report: {prompt}' for prompt in prompts])
+        self.assertEqual(model.max_running, 3)
+
+    def test_pool_reuses_its_event_loop(self):
+        model = LoopBoundReportModel()
+        with ReportClientPool(model, concurrency=2, requests_per_minute=0, max_retries=0, backoff=0) as pool:
+            self.assertEqual(pool.generate_all(['a', 'b']), ['report: a', 'report: b'])
+            self.assertEqual(pool.generate_all(['c']), ['report: c'])
+        self.assertTrue(model.loop.is_closed())
+
+    def test_rate_limiter_spaces_requests(self):
+        limiter = RequestRateLimiter(requests_per_minute=600)
+
+        async def acquire_all():
+            lock = asyncio.Lock()
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            for _ in range(4):
+                await limiter.acquire(lock)
+            return loop.time() - start
+
+        # 0.1秒間隔のため、4回目は約0.3秒後になる
+        self.assertGreaterEqual(asyncio.run(acquire_all()), 0.25)
+        self.assertEqual(RequestRateLimiter(0).interval, 0.0)
+
+
+# 外部サービスに接続しないスタブの生成モデルを使う
+@override_settings(AI_REPORT_MODEL='stub')
+class AIReportServiceTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='ai', email='ai@example.com', password='pass')
+        EcoProduct.objects.create(name='エコバッグ', points=10, is_common=True)
+        self.count = 0
+
+    def _scan(self, user, *names):
+        self.count += 1
+        items = [{'name': name, 'quantity': 1, 'price': 100} for name in names]
+        parsed = {'store_name': '不明', 'transaction_time': None, 'items': items, 'total_quantity': len(items), 'total_amount': 0}
+        return ReceiptService.save_scanned_receipt(user, f'/media/ai{self.count}.jpg', f'ai-ocr{self.count}', parsed)
+
+    def test_post_enqueues_job_and_status_reports_completion(self):
+        self._scan(self.user, '牛乳', 'エコバッグ')
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('core:ai_report'), {'generate': '1'})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Report.objects.exists())
+        job = BackgroundJob.objects.get(kind=AIReportService.JOB_KIND)
+        self.assertEqual(job.params['user_id'], self.user.pk)
+
+        # 生成中はボタンの代わりに状況の表示とポーリング先を出す
+        response = self.client.get(response['Location'])
+        self.assertEqual(response.context['pending_job'], job)
+        status_url = reverse('core:ai_report_status', args=[job.pk])
+        self.assertContains(response, status_url)
+        self.assertEqual(self.client.get(status_url).json()['status'], 'pending')
+
+        job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=job.pk))
+        self.assertEqual(job.status, 'completed')
+        self.assertEqual(self.client.get(status_url).json()['status'], 'completed')
+        report = Report.objects.get(user=self.user)
+        self.assertIn('スタブ', report.description)
+        self.assertEqual((report.score, report.monthly_points), (50, 10))
+        response = self.client.get(reverse('core:ai_report'))
+        self.assertTrue(response.context['report_exists'])
+        self.assertIsNone(response.context['pending_job'])
+
+        # 他のユーザーのジョブは参照できない
+        other = CustomUser.objects.create_user(username='other', email='other@example.com', password='pass')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(status_url).status_code, 404)
+
+    def test_job_batches_other_pending_requests(self):
+        other = CustomUser.objects.create_user(username='ai2', email='ai2@example.com', password='pass')
+        idle = CustomUser.objects.create_user(username='ai3', email='ai3@example.com', password='pass')
+        self._scan(self.user, '牛乳')
+        self._scan(other, 'エコバッグ')
+        today = timezone.localdate()
+        jobs = [AIReportService.request(user, today.year, today.month) for user in (self.user, other, idle)]
+        self.assertEqual(AIReportService.request(self.user, today.year, today.month), jobs[0])
+
+        job = BackgroundJobService.execute(BackgroundJobService.claim(job_id=jobs[0].pk))
+        self.assertEqual(job.result['batch_size'], 3)
+        self.assertEqual(set(BackgroundJob.objects.filter(pk__in=[j.pk for j in jobs]).values_list('status', flat=True)),
+                         {'completed'})
+        self.assertEqual(set(Report.objects.values_list('user_id', flat=True)), {self.user.pk, other.pk})
+
+    def test_monthly_points_include_receipts_without_ledger_rows(self):
+        # 台帳の導入前に読み取ったレシートも月間獲得ポイントに含める
+        Receipt.objects.create(user=self.user, image_url='http://example.com/legacy.jpg', points_earned=20,
+                               parsed_data={'items': [{'name': 'エコバッグ', 'quantity': 2}]})
+        self.assertFalse(PointTransaction.objects.exists())
+        today = timezone.localdate()
+        AIReportService.generate([self.user.pk], today.year, today.month)
+        report = Report.objects.get(user=self.user)
+        self.assertEqual((report.monthly_points, report.score), (20, 100))
+
+    def test_generate_monthly_reports_command(self):
+        other = CustomUser.objects.create_user(username='ai2', email='ai2@example.com', password='pass')
+        CustomUser.objects.create_user(username='ai3', email='ai3@example.com', password='pass')
+        self._scan(self.user, '牛乳')
+        self._scan(other, 'エコバッグ')
+        out = StringIO()
+        call_command('generate_monthly_reports', '--requests-per-minute', '0', '--batch-size', '1', stdout=out)
+        self.assertIn('生成 2 件', out.getvalue())
+        self.assertEqual(Report.objects.count(), 2)
+        job = BackgroundJob.objects.get(kind=AIReportService.MONTHLY_JOB_KIND)
+        self.assertEqual((job.progress, job.total), (2, 2))
+
+        # 再実行しても同じ月のレポートは置き換えられる
+        call_command('generate_monthly_reports', '--requests-per-minute', '0', stdout=StringIO())
+        self.assertEqual(Report.objects.count(), 2)
@@ -11,10 +11,13 @@ urlpatterns = [
     path('coupons/acquire/<int:coupon_id>/', views.acquire_coupon, name='acquire_coupon'),
     path('coupons/use/<int:coupon_id>/', views.use_coupon, name='use_coupon'),
     path("map/", views.store_map, name="store_map"),
+    path("map/stores/", views.store_map_data, name="store_map_data"),
+    path("map/stores/nearest/", views.nearest_stores, name="nearest_stores"),
     path('history/', views.receipt_history, name='receipt_history'),
     path('receipt/<int:receipt_id>/', views.receipt_detail, name='receipt_detail'),
     path("receipts/", views.scan, name="scan"),
     path("reports/", views.ai_report, name="ai_report"),
+    path("reports/jobs/<int:job_id>/", views.ai_report_status, name="ai_report_status"),
     path("inquiries/", views.inquiry, name="inquiry"),
     path("inquiries/complete/", views.inquiry_complete, name="inquiry_complete"),
 
@@ -71,6 +74,8 @@ urlpatterns = [
     path("store/coupons/add/", views.StoreCouponCreateView.as_view(), name="store_coupon_create"),
     path("store/coupons/<int:pk>/edit/", views.StoreCouponUpdateView.as_view(), name="store_coupon_update"),
     path("store/coupons/<int:coupon_id>/request_delete/", views.store_request_coupon_delete, name="store_request_coupon_delete"),
+    path("store/coupons/redeem/", views.redeem_coupons, name="redeem_coupons"),
+    path("store/coupons/redeem/tokens/", views.report_coupon_tokens, name="report_coupon_tokens"),
     
     # --- 承認管理 ---
     path("staff/approvals/", views.approval_list, name="approval_list"),
@@ -4,7 +4,6 @@ from django.contrib.auth import login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.admin.views.decorators import staff_member_required
-from django.core import serializers
 from django.core.mail import EmailMultiAlternatives
 from django.shortcuts import render, redirect, get_object_or_404
 from django.template.loader import render_to_string
@@ -12,7 +11,7 @@ from django.contrib import messages
 from django.core.files.storage import FileSystemStorage
 from django.http import JsonResponse, HttpResponse
 from django.urls import reverse, reverse_lazy
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import condition, require_POST
 from django.views.generic import ListView, CreateView, UpdateView, DeleteView
 from django.utils.decorators import method_decorator
 from django.contrib.auth.mixins import LoginRequiredMixin
@@ -34,9 +33,11 @@ import requests  # Add this import
 from django.core.files.base import ContentFile  # fs.saveエラーを修正するために追加
 import uuid  # Add this
 import numpy as np  # Add this line
-import google.generativeai as genai
 import re  # Add this import
-import calendar
+from core.image_hash import compute_image_hash
+from core.receipt_parser import parse_receipt_data
+from core.rewards import get_reward_engine
+from core.store_index import get_store_index
 
 from django.db import transaction, models, IntegrityError
 
@@ -58,7 +59,7 @@ from .forms import InquiryForm, ReplyForm, StoreForm, AnnouncementForm, CouponFo
 from accounts.forms import StoreUserCreationForm
 
 # Models
-from .models import Inquiry, InquiryMessage, Store, Announcement, Receipt, Coupon, Product, ReceiptItem, EcoProduct, CouponUsage, Report
+from .models import Inquiry, InquiryMessage, Store, Announcement, Receipt, Coupon, Product, ReceiptItem, EcoProduct, CouponUsage, Report, BackgroundJob
 from accounts.models import CustomUser
 
 # --- 認証関連ビュー ---
@@ -214,24 +215,11 @@ def main_menu(request):
     coupons = Coupon.objects.all()[:3]
     receipts = Receipt.objects.filter(
         user=request.user).order_by('-scanned_at')[:3]
-    MAX_POINTS = 800
-    # ランク進捗の計算
+    today = timezone.localdate()
+    monthly_summary = UserMonthlySummaryService.for_month(user, today.year, today.month)
+    # ランク進捗の計算 (RankTierの設定に従う)
     current_points = user.current_points
-    next_rank_points = 0
-    prev_rank_points = 0
-    
-    if current_points < 100:
-        next_rank_points = 100
-        prev_rank_points = 0
-    elif current_points < 300:
-        next_rank_points = 300
-        prev_rank_points = 100
-    elif current_points < 800:
-        next_rank_points = 800
-        prev_rank_points = 300
-    else:
-        next_rank_points = None # Max rank
-        prev_rank_points = 800
+    prev_rank_points, next_rank_points = get_reward_engine().progress(current_points)
 
     progress_percentage = 100
     points_to_next = 0
@@ -254,39 +242,20 @@ def main_menu(request):
         'next_rank_points': next_rank_points,
         'points_to_next': points_to_next,
         'progress_percentage': progress_percentage,
+        'monthly_summary': monthly_summary,
     }
     return render(request, "core/main_menu.html", context)
 
 
 @login_required
 def coupon_list(request):
-    # 所持クーポン
-    owned_coupons = request.user.current_coupons.all()
-    # 使用済みクーポンID
-    used_coupon_ids = CouponUsage.objects.filter(user=request.user).values_list('coupon_id', flat=True)
-    
+    # 所持・取得可能・使用済みのクーポン
     # 排他制御: 既に所持または使用済みのクーポンと同じ `required_points` を持つクーポンは取得リストに出さない。
-    # 1. ユーザーが関与した（所持 or 使用済み）クーポンのIDリスト
-    involved_coupon_ids = list(owned_coupons.values_list('id', flat=True)) + list(used_coupon_ids)
-    
-    # 2. それらのクーポンの `required_points` を取得
-    #    (未設定(0)などは除外するか要検討だが、一旦すべて対象とする)
-    acquired_point_thresholds = Coupon.objects.filter(
-        id__in=involved_coupon_ids
-    ).values_list('required_points', flat=True).distinct()
-    
-    # 3. 取得可能なクーポン
-    #    - ステータスが承認済み ('approved')
-    #    - まだ関与していない (exclude involved_coupon_ids)
-    #    - かつ、既に関与したポイント帯ではない (exclude required_points__in=acquired_point_thresholds)
-    available_coupons = Coupon.objects.filter(status='approved').exclude(
-        id__in=involved_coupon_ids
-    ).exclude(
-        required_points__in=acquired_point_thresholds
-    ).order_by('required_points')
-
-    # 使用済みクーポンオブジェクトの取得
-    used_coupons = Coupon.objects.filter(id__in=used_coupon_ids)
+    owned_coupons, available_coupons, used_coupons = CouponEligibilityService.coupons_for(request.user)
+    # 店舗端末がオフラインで検証できる署名付きトークン
+    tokens = CouponTokenService.issue(request.user, owned_coupons)
+    for coupon in owned_coupons:
+        coupon.token = tokens[coupon.pk]
 
     context = {
         'coupons': owned_coupons,
@@ -297,6 +266,16 @@ def coupon_list(request):
     return render(request, "core/coupon_list.html", context)
 
 
+ACQUIRE_COUPON_ERRORS = {
+    'not_approved': 'このクーポンはまだ承認されていません。',
+    'owned': '既にこのクーポンを持っています。',
+    'used': 'このクーポンは既に使用済みです。',
+    'owned_tier': 'このポイント帯のクーポンは既に取得済みです。',
+    'used_tier': 'このポイント帯のクーポンは既に利用済みです。',
+    'insufficient_points': 'ポイントが不足しています。必要ポイント: {coupon.required_points}pt',
+}
+
+
 @login_required
 @require_POST
 def acquire_coupon(request, coupon_id):
@@ -304,38 +283,11 @@ def acquire_coupon(request, coupon_id):
         coupon = Coupon.objects.get(pk=coupon_id)
         user = request.user
         
-        # 承認済みか確認
-        if coupon.status != 'approved':
-            return JsonResponse({'success': False, 'error': 'このクーポンはまだ承認されていません。'}, status=400)
-        
-        # 既に持っていないか確認
-        if user.current_coupons.filter(pk=coupon_id).exists():
-            return JsonResponse({'success': False, 'error': '既にこのクーポンを持っています。'}, status=400)
-            
-        # 過去に使用していないか確認
-        if CouponUsage.objects.filter(user=user, coupon=coupon).exists():
-             return JsonResponse({'success': False, 'error': 'このクーポンは既に使用済みです。'}, status=400)
-
-        # 排他制御: 同じ required_points のクーポンを既に持っているか、使用済みならNG
-        # 現在所持している他のクーポンで、同じポイントのものがあるか
-        if user.current_coupons.filter(required_points=coupon.required_points).exists():
-            return JsonResponse({'success': False, 'error': 'このポイント帯のクーポンは既に取得済みです。'}, status=400)
-
-        # 過去に使用したクーポンで、同じポイントのものがあるか
-        # CouponUsage -> coupon -> required_points
-        if CouponUsage.objects.filter(user=user, coupon__required_points=coupon.required_points).exists():
-            return JsonResponse({'success': False, 'error': 'このポイント帯のクーポンは既に利用済みです。'}, status=400)
-
-        # ポイント確認 (消費はしないが条件として確認)
-        if user.current_points < coupon.required_points:
-            return JsonResponse({'success': False, 'error': f'ポイントが不足しています。必要ポイント: {coupon.required_points}pt'}, status=400)
-        
-        with transaction.atomic():
-            # ポイント消費はしない
-            
-            # クーポン付与
-            user.current_coupons.add(coupon)
-            
+        # 承認済み・未所持・未使用・未取得のポイント帯・ポイント充足を確認して付与する（ポイント消費はしない）
+        reason = CouponEligibilityService.acquire(user, coupon)
+        if reason is not None:
+            return JsonResponse({'success': False, 'error': ACQUIRE_COUPON_ERRORS[reason].format(coupon=coupon)}, status=400)
+
         return JsonResponse({'success': True, 'new_points': user.current_points})
         
     except Coupon.DoesNotExist:
@@ -344,198 +296,173 @@ def acquire_coupon(request, coupon_id):
         return JsonResponse({'success': False, 'error': f'エラーが発生しました: {str(e)}'}, status=500)
 
 
+def _redemption_request_data(request):
+    """クーポン利用リクエストのJSONオブジェクトを読み込む（不正なJSONはNone）"""
+    if not request.body:
+        return {}
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
 @login_required
 @require_POST
 def use_coupon(request, coupon_id):
-    try:
-        coupon_to_use = request.user.current_coupons.get(pk=coupon_id)
-        
-        # 店舗IDを取得（JSONリクエストを想定）
-        # リクエストボディのサイズ制限 (10KB)
-        if len(request.body) > 10 * 1024:
-             return JsonResponse({'success': False, 'error': 'リクエストサイズが大きすぎます。'}, status=400)
-
-        import json
+    # 店舗ID・冪等キーを取得（JSONリクエストを想定）
+    # リクエストボディのサイズ制限 (10KB)
+    if len(request.body) > 10 * 1024:
+        return JsonResponse({'success': False, 'error': 'リクエストサイズが大きすぎます。'}, status=400)
+    data = _redemption_request_data(request) or {}
+
+    store_id = data.get('store_id')
+    if store_id and not Store.objects.filter(pk=store_id).exists():
         store_id = None
-        if request.body:
-            try:
-                data = json.loads(request.body)
-                store_id = data.get('store_id')
-            except json.JSONDecodeError:
-                pass
-        
-        store = None
-        if store_id:
-            try:
-                store = Store.objects.get(pk=store_id)
-            except Store.DoesNotExist:
-                pass
-
-        # 利用履歴を作成
-        CouponUsage.objects.create(
-            user=request.user,
-            coupon=coupon_to_use,
-            store=store
-        )
-
-        request.user.current_coupons.remove(coupon_to_use)
-        return JsonResponse({'success': True})
-    except Coupon.DoesNotExist:
-        return JsonResponse({'success': False, 'error': '指定されたクーポンが見つかりません。'}, status=404)
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+
+    # 所持クーポンの消費と利用履歴の作成を1トランザクションで行う
+    try:
+        CouponRedemptionService.redeem(
+            request.user.pk, coupon_id, store_id=store_id, idempotency_key=idempotency_key, rank=request.user.rank)
+    except CouponRedemptionError as e:
+        if e.code == 'not_owned':
+            return JsonResponse({'success': False, 'error': '指定されたクーポンが見つかりません。'}, status=404)
+        return JsonResponse({'success': False, 'error': str(e)}, status=409)
+    return JsonResponse({'success': True})
 
 
 @login_required
-def store_map(request):
-    stores = Store.objects.all()
-    stores_json = serializers.serialize('json', stores)
-    return render(request, 'core/store_map.html', {'stores_json': stores_json})
+@require_POST
+@user_passes_test(lambda u: u.is_staff or u.role in ('admin', 'store'))
+def redeem_coupons(request):
+    """
+    POS端末からのクーポン一括利用API。
+    {"redemptions": [{"user_id", "coupon_id", "idempotency_key"}, ...]} を受け取り、1件ごとの結果を返す。
+    店舗スタッフの利用は自店舗での利用として記録する。
+    """
+    # リクエストボディのサイズ制限 (1件あたり256バイト程度)
+    if len(request.body) > 10 * 1024 + settings.COUPON_REDEMPTION_BATCH_LIMIT * 256:
+        return JsonResponse({'success': False, 'error': 'リクエストサイズが大きすぎます。'}, status=400)
+    data = _redemption_request_data(request)
+    redemptions = data.get('redemptions') if data else None
+    if not isinstance(redemptions, list) or not all(isinstance(item, dict) for item in redemptions):
+        return JsonResponse({'success': False, 'error': 'redemptions の形式が正しくありません。'}, status=400)
+    if len(redemptions) > settings.COUPON_REDEMPTION_BATCH_LIMIT:
+        return JsonResponse(
+            {'success': False, 'error': f'一度に送信できるのは{settings.COUPON_REDEMPTION_BATCH_LIMIT}件までです。'},
+            status=400)
+
+    if request.user.role == 'store':
+        if not request.user.store_id:
+            return JsonResponse({'success': False, 'error': '店舗が設定されていません。'}, status=403)
+        store_id = request.user.store_id
+    else:
+        store_id = data.get('store_id')
+        if store_id and not Store.objects.filter(pk=store_id).exists():
+            return JsonResponse({'success': False, 'error': '指定された店舗が見つかりません。'}, status=400)
+
+    results = CouponRedemptionService.redeem_batch(redemptions, store_id=store_id)
+    return JsonResponse({'success': all(result['success'] for result in results), 'results': results})
 
 
 @login_required
-def receipt_history(request):
-    receipts = Receipt.objects.filter(
-        user=request.user).order_by('-scanned_at')
-    return render(request, "core/receipt_history.html", {'receipts': receipts})
+@require_POST
+@user_passes_test(lambda u: u.is_staff or u.role in ('admin', 'store'))
+def report_coupon_tokens(request):
+    """
+    店舗端末でオフライン検証したクーポントークンの利用報告API。
+    {"tokens": [...]} を受け付け、署名の正しいものをバックグラウンドで利用履歴として記録する。
+    """
+    # リクエストボディのサイズ制限 (1件あたり256バイト程度)
+    if len(request.body) > 10 * 1024 + settings.COUPON_REDEMPTION_BATCH_LIMIT * 256:
+        return JsonResponse({'success': False, 'error': 'リクエストサイズが大きすぎます。'}, status=400)
+    data = _redemption_request_data(request)
+    tokens = data.get('tokens') if data else None
+    if not isinstance(tokens, list):
+        return JsonResponse({'success': False, 'error': 'tokens の形式が正しくありません。'}, status=400)
+    if len(tokens) > settings.COUPON_REDEMPTION_BATCH_LIMIT:
+        return JsonResponse(
+            {'success': False, 'error': f'一度に送信できるのは{settings.COUPON_REDEMPTION_BATCH_LIMIT}件までです。'},
+            status=400)
+    if request.user.role == 'store' and not request.user.store_id:
+        return JsonResponse({'success': False, 'error': '店舗が設定されていません。'}, status=403)
+
+    job, accepted, rejected = CouponTokenService.report(tokens, store_id=request.user.store_id, user=request.user)
+    return JsonResponse({
+        'success': not rejected,
+        'job_id': job.pk if job else None,
+        'accepted': accepted,
+        'rejected': rejected,
+    }, status=202 if job else 400)
 
 
 @login_required
-def receipt_detail(request, receipt_id):
-    receipt = get_object_or_404(Receipt, pk=receipt_id, user=request.user)
-    return render(request, "core/result.html", {'receipt': receipt})
+def store_map(request):
+    # 店舗は表示範囲ごとに store_map_data から読み込む
+    return render(request, 'core/store_map.html')
 
 
-def parse_receipt_data(text):
+def _store_map_etag(request):
+    return get_store_index().etag(request.GET.urlencode())
+
+
+@login_required
+@condition(etag_func=_store_map_etag)
+def store_map_data(request):
     """
-    OCRテキストから店舗名、取引日時、商品リスト、合計などを抽出する。（改善版）
-    - 様々な日付フォーマットに対応。
-    - 複数行にわたる商品情報や、1行にまとまった商品情報に対応。
-    - 合計金額、合計点数の抽出精度を向上。
+    地図の表示範囲 (bbox=南,西,北,東) 内の店舗を返すAPI。
+    ズームが STORE_MAP_CLUSTER_MAX_ZOOM 未満の場合は近接する店舗をクラスターにまとめる。
     """
-    lines = text.split('\n')
-    lines = [line.strip() for line in lines if line.strip()]
+    try:
+        south, west, north, east = (float(value) for value in request.GET['bbox'].split(','))
+        zoom = min(max(int(request.GET.get('zoom', 13)), 0), 20)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'bbox=南,西,北,東 と zoom を指定してください。'}, status=400)
+
+    index = get_store_index()
+    indices = index.in_bbox(
+        south, west, north, east,
+        category=request.GET.get('category') or None, keyword=request.GET.get('q') or None,
+    )
+    if zoom < settings.STORE_MAP_CLUSTER_MAX_ZOOM:
+        clusters, stores = index.clusters(indices, zoom)
+    else:
+        clusters, stores = [], [index.records[i] for i in indices]
 
-    store_name = "不明"
-    title_line = ""
-    branch_line = ""
+    response = JsonResponse({'clusters': clusters, 'stores': stores})
+    response['Cache-Control'] = 'private, max-age=60'
+    return response
 
-    if lines:
-        title_line = lines[0]
 
-    for line in lines[1:5]:
-        if line.endswith('店'):
-            branch_line = line
-            break
-    
-    if title_line and branch_line and "HP" not in title_line:
-        store_name = f"{title_line} {branch_line}"
-    elif branch_line:
-        store_name = branch_line
-    elif title_line:
-        store_name = title_line
-    else:
-        store_name = "不明"
+@login_required
+def nearest_stores(request):
+    """(lat, lng) から半径 radius km 以内の近い店舗を最大 k 件、距離の近い順に返すAPI"""
+    try:
+        lat = float(request.GET['lat'])
+        lng = float(request.GET['lng'])
+        k = min(max(int(request.GET.get('k', 10)), 1), settings.STORE_NEAREST_MAX_K)
+        radius_km = min(max(float(request.GET.get('radius', 5)), 0.0), settings.STORE_NEAREST_MAX_RADIUS_KM)
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'lat と lng を指定してください。'}, status=400)
 
-    transaction_time = None
-    date_line_index = -1
-    date_pattern = re.compile(
-        r'(\d{4})[年/]\s*(\d{1,2})[月/]\s*(\d{1,2})日.*?\s*(\d{1,2}):(\d{2})'
-    )
-    for i, line in enumerate(lines):
-        print(f"[DEBUG] Date parsing - Processing line: '{line}'") # デバッグ追加
-        match = date_pattern.search(line)
-        if match:
-            print(f"[DEBUG] Date parsing - Match found for line: '{line}'") # デバッグ追加
-            print(f"[DEBUG] Date parsing - Matched groups: {match.groups()}") # デバッグ追加
-            try:
-                year_str, month_str, day_str, hour_str, minute_str = match.groups()
-                year, month, day, hour, minute = map(
-                    int, [year_str, month_str, day_str, hour_str, minute_str])
-                if year < 100:
-                    year += 2000
-                transaction_time = datetime(year, month, day, hour, minute)
-                date_line_index = i
-                print(f"[DEBUG] Date parsing - Successfully extracted: {transaction_time}") # デバッグ追加
-                break
-            except (ValueError, IndexError) as e: # エラー出力も追加
-                print(f"[DEBUG] Date parsing - Error converting date parts: {e} for groups: {match.groups()}") # デバッグ追加
-                continue
-
-    total_quantity_from_receipt = 0
-    total_amount_from_receipt = 0
-    quantity_total_pattern = re.compile(r'(?:合計点数|買上点数|点数)\s*(\d+)')
-    amount_total_pattern = re.compile(r'(?:(?:御)?合計|小計)\s*¥?([\d,]+)')
-
-    for line in lines:
-        qty_match = quantity_total_pattern.search(line)
-        if qty_match:
-            total_quantity_from_receipt = int(qty_match.group(1))
-        amt_match = amount_total_pattern.search(line)
-        if amt_match:
-            total_amount_from_receipt = int(amt_match.group(1).replace(',', ''))
-
-    items = []
-    start_index = date_line_index + 1 if date_line_index != -1 else 0
-    end_index = len(lines)
-
-    for i, line in enumerate(lines[start_index:]):
-        if any(keyword in line for keyword in ['小計', '合計', 'クレジット', 'お預り']):
-            end_index = start_index + i
-            break
-
-    item_lines = lines[start_index:end_index]
-
-    # 商品行の正規表現
-    single_line_pattern = re.compile(r'^\d{4}\s+(.+?)\s+¥([\d,]+)※?$')
-    name_pattern = re.compile(r'^\d{4}\s+(.+)$')
-    price_pattern = re.compile(r'^¥([\d,]+)※?$')
-    quantity_pattern = re.compile(r'\(?\s*(\d+)\s*[個xX]')
-
-    i = 0
-    while i < len(item_lines):
-        line = item_lines[i]
-        
-        # 1行パターン
-        single_match = single_line_pattern.search(line)
-        if single_match:
-            name = single_match.group(1).strip()
-            price = int(single_match.group(2).replace(',', ''))
-            items.append({"name": name, "quantity": 1, "price": price})
-            i += 1
-        # 2行パターン
-        else:
-            name_match = name_pattern.search(line)
-            if name_match and i + 1 < len(item_lines):
-                next_line = item_lines[i+1]
-                price_match = price_pattern.search(next_line)
-                if price_match:
-                    name = name_match.group(1).strip()
-                    price = int(price_match.group(1).replace(',', ''))
-                    items.append({"name": name, "quantity": 1, "price": price})
-                    i += 2
-                else:
-                    i += 1 # nameはあったがpriceがなかった
-            else:
-                i += 1 # 何にもマッチせず
-            
-        # 数量行のチェック (itemsに追加された後)
-        if items and i < len(item_lines):
-            qty_line = item_lines[i]
-            qty_match = quantity_pattern.search(qty_line)
-            if qty_match:
-                quantity = int(qty_match.group(1))
-                items[-1]['quantity'] = quantity
-                i += 1 # 数量行を消費
-
-    final_total_quantity = total_quantity_from_receipt if total_quantity_from_receipt > 0 else sum(
-        item.get('quantity', 1) for item in items)
-
-    return {
-        "store_name": store_name,
-        "transaction_time": transaction_time,
-        "items": items,
-        "total_quantity": final_total_quantity,
-        "total_amount": total_amount_from_receipt
-    }
+    nearest = get_store_index().nearest(lat, lng, k=k, radius_km=radius_km, category=request.GET.get('category') or None)
+    return JsonResponse({'stores': [dict(store, distance_km=round(distance, 3)) for store, distance in nearest]})
+
+
+@login_required
+def receipt_history(request):
+    receipts = Receipt.objects.filter(
+        user=request.user).select_related('store').order_by('-scanned_at')
+    today = timezone.localdate()
+    monthly_summary = UserMonthlySummaryService.for_month(request.user, today.year, today.month)
+    return render(request, "core/receipt_history.html", {'receipts': receipts, 'monthly_summary': monthly_summary})
+
+
+@login_required
+def receipt_detail(request, receipt_id):
+    receipt = get_object_or_404(Receipt, pk=receipt_id, user=request.user)
+    return render(request, "core/result.html", {'receipt': receipt})
 
 
 @login_required
@@ -551,6 +478,11 @@ def scan(request):
 
         image_bytes = image_file.read()
         ocr_text = None
+
+        # 同じレシート画像の再アップロードは、OCRを実行する前に知覚ハッシュで弾く
+        image_hash = compute_image_hash(image_bytes)
+        if ReceiptService.find_similar_image(request.user, image_hash):
+            return JsonResponse({'success': False, 'error': 'このレシート（画像）は既に登録済みです。'})
         fs = FileSystemStorage()
 
         # --- 新しい安全なファイル名を生成 ---
@@ -653,13 +585,11 @@ def scan(request):
             # (以下、既存のパース・保存ロジック)
             parsed_data = parse_receipt_data(ocr_text)
             store = None
+            store_header = None
             if parsed_data['store_name'] and parsed_data['store_name'] != "不明":
-                store_name_to_find = parsed_data['store_name'].strip()
-                # get_or_create を使用して、店舗が存在しない場合は作成する
-                store, created = Store.objects.get_or_create(
-                    store_name=store_name_to_find,
-                    defaults={'category': 'other', 'address': '不明'} # 新規作成時のデフォルト値
-                )
+                store_header = parsed_data['store_name'].strip()
+                # OCRの表記揺れで店舗が増えないよう、電話番号・店舗名・別名で既存の店舗に照合する
+                store = StoreResolutionService.resolve(store_header, ocr_text)
             # 重複チェック
             if store and parsed_data['transaction_time']:
                 existing_receipt = Receipt.objects.filter(
@@ -672,80 +602,27 @@ def scan(request):
                     return JsonResponse({'success': False, 'error': 'このレシートは既に登録済みです。'})
 
             # OCRテキストによる重複チェック (店舗や日時が不明な場合でも内容が同じなら弾く)
-            # 完全一致は厳しすぎる可能性があるが、同じ画像の再アップロードを防ぐには有効
-            if ocr_text and Receipt.objects.filter(user=request.user, ocr_text=ocr_text).exists():
+            # 正規化したOCRテキストの指紋をインデックスで照合する
+            if ReceiptService.is_duplicate(request.user, ocr_text):
                  return JsonResponse({'success': False, 'error': 'このレシート（画像内容）は既に登録済みです。'})
 
-            try:
-                with transaction.atomic():
-                    # parsed_dataからdatetimeオブジェクトを削除または文字列に変換
-                    data_to_save = parsed_data.copy()
-                    if 'transaction_time' in data_to_save:
-                        del data_to_save['transaction_time']
-
-                    # まずレシート本体を作成
-                    receipt = Receipt.objects.create(
-                        user=request.user,
-                        image_url=image_url,
-                        ocr_text=ocr_text,
-                        store=store,
-                        transaction_time=parsed_data['transaction_time'],
-                        parsed_data=data_to_save  # datetimeを除いた辞書を保存
-                    )
-
-                    # エコ商品のリストを事前に取得
-                    eco_products = list(EcoProduct.objects.all())
-                    total_eco_points_to_add = 0
-                    # パースされたアイテムをReceiptItemモデルに保存
-                    if parsed_data['items']:
-                        import unicodedata
-                        for item_data in parsed_data['items']:
-                            # 商品名が空の場合はスキップ
-                            if not item_data.get('name'):
-                                continue
-
-                            product, created = Product.objects.get_or_create(
-                                name=item_data['name']
-                            )
-                            receipt_item = ReceiptItem(
-                                receipt=receipt,
-                                product=product,
-                                # quantityがない場合のデフォルト値
-                                quantity=item_data.get('quantity', 1),
-                                # priceがない場合のデフォルト値
-                                price=item_data.get('price', 0)
-                            )
-
-                            # ポイント加算ロジック
-                            item_points = 0
-                            # 商品名を正規化（NFKC）して空白削除、小文字化
-                            normalized_product_name = re.sub(r'\s+', '', unicodedata.normalize('NFKC', product.name)).lower()
-                            
-                            for eco_product in eco_products:
-                                # エコ商品名も同様に正規化
-                                normalized_eco_name = re.sub(r'\s+', '', unicodedata.normalize('NFKC', eco_product.name)).lower()
-                                
-                                # 商品名にエコ商品のキーワードが含まれているかチェック
-                                if normalized_eco_name in normalized_product_name:
-                                    # 共通商品 または レシートの店舗とエコ商品の店舗が一致する場合のみ付与
-                                    if eco_product.is_common or (receipt.store and eco_product.store == receipt.store):
-                                        item_points = eco_product.points * receipt_item.quantity # 数量分ポイント加算
-                                        total_eco_points_to_add += item_points
-                                        # 1つの商品行が複数のエコ商品キーワードにマッチしても、最初の1つで抜ける
-                                        break
-                            
-                            receipt_item.points = item_points
-                            receipt_item.save()
-
-                    # 合計ポイントを加算してユーザー情報を更新
-                    if total_eco_points_to_add > 0:
-                        user = request.user
-                        user.add_points(total_eco_points_to_add)
-                        
-                        # レシートにも獲得ポイントを保存
-                        receipt.points_earned = total_eco_points_to_add
-                        receipt.save()
+            # 撮り直しなどでOCR結果がわずかに異なる同一レシートもMinHashで検出する
+            if ReceiptService.find_near_duplicate(request.user, ocr_text, store, parsed_data['transaction_time']):
+                 return JsonResponse({'success': False, 'error': 'このレシートは既に登録済みです（同じ内容のレシートがあります）。'})
 
+            try:
+                # レシート本体・商品マスター・明細を一括保存し、ポイントを付与
+                receipt = ReceiptService.save_scanned_receipt(
+                    user=request.user,
+                    image_url=image_url,
+                    ocr_text=ocr_text,
+                    parsed_data=parsed_data,
+                    store=store,
+                    image_hash=image_hash,
+                )
+            except DuplicateReceiptError as e:
+                # 同時アップロードされた重複はDBの一意制約で検出される
+                return JsonResponse({'success': False, 'error': str(e)})
             except Exception as e:
                 # トランザクション内でエラーが起きた場合
                 import traceback
@@ -754,6 +631,10 @@ def scan(request):
                 print(f"[ERROR] Traceback: {traceback.format_exc()}")
                 return JsonResponse({'success': False, 'error': f"レシートの保存中にエラーが発生しました: {e}"})
 
+            if store is None and store_header:
+                # 照合できなかったヘッダーは店舗を作らず、管理者の確認待ちに登録する
+                StoreResolutionService.queue(store_header, ocr_text, receipt)
+
             redirect_url = reverse('core:receipt_detail', kwargs={
                                    'receipt_id': receipt.id})
             return JsonResponse({'success': True, 'redirect_url': redirect_url})
@@ -763,7 +644,6 @@ def scan(request):
 
 @login_required
 def ai_report(request):
-    from django.db.models import Sum
     # 1. 対象月の決定
     today = timezone.now()
     try:
@@ -792,51 +672,21 @@ def ai_report(request):
 
     is_latest_month = (year == today.year and month == today.month)
     
-    # 2. レシートのフィルタリング
-    start_date = datetime(year, month, 1).date()
-    last_day = calendar.monthrange(year, month)[1]
-    end_date = datetime(year, month, last_day).date()
-    
-    receipts = Receipt.objects.filter(
-        user=request.user,
-        scanned_at__range=(start_date, end_date)
-    )
-    
-    # 3. 商品の集計とスコア計算
-    product_aggregation = {} # 商品名ごとの数量集計用
-    total_quantity = 0
-    total_eco_points = receipts.aggregate(Sum('points_earned'))['points_earned__sum'] or 0
-    eco_quantity = 0
-    
-    for receipt in receipts:
-        # 商品数の集計
-        items = receipt.items.all()
-        if items.exists():
-            for item in items:
-                name = item.product.name
-                qty = item.quantity
-                total_quantity += qty
-                product_aggregation[name] = product_aggregation.get(name, 0) + qty
-                if item.points > 0:
-                    eco_quantity += qty
-        elif receipt.parsed_data and isinstance(receipt.parsed_data, dict) and 'items' in receipt.parsed_data:
-             for item_data in receipt.parsed_data['items']:
-                 name = item_data.get('name', 'Unknown')
-                 qty = item_data.get('quantity', 1)
-                 total_quantity += qty
-                 product_aggregation[name] = product_aggregation.get(name, 0) + qty
-                 # parsed_dataの場合は簡易的に判定
-                 if receipt.points_earned > 0:
-                     # ここでは正確な判定が難しいため、レシート全体にポイントがあれば暫定的にカウント
-                     eco_quantity += qty 
-
-    purchased_products_display = [f"{name} ({qty}点)" for name, qty in product_aggregation.items()]
-
-    # 月間獲得ポイント (最新月の場合は現在の所持ポイントを優先)
-    calculated_monthly_points = request.user.current_points if is_latest_month else total_eco_points
+    # 2. 商品の集計とスコア計算
+    # レシート保存時に更新している月別集計の1行を読む
+    summary = UserMonthlySummaryService.for_month(request.user, year, month)
+    total_quantity = summary.total_quantity
+    eco_quantity = summary.eco_quantity
+    # 月間獲得ポイントもレシートから集計した値を使う（台帳導入前の月も含めて集計済み）
+    total_eco_points = summary.eco_points
+
+    purchased_products_display = summary.products_display()
+
+    # 月間獲得ポイント
+    calculated_monthly_points = total_eco_points
     current_rank_display = request.user.get_rank_display()
 
-    # 4. 既存レポートのチェック
+    # 3. 既存レポートのチェック
     existing_report = Report.objects.filter(
         user=request.user,
         generated_at__year=year,
@@ -867,75 +717,14 @@ def ai_report(request):
         # 最新月の場合は、計算されたリアルタイム値を優先する場合がある（今回は一貫性のためここで上書きを調整）
     
     # レポート生成または再生成（最新月のみ許可）
+    # 生成モデルへの問い合わせはジョブで行い、画面は生成状況を問い合わせて完了後に再読み込みする
     if is_latest_month and request.method == 'POST' and 'generate' in request.POST:
-        # 既存レポートを削除して再生成
-        Report.objects.filter(
-            user=request.user,
-            generated_at__year=year,
-            generated_at__month=month
-        ).delete()
-
-        # エコ商品リストを取得（プロンプト用）
-        eco_product_names = list(EcoProduct.objects.values_list('name', flat=True))
-        
-        # スコア計算 (加重)
-        if total_quantity > 0:
-            raw_score = (total_eco_points / (total_quantity * 10)) * 100
-            score = int(min(raw_score, 100)) # 100点キャップ
-        else:
-            score = 0
-        
         if purchased_products_display:
-            try:
-                genai.configure(api_key=settings.GEMINI_API_KEY)
-                model = genai.GenerativeModel('gemini-flash-latest')
-                
-                # ユーザー入力のサニタイズ
-                safe_products = purchased_products_display
-                safe_eco_products = eco_product_names
-
-                prompt = f"""
-                あなたは環境保護のエキスパートです。
-                ユーザーの今月のエコスコアは【{score}点】です。
-                （購入商品数: {total_quantity}点、うちエコ商品: {eco_quantity}点、獲得エコポイント: {total_eco_points}点）
-                
-                以下の購入商品リストとエコ商品データベースを参考に、
-                ユーザーに向けて**100文字程度**で簡潔なアドバイス付きレポートを作成してください。
-                JSONではなく、テキストのみで出力してください。
+            AIReportService.request(request.user, year, month)
+            return redirect(f"{reverse('core:ai_report')}?year={year}&month={month}")
+        report_text = AIReportService.EMPTY_MESSAGE
 
-                ※購入商品リストはレシートOCRの結果であり、省略や誤字が含まれる可能性があります。
-                文脈から正式な商品名を推測し、どのような商品を購入したかを理解した上でアドバイスを行ってください。
-                
-                # 購入商品リスト:
-                \"\"\"
-                {', '.join(safe_products)}
-                \"\"\"
-                
-                # エコ商品データベース:
-                \"\"\"
-                {', '.join(safe_eco_products)}
-                \"\"\"
-                """
-                
-                response = model.generate_content(prompt)
-                report_text = response.text.strip()
-                
-                # レポート保存
-                Report.objects.create(
-                    user=request.user,
-                    description=report_text,
-                    score=score,
-                    rank=current_rank_display,
-                    monthly_points=calculated_monthly_points,
-                    held_points=request.user.current_points
-                )
-                report_exists = True
-                
-            except Exception as e:
-                print(f"Gemini API Error: {e}")
-                report_text = "AIレポートの生成中にエラーが発生しました。時間をおいて再度お試しください。"
-        else:
-            report_text = "今月の購入履歴がありません。"
+    pending_job = AIReportService.pending_job(request.user, year, month) if is_latest_month else None
 
     # 月間平均スコアの計算
     from django.db.models import Avg
@@ -964,13 +753,29 @@ def ai_report(request):
         'average_score': round(average_score, 1) if average_score else 0,
         'rank': display_rank,
         'held_points': display_held_points,
+        'pending_job': pending_job,
     }
     return render(request, "core/ai_report.html", context)
 
+
+@login_required
+def ai_report_status(request, job_id):
+    """AIレポート生成ジョブの状況を返す（ai_report画面のポーリング用）"""
+    job = get_object_or_404(BackgroundJob, pk=job_id, user=request.user, kind=AIReportService.JOB_KIND)
+    return JsonResponse({
+        'status': job.status,
+        'error': 'AIレポートの生成中にエラーが発生しました。時間をおいて再度お試しください。'
+                 if job.status == 'failed' else '',
+    })
+
 # --- 問い合わせ関連ビュー ---
 
 
-from core.services import InquiryService
+from core.services import (
+    AIReportService, CouponEligibilityService, CouponGrantService, CouponRedemptionError, CouponRedemptionService, CouponStatsService,
+    CouponTokenService, CouponUsageRollupService, DuplicateReceiptError, InquiryService,
+    ReceiptService, StoreResolutionService, UserMonthlySummaryService,
+)
 
 def inquiry(request):
     if request.method == "POST":
@@ -1163,23 +968,24 @@ def grant_coupon_admin(request):
             target_all = form.cleaned_data['target_all']
             
             if target_all:
-                # 全ユーザーのうち、必要ポイントを満たしているユーザーを取得
+                # 全ユーザーのうち、必要ポイントを満たしていて未所持のユーザーに一括付与
                 required_points = coupon.required_points
-                users = CustomUser.objects.filter(role='user', current_points__gte=required_points)
-                
-                count = 0
-                skip_count = 0
-                for user in users:
-                    if user.current_coupons.filter(pk=coupon.pk).exists():
-                        skip_count += 1
-                    else:
-                        user.current_coupons.add(coupon)
-                        count += 1
-                
-                msg = f'条件（{required_points}pt以上）を満たす{count}人のユーザーにクーポン「{coupon.title}」を付与しました。'
-                if skip_count > 0:
-                    msg += f'（{skip_count}人は既に所持していたためスキップ）'
-                messages.success(request, msg)
+                users = CouponGrantService.qualifying_users(coupon)
+                missing = CouponGrantService.missing_holders(coupon, users).count()
+
+                if missing > settings.COUPON_GRANT_SYNC_LIMIT:
+                    # 大量付与はバックグラウンドジョブで実行し、進捗をこのページに表示する
+                    job = CouponGrantService.schedule(coupon, user=request.user)
+                    messages.success(
+                        request, f'{missing}人へのクーポン「{coupon.title}」の付与をバックグラウンドで開始しました（ジョブ #{job.pk}）。')
+                else:
+                    count = CouponGrantService.grant(coupon, users)
+                    skip_count = users.count() - count
+
+                    msg = f'条件（{required_points}pt以上）を満たす{count}人のユーザーにクーポン「{coupon.title}」を付与しました。'
+                    if skip_count > 0:
+                        msg += f'（{skip_count}人は既に所持していたためスキップ）'
+                    messages.success(request, msg)
                 
             else:
                 user = form.cleaned_data['user']
@@ -1194,7 +1000,8 @@ def grant_coupon_admin(request):
             return redirect('core:grant_coupon_admin')
     else:
         form = GrantCouponForm(request_user=request.user)
-    return render(request, 'admin/grant_coupon_admin.html', {'form': form})
+    grant_jobs = BackgroundJob.objects.filter(kind=CouponGrantService.JOB_KIND).order_by('-pk')[:5]
+    return render(request, 'admin/grant_coupon_admin.html', {'form': form, 'grant_jobs': grant_jobs})
 
 
 @staff_member_required
@@ -1264,42 +1071,16 @@ def inquiry_detail(request, inquiry_id):
 def staff_index(request):
     announcements = Announcement.objects.all().order_by('-created_at')
     
-    # クーポン統計の計算
-    coupons = Coupon.objects.all()
-    coupon_stats = []
-    
-    for coupon in coupons:
-        # 現在の所持者数
-        holders_count = coupon.customuser_set.count()
-        # 利用回数
-        usage_count = CouponUsage.objects.filter(coupon=coupon).count()
-        # 発行総数 = 所持者数 + 利用回数
-        issued_count = holders_count + usage_count
-        
-        # 利用率
-        usage_ratio = 0
-        if issued_count > 0:
-            usage_ratio = (usage_count / issued_count) * 100
-            
-        # 自店での利用数
-        used_at_my_store = 0
-        if request.user.role == 'store' and request.user.store:
-            used_at_my_store = CouponUsage.objects.filter(
-                coupon=coupon, 
-                store=request.user.store
-            ).count()
-        elif request.user.role == 'admin' or request.user.is_superuser:
-            # 管理者の場合は全店舗での利用数を表示するか、あるいは「-」とするか
-            # ここでは便宜上、全利用数を表示しておくか、0にしておく
-            used_at_my_store = usage_count
-
-        coupon_stats.append({
-            'coupon': coupon,
-            'issued_count': issued_count,
-            'usage_count': usage_count,
-            'usage_ratio': round(usage_ratio, 1),
-            'used_at_my_store': used_at_my_store
-        })
+    # クーポン統計（全クーポン分を1回のクエリで集計し、店舗ごとにキャッシュ）
+    store = None
+    if request.user.role == 'store' and request.user.store:
+        store = request.user.store
+    # 自店での利用数（管理者は全店舗での利用数、店舗未設定のスタッフは0）
+    show_store_usage = store is not None or request.user.role == 'admin' or request.user.is_superuser
+    coupon_stats = [
+        {**stat, 'used_at_my_store': stat['store_usage_count'] if show_store_usage else 0}
+        for stat in CouponStatsService.stats_for(store)
+    ]
 
     return render(request, "admin/staff_index.html", {
         'announcements': announcements,
@@ -1307,60 +1088,79 @@ def staff_index(request):
     })
 
 
+def _parse_history_cursor(value):
+    """履歴一覧のカーソル「利用日時_ID」を (datetime, id) に変換する（不正な値はNone）"""
+    try:
+        used_at, usage_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(used_at), int(usage_id)
+    except (AttributeError, ValueError):
+        return None
+
+
 @staff_member_required
 def coupon_stats_detail(request, coupon_id):
     coupon = get_object_or_404(Coupon, pk=coupon_id)
-    
-    # 利用履歴の取得
-    usage_history = CouponUsage.objects.filter(coupon=coupon).select_related('user', 'store').order_by('-used_at')
-    
-    # 店舗スタッフの場合は自店の利用履歴のみに絞り込む
+
+    # 店舗スタッフの場合は自店の利用のみを対象にする
+    store = None
     if request.user.role == 'store' and request.user.store:
-        usage_history = usage_history.filter(store=request.user.store)
-    
-    # グラフ用データの作成
+        store = request.user.store
+
+    # 利用履歴の取得 (used_at, id) のキーセットページング
+    usage_history = CouponUsage.objects.filter(coupon=coupon).select_related('user', 'store').order_by('-used_at', '-id')
+    if store is not None:
+        usage_history = usage_history.filter(store=store)
+    cursor = _parse_history_cursor(request.GET.get('before'))
+    if cursor:
+        used_at, usage_id = cursor
+        usage_history = usage_history.filter(models.Q(used_at__lt=used_at) | models.Q(used_at=used_at, id__lt=usage_id))
+    page_size = settings.COUPON_HISTORY_PAGE_SIZE
+    usage_history = list(usage_history[:page_size + 1])
+    next_cursor = None
+    if len(usage_history) > page_size:
+        usage_history = usage_history[:page_size]
+        last = usage_history[-1]
+        next_cursor = f'{last.used_at.isoformat()}_{last.pk}'
+
+    # グラフ用データの作成（利用履歴ではなく日別の集計から読む）
     chart_labels = []
     chart_data = []
-    
-    if request.user.role == 'store' and request.user.store:
+
+    if store is not None:
         # 店舗スタッフ: ランクごとの利用割合
-        from django.db.models import Count
-        rank_stats = usage_history.values('user__rank').annotate(count=Count('id'))
-        
-        # ランク名のマッピング
         rank_names = dict(CustomUser.RANK_CHOICES)
-        
-        for stat in rank_stats:
-            rank_code = stat['user__rank']
-            count = stat['count']
+        for rank_code, count in CouponUsageRollupService.breakdown(coupon, 'rank', store=store):
             chart_labels.append(rank_names.get(rank_code, rank_code))
             chart_data.append(count)
-            
     else:
         # 管理者: 店舗ごとの利用割合
-        from django.db.models import Count
-        store_stats = usage_history.values('store__store_name').annotate(count=Count('id'))
-        
-        for stat in store_stats:
-            store_name = stat['store__store_name'] or '不明/オンライン'
-            count = stat['count']
-            chart_labels.append(store_name)
+        for store_name, count in CouponUsageRollupService.breakdown(coupon, 'store__store_name'):
+            chart_labels.append(store_name or '不明/オンライン')
             chart_data.append(count)
-            
+
     # 発行状況データの作成 (外側のリング用)
     # 利用済み総数
-    global_usage_count = CouponUsage.objects.filter(coupon=coupon).count()
+    global_usage_count = CouponUsageRollupService.total(coupon)
     # 未利用（現在所持しているユーザー数）
     holders_count = coupon.customuser_set.count()
     issued_chart_data = [global_usage_count, holders_count]
 
-    import json
+    # 利用推移（直近48時間は時間別、それ以外は直近30日の日別）
+    period = 'hour' if request.GET.get('period') == 'hour' else 'day'
+    timeline = CouponUsageRollupService.timeline(coupon, period, 48 if period == 'hour' else 30, store=store)
+    label_format = '%m/%d %H時' if period == 'hour' else '%m/%d'
+
     context = {
         'coupon': coupon,
         'usage_history': usage_history,
+        'next_cursor': next_cursor,
+        'is_first_page': cursor is None,
+        'period': period,
         'chart_labels': json.dumps(chart_labels),
         'chart_data': json.dumps(chart_data),
         'issued_chart_data': json.dumps(issued_chart_data),
+        'timeline_labels': json.dumps([timezone.localtime(start).strftime(label_format) for start, _ in timeline]),
+        'timeline_data': json.dumps([count for _, count in timeline]),
         'is_store_staff': request.user.role == 'store'
     }
     return render(request, "admin/coupon_stats_detail.html", context)